@@ -0,0 +1,135 @@
+"""
+Multiple charge correction of SMPS scans expressed as a kernel matrix.
+
+A particle of diameter D carrying j charges has the mobility of a singly charged particle of a smaller diameter and is
+therefore counted in a lower channel.  The measured concentrations (dn) are connected to the true concentrations by an
+upper triangular kernel matrix K (measured channel x true diameter), dn = K . true, with the singly charged fraction on
+the diagonal and the j-times charged fractions above it.  The kernel only depends on the diameters, the gas conditions,
+and the number of charges considered, so it is built once and applied to all scans.
+
+Usage
+-----
+>>> kernel = charge_correction.get_kernel(diam, gas, n=3)
+>>> true_dn = kernel.apply(dn)          # dn can be a single scan or a (scans x diameters) array
+"""
+from collections import OrderedDict as _OrderedDict
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+from atmPy.aerosols.physics import aerosol
+
+_kernels = _OrderedDict()
+_kernel_cache_size = 100
+
+
+class ChargeCorrectionKernel(object):
+    """
+    Kernel matrix of the multiple charge correction, see module docstring.
+
+    Parameters
+    ----------
+    diam:       array of float
+                array of diameters in nm
+    gas:        gas object
+                Gas object that defines the properties of the gas
+    n:          int, optional
+                Number of charges to consider.  Default is 3.
+    pos_neg:    int, optional
+                Positive or negative one indicating whether to consider positive or negative charges.
+                Default is -1.
+
+    Attributes
+    ----------
+    matrix:     2D numpy array
+                The kernel (measured channel x true diameter)
+    f1:         array
+                Singly charged fraction of each diameter
+    channels:   int array (diameters x charges - 1)
+                Channel that contains the particles with 2, 3, ... charges, -1 if below the smallest diameter
+    fractions:  array (diameters x charges - 1)
+                Fraction of particles with 2, 3, ... charges
+    """
+    def __init__(self, diam, gas, n=3, pos_neg=-1):
+        diam = np.asarray(diam, dtype=float)
+        self.diam = diam
+        self.n = n
+        self.pos_neg = pos_neg
+
+        self.f1 = aerosol.ndistr(diam, pos_neg, gas.t)
+        self.channels = np.full((diam.shape[0], max(n - 1, 0)), -1, dtype=int)
+        self.fractions = np.zeros((diam.shape[0], max(n - 1, 0)))
+
+        # Mobility of singly charged particles
+        z1 = np.abs(aerosol.z(diam, gas, pos_neg))
+
+        for j in range(2, n + 1):
+            self.fractions[:, j - 2] = aerosol.ndistr(diam, j * pos_neg, gas.t)
+
+            # Diameter bin which contains the multiply charged particles
+            d_mult = aerosol.z2d_vectorized(j * z1, gas, 1)
+            k = np.abs(diam[None, :] - d_mult[:, None]).argmin(axis=1)
+            self.channels[:, j - 2] = np.where(d_mult >= diam[0], k, -1)
+
+        self.matrix = np.diag(self.f1)
+        for j in range(self.channels.shape[1]):
+            valid = self.channels[:, j] >= 0
+            np.add.at(self.matrix, (self.channels[valid, j], np.arange(diam.shape[0])[valid]),
+                      self.fractions[valid, j])
+
+    def apply(self, dn, clip=True):
+        """
+        Correct concentrations for multiple charges.
+
+        Parameters
+        ----------
+        dn:     array of float
+                Concentrations of a single scan or a 2D array (scans x diameters)
+        clip:   bool, optional
+                If True (default) the scans are corrected by back-substitution from the largest to the smallest
+                diameter and no more particles are removed from a channel than it contains (this is the behaviour of
+                SMPS.__chargecorr__).  If False the linear system is solved for all scans in a single
+                triangular solve, which can result in negative concentrations.
+
+        Returns
+        -------
+        Corrected concentrations, same shape as dn
+        """
+        dn = np.asarray(dn, dtype=float)
+        single = dn.ndim == 1
+        dn = np.atleast_2d(dn)
+
+        if not clip:
+            out = solve_triangular(self.matrix, dn.T, lower=False).T
+
+        else:
+            out = dn.copy()
+            for l in range(out.shape[1] - 1, -1, -1):
+                for j in range(self.channels.shape[1] - 1, -1, -1):
+                    k = self.channels[l, j]
+                    if k < 0:
+                        continue
+                    # Remove the particles in bin k that belong in the current bin, but don't remove more
+                    # particles than there are in the bin
+                    out[:, k] -= np.minimum(out[:, l] * self.fractions[l, j] / self.f1[l], out[:, k])
+                out[:, l] /= self.f1[l]
+
+        if single:
+            return out[0]
+        return out
+
+
+def get_kernel(diam, gas, n=3, pos_neg=-1):
+    """
+    ChargeCorrectionKernel for the given diameters, gas conditions, and number of charges.  Kernels are memoized, so
+    scans taken under the same conditions share one kernel.
+    """
+    diam = np.asarray(diam, dtype=float)
+    key = (diam.tobytes(), float(gas.t), float(gas.mu()), float(gas.l()), int(n), int(pos_neg))
+    if key in _kernels:
+        _kernels.move_to_end(key)
+    else:
+        _kernels[key] = ChargeCorrectionKernel(diam, gas, n=n, pos_neg=pos_neg)
+        while len(_kernels) > _kernel_cache_size:
+            _kernels.popitem(last=False)
+    return _kernels[key]
@@ -7,9 +7,11 @@ Created on Tue Mar  3 10:45:47 2015
 from math import log
 from math import pi
 
+import numpy as np
 from scipy.optimize import newton
 
 from atmPy.aerosols.physics.aerosol import z
+from atmPy.aerosols.physics.aerosol import z2d_vectorized
 
 
 class DMA(object):
@@ -92,6 +94,38 @@ class DMA(object):
         zc = (qc+qm)/(4*pi*gamma*v)
         return newton(lambda d: z(d, gas, 1)-zc, 1, maxiter=1000)
 
+    def v2d_vectorized(self, v, gas, qc, qm, rtol=1e-10):
+        """
+        Vectorized version of v2d, which finds the selected diameters for an array of voltages at once (see
+        aerosol.z2d_vectorized).
+
+        Parameters
+        ----------
+        v:      float or array-like
+                Voltage in Volts
+        gas:    gas object
+                Carrier gas object for performing calculations
+        qc:     float
+                Input sheath flow in lpm
+        qm:     float
+                Output sheath flow in lpm
+        rtol:   float, optional
+                Relative tolerance of the diameters
+
+        Returns
+        -------
+        Diameters in nanometers (array)
+        """
+        gamma = self._l/log(self._ro/self._ri)
+
+        # Convert flow rates from lpm to m3/s
+        qc = float(qc)/60*0.001
+        qm = float(qm)/60*0.001
+
+        # Central mobility
+        zc = (qc+qm)/(4*pi*gamma*np.asarray(v, dtype=float))
+        return z2d_vectorized(zc, gas, 1, rtol=rtol)
+
 
 class NoaaWide(DMA):
     """
@@ -125,3 +159,33 @@ class Tsi3085(DMA):
 
     def __init__(self):
         super(Tsi3085, self).__init__(0.04987, 0.01961, 0.00937)
+
+
+def benchmark_v2d(gas, dma=None, no_of_voltages=1000):
+    """
+    Compares DMA.v2d in a loop (as in a SMPS scan) with DMA.v2d_vectorized.
+
+    Parameters
+    ----------
+    gas:    gas object
+    dma:    DMA object, optional
+            Default is the NOAA wide DMA.
+    no_of_voltages: int
+    """
+    import time
+    if dma is None:
+        dma = NoaaWide()
+    v = np.logspace(1, 4, no_of_voltages)
+
+    start = time.time()
+    d_loop = np.array([dma.v2d(i, gas, 5., 5.) for i in v])
+    time_loop = time.time() - start
+
+    start = time.time()
+    d_vec = dma.v2d_vectorized(v, gas, 5., 5.)
+    time_vec = time.time() - start
+
+    print('loop: %.3f s' % time_loop)
+    print('vectorized: %.4f s (speedup: %.0f)' % (time_vec, time_loop / time_vec))
+    print('max. relative deviation: %s' % np.abs(d_vec / d_loop - 1).max())
+    return time_loop, time_vec
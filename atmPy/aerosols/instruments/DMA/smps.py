@@ -1,5 +1,7 @@
 import sys
 import tkinter as tk
+import uuid
+from concurrent import futures
 from datetime import datetime as dt
 from datetime import timedelta
 from math import floor
@@ -13,6 +15,55 @@ from scipy.interpolate import interp1d
 
 from atmPy.general.atmosphere import Air
 from atmPy.aerosols.physics import aerosol
+from atmPy.aerosols.instruments.DMA import charge_correction
+from atmPy.aerosols.instruments.DMA import transfer_function
+from atmPy.aerosols.size_distribution import diameter_binning
+from atmPy.aerosols.size_distribution import sizedistribution
+
+
+# Precision of the scan conditions used for the inversion.  Scans under practically the same conditions then have the
+# same channel diameters and share the memoized transfer function widths and charge correction kernels (see
+# transfer_function.get_fwhm and charge_correction.get_kernel).
+_t_decimals = 1     # temperature in C
+_p_decimals = 2     # pressure in psi
+_q_digits = 3       # significant digits of the flows
+
+
+def _round_conditions(mean_data):
+    """Temperature, pressure, aerosol and sheath flow of a scan, rounded to the precision given above."""
+    def significant(value):
+        return float('%.*g' % (_q_digits, value))
+    return (round(float(mean_data.Aer_Temp_C), _t_decimals), round(float(mean_data.Aer_Pres_PSI), _p_decimals),
+            significant(mean_data.Aer_Q_VLPM), significant(mean_data.Sh_Q_VLPM))
+
+
+# SMPS instance of a worker process and the token of the settings it was set up with, see SMPS.proc_files
+_worker_smps = None
+_worker_token = None
+
+
+def _init_worker(dma, lag, alpha, diam_interp, diffusion):
+    """Sets up the SMPS instance of a worker process."""
+    global _worker_smps
+    _worker_smps = SMPS(dma)
+    _worker_smps.lag = lag
+    _worker_smps.alpha = alpha
+    _worker_smps.diam_interp = diam_interp
+    _worker_smps.diffusion = diffusion
+
+
+def _proc_file(fname, token, settings):
+    """Processes a single file in a worker process.
+
+    The settings (see _init_worker) are sent with each file, since ProcessPoolExecutor only takes an initializer from
+    Python 3.7 on. The SMPS instance of the worker is only set up again if the token changed, i.e. for the first file
+    of each call of SMPS.proc_files, so the caches of the charge correction and transfer function carry over from
+    file to file."""
+    global _worker_token
+    if token != _worker_token:
+        _init_worker(*settings)
+        _worker_token = token
+    return _worker_smps.__proc_file__(fname)
 
 
 class SMPS(object):
@@ -34,9 +85,15 @@ class SMPS(object):
     air:            Air object
                     Use this object to set the temperature and pressure and do calculations related to the gas
     files:          list of file objects
-                    These are the files that will be processed
+                    These are the files that will be processed (file names work as well)
     scan_folder:    String
                     Location of scan data
+    size_distribution:  SizeDist_TS
+                    dNdlogDp distributions of all processed scans, see proc_files
+    failed:         dict
+                    Files that could not be processed by proc_files and the corresponding exception
+    diffusion:      bool
+                    If True the channel widths are derived from the diffusion broadened transfer function
 
 
     """
@@ -58,6 +115,10 @@ class SMPS(object):
         self.lag = 10
         # Smoothing parameter for the LOWESS smoothing
         self.alpha = 0.3
+        # Use the diffusion broadened transfer function to get the width of the channels
+        self.diffusion = False
+        self.size_distribution = None
+        self.failed = {}
 
     def openFiles(self, scan_folder=''):
         """
@@ -132,195 +193,206 @@ class SMPS(object):
             b)
 
         """
-        # Flip the incoming diamter array
-        rdiam = np.copy(diam[::-1])
+        # The loops described above are expressed as a kernel matrix, which is built once for the diameters, gas
+        # conditions and number of charges (see charge_correction).
+        kernel = charge_correction.get_kernel(diam, gas, n=n, pos_neg=pos_neg)
+        dn[:] = kernel.apply(dn)
 
-        # We are working backwards, so we need to have the length to get this all right...
-        l = len(dn)-1
+        return None
 
-        # Inline function for finding the value closest to diameter d in the array diam
-        fmin = lambda nd: (np.abs(np.asarray(diam) - nd)).argmin()
+    def __proc_file__(self, fname):
+        """
+        Process a single scan file.
 
-        for i, d in enumerate(rdiam):
+        Parameters
+        ----------
+        fname:  string
+                Name of the scan file
 
-            # Get the fraction of particles that are singly charged
-            f1 = aerosol.ndistr(d, pos_neg, gas.t)
+        Returns
+        -------
+        dict with the start times, diameters, raw and smoothed CPC concentrations, and the rounded conditions
+        (temperature, pressure, aerosol and sheath flow, see _round_conditions) of the up and the down scan.  The
+        inversion (SMPS.__fwhm__) is done by proc_files for all scans at once.
+        """
+        # Get the data in the file header
+        meta_data = self.__readmeta__(fname)
 
-            for j in reversed(range(2, n+1)):  # Loop through charges 2 and higher backwards
+        # Retrieve the scan and dwell times from the meta data.
+        tscan = meta_data['Scan_Time'].values[0]
+        tdwell = meta_data['Dwell_Time'].values[0]
 
-                ne = j*pos_neg
-                fi = aerosol.ndistr(d, ne, gas.t)
+        # This is the data in the scan file
+        data = self.__readdata__(fname)
 
-                # Mobility of multiply charged particles
-                z_mult = abs(ne * aerosol.z(d, gas, pos_neg))
+        # Get the CPC data of interest and pad the end with zeros for the sake of
+        # readability.
+        cpc_data = np.pad(data.CPC_1_Cnt.values[self.lag:], (0, self.lag),
+                          mode="constant", constant_values=(0, 0))
 
-                # Diameter bin which contains the multiply charged particles
-                d_mult = aerosol.z2d(z_mult, gas, 1)
+        # This is the CPC concentration
+        cpc_data /= data.CPC_Flw.values
 
-                # Continue while the diameter specified is larger than the minimum diameter
-                if d_mult >= diam[0]:
+        # Remove NaNs and infs from the cpc data
+        cpc_data[np.where(np.isnan(cpc_data))] = 0.0
+        cpc_data[np.where(np.isinf(cpc_data))] = 0.0
 
-                    # Find the index of the multiple charges
-                    k = fmin(d_mult)
+        # In the following section, we will take the two variables, 'data' and
+        # 'cpc_data' to produce the data that will be run through the core of
+        # the processing code.  The steps are as follows to prepare the data:
+        #   1. If the data is the downward data, flip the arrays.
+        #   2. Truncate the data to get the scanned data.
+        #       a. If the data is the up data, we simply want the first 'tscan'
+        #          elements.
+        #       b. If the data is the down data, we will account for the final
+        #          dwell time ('tdwell'), and take the portion of the arrays
+        #          from tdwell to tscan + tdwell.
+        #   3. Get the mean values of all the data in the scan array from the
+        #      respective data array.  We will use the mean values for inversion.
 
-                    # Remove the particles in bin k that belong in the current bin, but don't remove more
-                    # particles than there are in the bin
-                    dn[k] -= min(dn[l-i]*fi/f1, dn[k])
+        # PRODUCE UP DATA FOR PROCESSING #
+        # Extract the portion of the CPC data of interest for the upward scan
+        cpc_up = cpc_data[:tscan]
+        up_data = data.iloc[:tscan]
+        smooth_up = sm.nonparametric.lowess(cpc_up, up_data.DMA_Diam.values,
+                                            frac=self.alpha, it=1, missing='none',
+                                            return_sorted=False)
 
-                # The total number of particlesi n the current bin is simply the number of singly charged
-                # particles divided by the singly charged charging efficiency.
-            dn[l-i] /= f1
+        smooth_up[np.where(np.isnan(smooth_up))] = 0.0
+        smooth_up[np.where(np.isinf(smooth_up))] = 0.0
 
-        return None
+        # Retrieve mean up data
+        cup = _round_conditions(up_data.mean(axis=0))
 
-    def proc_files(self):
-        """
-        Process the files that are contained by the SMPS class attribute 'files'
-        """
+        self.air.t, self.air.p = cup[:2]
 
-        e_count = 0
-        # TODO: Some of the processes here can be parallelized using the multiprocessing library
-        #       Reading of the data and determing the lag will require a proper sequence, but
-        #       we can parallelize:
-        #       1) The processing of an individual file
-        #       2) The processing of the up and down scans within a file
-        #       WARNING:    Need to ensure that the different processes don't step on each other.
-        #                   Likely we would need to make some of the instance variables local (air.t and air.p
-        #                   come to mind).
+        # Calculate diameters from voltages
+        dup = self.dma.v2d_vectorized(up_data.DMA_Set_Volts.values, self.air, cup[3], cup[3])
 
-        self.dn_interp = np.zeros((2*len(self.files), len(self.diam_interp)))
-        self.date = [None]*2*len(self.files)
+        # UP DATA PRODUCTION COMPLETE #
 
-        self.cn_raw = np.zeros((2*len(self.files), len(self.diam_interp)))
-        self.cn_smoothed = np.zeros((2*len(self.files), len(self.diam_interp)))
-        self.diam = np.zeros((2*len(self.files), len(self.diam_interp)))
+        # BEGIN DOWN DATA PRODUCTION #
+        # Flip the cpc data and extricate the portion of interest
+        cpc_down = cpc_data[::-1]
+        cpc_down = cpc_down[tdwell:tscan+tdwell]
 
-        for e, i in enumerate(self.files):
-
-            try:
-
-                print(i.name)
-
-                # Get the data in the file header
-                meta_data = self.__readmeta__(i.name)
-
-                # Retrieve the scan and dwell times from the meta data.
-                tscan = meta_data['Scan_Time'].values[0]
-                tdwell = meta_data['Dwell_Time'].values[0]
-
-                # This is the data in the scan file
-                data = self.__readdata__(i.name)
-
-                # Get the CPC data of interest and pad the end with zeros for the sake of
-                # readability.
-                cpc_data = np.pad(data.CPC_1_Cnt.values[self.lag:], (0, self.lag),
-                                  mode="constant", constant_values=(0, 0))
-
-                # This is the CPC concentration
-                cpc_data /= data.CPC_Flw.values
-
-                # Remove NaNs and infs from the cpc data
-                cpc_data[np.where(np.isnan(cpc_data))] = 0.0
-                cpc_data[np.where(np.isinf(cpc_data))] = 0.0
-
-                # In the following section, we will take the two variables, 'data' and
-                # 'cpc_data' to produce the data that will be run through the core of
-                # the processing code.  The steps are as follows to prepare the data:
-                #   1. If the data is the downward data, flip the arrays.
-                #   2. Truncate the data to get the scanned data.
-                #       a. If the data is the up data, we simply want the first 'tscan'
-                #          elements.
-                #       b. If the data is the down data, we will account for the final
-                #          dwell time ('tdwell'), and take the portion of the arrays
-                #          from tdwell to tscan + tdwell.
-                #   3. Get the mean values of all the data in the scan array from the
-                #      respective data array.  We will use the mean values for inversion.
-
-                # PRODUCE UP DATA FOR PROCESSING #
-                # Extract the portion of the CPC data of interest for the upward scan
-                cpc_up = cpc_data[:tscan]
-                up_data = data.iloc[:tscan]
-                smooth_up = sm.nonparametric.lowess(cpc_up, up_data.DMA_Diam.values,
-                                                    frac=self.alpha, it=1, missing='none',
-                                                    return_sorted=False)
-
-                smooth_up[np.where(np.isnan(smooth_up))] = 0.0
-                smooth_up[np.where(np.isinf(smooth_up))] = 0.0
-
-                # Retrieve mean up data
-                mup = up_data.mean(axis=0)
-
-                self.air.t = mup.Aer_Temp_C
-                self.air.p = mup.Aer_Pres_PSI
-
-                # Calculate diameters from voltages
-                dup = [self.dma.v2d(i, self.air, mup.Sh_Q_VLPM,
-                                    mup.Sh_Q_VLPM) for i in up_data.DMA_Set_Volts.values]
-
-                # UP DATA PRODUCTION COMPLETE #
-
-                # BEGIN DOWN DATA PRODUCTION #
-                # Flip the cpc data and extricate the portion of interest
-                cpc_down = cpc_data[::-1]
-                cpc_down = cpc_down[tdwell:tscan+tdwell]
-
-                # Flip the down data and slice it
-                down_data = data.iloc[::-1]
-                down_data = down_data.iloc[int(tdwell):int(tscan+tdwell)]
-
-                smooth_down = sm.nonparametric.lowess(cpc_down, down_data.DMA_Diam.values,
-                                                      frac=self.alpha, it=1, missing='none',
-                                                      return_sorted=False)
-
-                smooth_down[np.where(np.isnan(smooth_up))] = 0.0
-                smooth_down[np.where(np.isinf(smooth_up))] = 0.0
-
-                # Retrieve mean down data
-                mdown = down_data.mean(axis=0)
-
-                self.air.t = mdown.Aer_Temp_C
-                self.air.p = mdown.Aer_Pres_PSI
-
-                # Calculate diameters from voltages
-                ddown = [self.dma.v2d(i, self.air, mdown.Sh_Q_VLPM,
-                                      mdown.Sh_Q_VLPM) for i in down_data.DMA_Set_Volts.values]
+        # Flip the down data and slice it
+        down_data = data.iloc[::-1]
+        down_data = down_data.iloc[int(tdwell):int(tscan+tdwell)]
 
-                up_interp_dn = self.__fwhm__(dup, smooth_up, mup)
-                down_interp_dn = self.__fwhm__(ddown, smooth_down, mdown)
+        smooth_down = sm.nonparametric.lowess(cpc_down, down_data.DMA_Diam.values,
+                                              frac=self.alpha, it=1, missing='none',
+                                              return_sorted=False)
 
-                up_interp_dn[np.where(up_interp_dn < 0)] = 0
-                down_interp_dn[np.where(down_interp_dn < 0)] = 0
+        smooth_down[np.where(np.isnan(smooth_up))] = 0.0
+        smooth_down[np.where(np.isinf(smooth_up))] = 0.0
 
-            except ValueError:
-                print("Unexpected error:", sys.exc_info()[0])
-                print("Issue processing file " + str(i.name))
-                e_count += 1
-                continue
-            except TypeError:
-                print("Error processing file.")
-                e_count += 1
-                continue
+        # Retrieve mean down data
+        cdown = _round_conditions(down_data.mean(axis=0))
 
-            else:
-                n_e = e-e_count
-                # Stuff the data for the attributes down here.  If an error is thrown, we will not contaminate
-                # member data.
+        self.air.t, self.air.p = cdown[:2]
 
-                self.date[2*n_e] = dt.strptime(str(meta_data.Date[0]) + ',' + str(meta_data.Time[0]),
-                                               '%m/%d/%y,%H:%M:%S')
-                self.date[2*n_e + 1] = self.date[2*n_e] + timedelta(0, tscan + tdwell)
+        # Calculate diameters from voltages
+        ddown = self.dma.v2d_vectorized(down_data.DMA_Set_Volts.values, self.air, cdown[3], cdown[3])
 
-                self.diam[2*n_e, 0:np.asarray(dup).size] = np.asarray(dup)
-                self.cn_raw[2*n_e, 0:cpc_up.size] = cpc_up
+        date_up = dt.strptime(str(meta_data.Date[0]) + ',' + str(meta_data.Time[0]), '%m/%d/%y,%H:%M:%S')
 
-                # Store raw data for the down scan
-                self.cn_raw[2*n_e+1, 0:cpc_down.size] = cpc_down
-                self.diam[2*n_e+1, 0:np.asarray(ddown).size] = np.asarray(ddown)
+        return {'date': (date_up, date_up + timedelta(0, int(tscan + tdwell))),
+                'diam': (np.asarray(dup), np.asarray(ddown)),
+                'cn_raw': (cpc_up, cpc_down),
+                'cn_smoothed': (smooth_up, smooth_down),
+                'conditions': (cup, cdown)}
+
+    def proc_files(self, workers=1):
+        """
+        Process the files that are contained by the SMPS class attribute 'files'
 
-                self.cn_smoothed[2*n_e, 0:smooth_up.size] = smooth_up
-                self.cn_smoothed[2*n_e+1, 0:smooth_down.size] = smooth_down
-                self.dn_interp[2*n_e, :] = up_interp_dn
-                self.dn_interp[2*n_e+1, :] = down_interp_dn
+        Parameters
+        ----------
+        workers:    int, optional
+                    Number of processes the files are spread over.  Each process gets its own copy of the DMA, the
+                    settings (lag, alpha, diam_interp) and its own Air object, so the files do not step on each
+                    other.  Default is 1, which processes the files one after the other in the current process.
+
+        Returns
+        -------
+        SizeDist_TS instance
+            Up and down scans of all files that could be processed, in chronological order.  The same is stored in
+            the attribute size_distribution.  Files that could not be processed are reported and collected in the
+            attribute failed ({file name: exception}).
+
+        Raises
+        ------
+        ValueError
+            If none of the files could be processed.
+        """
+        fnames = [i.name if hasattr(i, 'name') else i for i in self.files]
+        if workers < 1:
+            raise ValueError('workers has to be at least 1.')
+
+        results = []
+        if workers == 1 or len(fnames) < 2:
+            for fname in fnames:
+                print(fname)
+                try:
+                    results.append(self.__proc_file__(fname))
+                except Exception as err:
+                    results.append(err)
+        else:
+            token = uuid.uuid4().hex
+            settings = (self.dma, self.lag, self.alpha, self.diam_interp, self.diffusion)
+            with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                jobs = [executor.submit(_proc_file, fname, token, settings) for fname in fnames]
+                for fname, job in zip(fnames, jobs):
+                    try:
+                        results.append(job.result())
+                    except Exception as err:
+                        results.append(err)
+
+        self.failed = {}
+        processed = []
+        for fname, result in zip(fnames, results):
+            if isinstance(result, Exception):
+                print("Issue processing file " + str(fname) + ": " + repr(result))
+                self.failed[fname] = result
+            else:
+                processed.append(result)
+
+        if len(processed) == 0:
+            self.size_distribution = None
+            raise ValueError('None of the %i files could be processed, see the attribute failed.' % len(fnames))
+
+        # Bring the scans into chronological order, no matter in which order the files were given
+        processed.sort(key=lambda result: result['date'][0])
+
+        self.dn_interp = np.zeros((2*len(processed), len(self.diam_interp)))
+        self.date = [None]*2*len(processed)
+
+        self.cn_raw = np.zeros((2*len(processed), len(self.diam_interp)))
+        self.cn_smoothed = np.zeros((2*len(processed), len(self.diam_interp)))
+        self.diam = np.zeros((2*len(processed), len(self.diam_interp)))
+
+        # Scans with the same diameters and conditions are inverted at once
+        groups = {}
+        for n_e, result in enumerate(processed):
+            for k in (0, 1):
+                self.date[2*n_e + k] = result['date'][k]
+                self.diam[2*n_e + k, 0:result['diam'][k].size] = result['diam'][k]
+                self.cn_raw[2*n_e + k, 0:result['cn_raw'][k].size] = result['cn_raw'][k]
+                self.cn_smoothed[2*n_e + k, 0:result['cn_smoothed'][k].size] = result['cn_smoothed'][k]
+                diam = np.asarray(result['diam'][k], dtype=float)
+                key = (diam.tobytes(), result['conditions'][k])
+                group = groups.setdefault(key, (diam, result['conditions'][k], [], []))
+                group[2].append(2*n_e + k)
+                group[3].append(result['cn_smoothed'][k])
+
+        for diam, conditions, rows, dn in groups.values():
+            self.dn_interp[rows] = self.__fwhm__(diam, dn, conditions)
+
+        bins, colnames = diameter_binning.bincenters2binsANDnames(self.diam_interp)
+        df = pd.DataFrame(self.dn_interp, index=pd.DatetimeIndex(self.date))
+        self.size_distribution = sizedistribution.SizeDist_TS(df, bins, 'dNdlogDp')
+        return self.size_distribution
 
     @staticmethod
     def __readmeta__(file):
@@ -353,7 +425,7 @@ class SMPS(object):
         --------
         pandas data frame
         """
-        return pd.read_csv(file, parse_dates='Date_Time', index_col=0, header=2, lineterminator='\n')
+        return pd.read_csv(file, parse_dates=True, index_col=0, header=2, lineterminator='\n')
 
     def getLag(self, index, delta=0, p=True):
         """
@@ -455,7 +527,7 @@ class SMPS(object):
 
         return None
 
-    def __fwhm__(self, diam, dn, mean_data):
+    def __fwhm__(self, diam, dn, conditions):
         """
         Retrieve the full width at half max and return an interpolated concentration dN/dlogdp array
 
@@ -464,75 +536,36 @@ class SMPS(object):
         diam:       NumPy array of floats
                     Diameters calculated from the setpoint voltage of the scan.  Units are nm
         dn:         NumPy array of floats
-                    CPC concentration at each diameter.  Units are cc^-1.
-        mean_data:  pandas DataFrame
-                    DataFrame containing mean data from the scan.
-        :return:
+                    CPC concentration at each diameter of a single scan or of several scans (scans x diameters).
+                    Units are cc^-1.
+        conditions: tuple
+                    Rounded temperature, pressure, aerosol and sheath flow of the scans, see _round_conditions.
+        :return:    Charge corrected dNdlogDp distributions on diam_interp, same number of dimensions as dn
         """
-        ls = len(dn)
-        dlogd = np.zeros(ls)    # calculate dlogd
-        fwhm = np.zeros(ls)     # hold width
-        self.air.t = mean_data.Aer_Temp_C
-        self.air.p = mean_data.Aer_Pres_PSI
-
-        def xfer(dp, qa, qs):
-            """
-            Return the full-width, half-max of the transfer function in diameter space.
-            This implementation ignores diffusion broadening.
-
-            Parameters
-            -----------
-            dp: float
-                particle size in nm
-            qa: float
-                aerosol flow rate in lpm
-            qs: float
-                aerosol flow rate in lpm
-
-            Returns
-            -------
-            Width of transfer function in nm.
-            """
-            beta = float(qa)/float(qs)
-
-            # Retrieve the center mobility
-            zc = aerosol.z(dp, self.air, 1)
-
-            # Upper bound of the mobility
-            zm = (1-beta/2)*zc
-
-            # Lower bound of the mobility
-            zp = (1+beta/2)*zc
-
-            return aerosol.z2d(zm, self.air, 1) - aerosol.z2d(zp, self.air, 1)
-
-        for e, i in enumerate(diam):
-            try:
-                fwhm[e] = xfer(i, mean_data.Aer_Q_VLPM, mean_data.Sh_Q_VLPM)
-                dlogd[e] = np.log10(i+fwhm[e]/2)-np.log10(i-fwhm[e]/2)
-
-            except (ValueError, ZeroDivisionError):
-                fwhm[e] = np.nan
-                print('Handling divide by zero error')
-            except:
-                fwhm[e] = np.nan
-                print('Handling unknown error: ' + str(sys.exc_info()[0]))
-
-        # Correct for multiple charging.  We will use the array dn by reference and stuff this
-        # into another array
-        self.__chargecorr__(diam, dn, self.air)
+        diam = np.asarray(diam, dtype=float)
+        dn = np.array(dn, dtype=float)
+        self.air.t, self.air.p, qa, qs = conditions
 
-        output_sd = np.copy(dn)
+        # Full-width, half-max of the transfer function in diameter space for all diameters at once (memoized for
+        # scans with the same diameters and conditions, see transfer_function)
+        fwhm = transfer_function.get_fwhm(diam, self.air, qa, qs, dma=self.dma, diffusion=self.diffusion)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dlogd = np.log10(diam+fwhm/2)-np.log10(diam-fwhm/2)
+
+        # Correct for multiple charging (all scans at once).  We will use the array dn by reference
+        self.__chargecorr__(diam, dn, self.air)
 
         # Divide the concentration by dlogdp from the transfer function
-        output_sd /= dlogd
+        output_sd = dn / dlogd
 
         # Use the 1D interpolation scheme to project the current concentrations
         # onto the array defined by diam_interp
         f = interp1d(diam, output_sd, bounds_error=False, kind='linear')
 
         # Return the interpolated dNdlogDp distribution
-        return f(self.diam_interp)
+        output_sd = f(self.diam_interp)
+        output_sd[np.where(output_sd < 0)] = 0
+        return output_sd
 
 
 
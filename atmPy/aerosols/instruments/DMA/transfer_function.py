@@ -0,0 +1,215 @@
+"""
+Vectorized DMA transfer functions and their widths.
+
+All functions work on whole arrays of mobilities or diameters at once.  The mobility is expressed relative to the
+centroid mobility of the DMA setting, z_tilde = z/zc, and the flow ratio beta = qa/qs (balanced flows).
+
+* omega_triangular: non-diffusing transfer function (Knutson and Whitby, 1975)
+* omega_diffusing:  diffusion broadened transfer function (Stolzenburg, 1988)
+* fwhm_mobility:    full width at half maximum in z_tilde
+* fwhm_diameter:    full width at half maximum in diameter space, as used for the dlogDp of SMPS channels
+* get_fwhm:         memoized fwhm_diameter, so scans with the same diameters, flows and gas conditions share the
+                    result
+
+Usage
+-----
+>>> from atmPy.aerosols.instruments.DMA import transfer_function
+>>> fwhm = transfer_function.get_fwhm(diam, gas, qa=0.3, qs=3.)
+>>> fwhm = transfer_function.get_fwhm(diam, gas, qa=0.3, qs=3., dma=dma.NoaaWide(), diffusion=True)
+"""
+from collections import OrderedDict as _OrderedDict
+from math import log, pi
+
+import numpy as np
+from scipy.special import erf
+
+from atmPy.aerosols.physics import aerosol
+from atmPy.general import constants
+
+_fwhm_cache = _OrderedDict()
+_fwhm_cache_size = 100
+
+
+def omega_triangular(z_tilde, beta):
+    """
+    Transfer function of a DMA without diffusion for balanced flows.
+
+    Parameters
+    ----------
+    z_tilde:    float or array
+                Mobility relative to the centroid mobility
+    beta:       float or array
+                Ratio of aerosol to sheath flow
+
+    Returns
+    -------
+    Transfer probability (array), 1 at z_tilde = 1, 0 outside 1 +- beta.
+    """
+    z_tilde = np.asarray(z_tilde, dtype=float)
+    return (np.abs(z_tilde - (1 + beta)) + np.abs(z_tilde - (1 - beta)) - 2 * np.abs(z_tilde - 1)) / (2 * beta)
+
+
+def _epsilon(x):
+    return x * erf(x) + np.exp(-x ** 2) / np.sqrt(pi)
+
+
+def omega_diffusing(z_tilde, beta, sigma):
+    """
+    Diffusion broadened transfer function for balanced flows (Stolzenburg, 1988).
+
+    Parameters
+    ----------
+    z_tilde:    float or array
+                Mobility relative to the centroid mobility
+    beta:       float or array
+                Ratio of aerosol to sheath flow
+    sigma:      float or array
+                Standard deviation of the diffusional broadening in z_tilde, see sigma_diffusion
+
+    Returns
+    -------
+    Transfer probability (array)
+    """
+    z_tilde = np.asarray(z_tilde, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    s2 = np.sqrt(2) * sigma
+    return sigma / (np.sqrt(2) * beta) * (_epsilon((z_tilde - (1 + beta)) / s2)
+                                          + _epsilon((z_tilde - (1 - beta)) / s2)
+                                          - 2 * _epsilon((z_tilde - 1) / s2))
+
+
+def _geometry_factor(dma, beta):
+    """Geometry factor G of a cylindrical DMA (Stolzenburg, 1988)."""
+    gamma = (dma._ri / dma._ro) ** 2
+    kappa = dma._l * dma._ro / (dma._ro ** 2 - dma._ri ** 2)
+    lng = log(gamma)
+    i_gamma = ((0.25 * (1 - gamma ** 2) * (1 - gamma) ** 2
+                + 5. / 18 * (1 - gamma ** 3) * (1 - gamma) * lng
+                + 1. / 12 * (1 - gamma ** 4) * lng ** 2)
+               / ((1 - gamma) * (-0.5 * (1 + gamma) * lng - (1 - gamma)) ** 2))
+    return 4 * (1 + beta) ** 2 / (1 - gamma) * (i_gamma + (2 * (1 + beta) * kappa) ** -2)
+
+
+def sigma_diffusion(dma, zc, gas, qa, qs, n=1):
+    """
+    Standard deviation (in z_tilde) of the diffusional broadening of the transfer function.
+
+    Parameters
+    ----------
+    dma:        DMA object
+    zc:         float or array
+                Centroid mobility in m2/Vs
+    gas:        gas object
+    qa, qs:     float
+                Aerosol and sheath flow in lpm
+    n:          int, optional
+                Number of charges
+
+    Returns
+    -------
+    sigma (array)
+    """
+    beta = float(qa) / float(qs)
+    qs = float(qs) / 60 * 0.001
+
+    # Stokes-Einstein diffusion coefficient
+    d = constants.k * (gas.t + 273.15) * np.asarray(zc, dtype=float) / (n * constants.e)
+    d_tilde = 2 * pi * dma._l * d / qs
+    return np.sqrt(_geometry_factor(dma, beta) * d_tilde)
+
+
+def fwhm_mobility(beta, sigma=None, no_pts=2001):
+    """
+    Lower and upper half maximum of the transfer function in z_tilde.
+
+    Parameters
+    ----------
+    beta:       float
+                Ratio of aerosol to sheath flow
+    sigma:      float or array, optional
+                Diffusional broadening (see sigma_diffusion).  If None the triangular transfer function is used.
+    no_pts:     int, optional
+                Number of points the diffusing transfer function is evaluated at.
+
+    Returns
+    -------
+    z_low, z_high (arrays)
+    """
+    if sigma is None:
+        return np.array(1 - beta / 2.), np.array(1 + beta / 2.)
+
+    sigma = np.atleast_1d(np.asarray(sigma, dtype=float))
+    half_width = beta + 6 * sigma
+    z_tilde = 1 + half_width[:, None] * np.linspace(-1, 1, no_pts)[None, :]
+    omega = omega_diffusing(z_tilde, beta, sigma[:, None])
+    half = omega.max(axis=1) / 2.
+
+    # the transfer function is symmetric and increases monotonically up to its center
+    center = no_pts // 2
+    rows = np.arange(sigma.shape[0])
+    above = omega[:, :center + 1] >= half[:, None]
+    first = above.argmax(axis=1)
+    below = np.maximum(first - 1, 0)
+    frac = (half - omega[rows, below]) / (omega[rows, first] - omega[rows, below])
+    z_low = z_tilde[rows, below] + np.nan_to_num(frac) * (z_tilde[rows, first] - z_tilde[rows, below])
+    return z_low, 2 - z_low
+
+
+def fwhm_diameter(diam, gas, qa, qs, dma=None, diffusion=False):
+    """
+    Full width at half maximum of the transfer function in diameter space for an array of diameters (the
+    vectorized version of the xfer function in SMPS.__fwhm__).
+
+    Parameters
+    ----------
+    diam:       array of float
+                Diameters in nm
+    gas:        gas object
+    qa, qs:     float
+                Aerosol and sheath flow in lpm
+    dma:        DMA object, optional
+                Needed if diffusion is True
+    diffusion:  bool, optional
+                If True the diffusion broadened transfer function is used.
+
+    Returns
+    -------
+    Width of the transfer function in nm (array).  NaN where it can not be calculated.
+    """
+    diam = np.asarray(diam, dtype=float)
+    beta = float(qa) / float(qs)
+
+    # Retrieve the center mobility
+    zc = np.asarray(aerosol.z(diam, gas, 1))
+
+    if diffusion:
+        if dma is None:
+            raise ValueError('The diffusion broadened transfer function requires the dma.')
+        sigma = sigma_diffusion(dma, zc.ravel(), gas, qa, qs)
+        z_low, z_high = fwhm_mobility(beta, sigma)
+        z_low = z_low.reshape(diam.shape)
+        z_high = z_high.reshape(diam.shape)
+    else:
+        z_low, z_high = fwhm_mobility(beta)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return aerosol.z2d_vectorized(z_low * zc, gas, 1) - aerosol.z2d_vectorized(z_high * zc, gas, 1)
+
+
+def get_fwhm(diam, gas, qa, qs, dma=None, diffusion=False):
+    """
+    Memoized fwhm_diameter.  Results are kept for each combination of diameters, flows, gas conditions, and DMA
+    geometry.  The values are compared exactly, so measured conditions have to be rounded to share a calculation;
+    SMPS does this for its scans (see smps._round_conditions).
+    """
+    diam = np.asarray(diam, dtype=float)
+    dma_key = None if dma is None else (dma._l, dma._ro, dma._ri)
+    key = (diam.tobytes(), float(qa), float(qs), float(gas.t), float(gas.mu()), float(gas.l()), dma_key,
+           bool(diffusion))
+    if key in _fwhm_cache:
+        _fwhm_cache.move_to_end(key)
+    else:
+        _fwhm_cache[key] = fwhm_diameter(diam, gas, qa, qs, dma=dma, diffusion=diffusion)
+        while len(_fwhm_cache) > _fwhm_cache_size:
+            _fwhm_cache.popitem(last=False)
+    return _fwhm_cache[key]
@@ -1,12 +1,15 @@
 #from POPS_lib.fileIO import read_Calibration_fromFile,read_Calibration_fromString,save_Calibration
 #import fileIO
 from scipy.interpolate import UnivariateSpline
+import hashlib
+import os
 import numpy as np
 import pylab as plt
 from io import StringIO as io
 import pandas as pd
 import warnings
 from atmPy.aerosols.instruments.POPS import mie
+from atmPy.tools import array_tools
 
 
 #read_fromFile = fileIO.read_Calibration_fromFile
@@ -19,6 +22,82 @@ def _msg(txt, save, out_file, verbose):
         out_file.write(str(txt) + '\n')
 
 
+_response_cache = {}
+
+
+def _response_fname(cache, key):
+    return os.path.join(os.path.expanduser(cache), 'pops_response_%s.npz' % hashlib.sha1(repr(key).encode()).hexdigest())
+
+
+def _save_response(fname, response):
+    # write to a temporary file first, so an interrupted save does not leave a broken file behind
+    tmp = fname + '.tmp.npz'
+    np.savez(tmp, d=response.index.values, amp=response.values)
+    os.replace(tmp, fname)
+
+
+def simulate_responses(iors,
+                       dr=[110, 3400],
+                       no_pts=600,
+                       wavelength=0.405,
+                       POPSdesign='POPS 2',
+                       mirrorJetDist=10.,
+                       geometry='perpendicular',
+                       noOfAngles=100,
+                       cache=None):
+    """Simulated POPS responds (intensity as a function of diameter) for several refractive indices.
+
+    Curves are memoized by (instrument geometry, wavelength, refractive index, diameter grid), in memory and, if cache
+    is given, on disk. Only refractive indices that have not been calculated before cost a Mie calculation, and all of
+    those are calculated in a single batched pass (mie.makeMie_diameter_batch). When sweeping the refractive index
+    the reference curve of the single point calibration is therefore only calculated once.
+
+    Args:
+        iors: complex or list of complex
+            Refractive indices.
+        dr, no_pts: see generate_calibration
+        wavelength, POPSdesign, mirrorJetDist, geometry, noOfAngles: see mie.makeMie_diameter_batch
+        cache: str [None]
+            Folder in which the curves are saved and looked up.
+    Returns:
+        dict: {ior: Series instance (intensity, index is diameter in um)}
+    """
+    iors = list(np.atleast_1d(iors))
+    rr = np.array(dr) / 2 / 1000
+    d = np.logspace(np.log10(rr[0]), np.log10(rr[1]), no_pts) * 2
+    grid = (float(rr[0]), float(rr[1]), int(no_pts))
+    setup = (POPSdesign, float(mirrorJetDist), geometry, int(noOfAngles), float(wavelength))
+    keys = [setup + (complex(ior),) + grid for ior in iors]
+
+    missing = []
+    for key in keys:
+        if key in missing:
+            continue
+        fname = _response_fname(cache, key) if cache else None
+        if key in _response_cache:
+            if fname and not os.path.isfile(fname):
+                _save_response(fname, _response_cache[key])
+        elif fname and os.path.isfile(fname):
+            with np.load(fname) as data:
+                _response_cache[key] = pd.Series(data['amp'], data['d'])
+        else:
+            missing.append(key)
+
+    if len(missing) > 0:
+        amps = mie.makeMie_diameter_batch(d, wavelength, [key[5] for key in missing],
+                                          noOfAngles=noOfAngles,
+                                          POPSdesign=POPSdesign,
+                                          geometry=geometry,
+                                          mirrorJetDist=mirrorJetDist,
+                                          as_array=True)[0]
+        for key, amp in zip(missing, amps):
+            _response_cache[key] = pd.Series(amp, d)
+            if cache:
+                _save_response(_response_fname(cache, key), _response_cache[key])
+
+    return {ior: _response_cache[key] for ior, key in zip(iors, keys)}
+
+
 def generate_calibration(single_pnt_cali_d=508,
                          single_pnt_cali_ior=1.6,
                          single_pnt_cali_int=1000,
@@ -28,7 +107,12 @@ def generate_calibration(single_pnt_cali_d=508,
                          no_cal_pts=30,
                          plot=False,
                          raise_error=True,
-                         test=False
+                         test=False,
+                         wavelength=0.405,
+                         POPSdesign='POPS 2',
+                         mirrorJetDist=10.,
+                         geometry='perpendicular',
+                         cache=None
                          ):
     """
     This function generates a calibration function for the POPS instrument based on its theoretical responds.
@@ -57,6 +141,11 @@ def generate_calibration(single_pnt_cali_d=508,
             If an error is raised in case the resulting calibration function is not bijective.
         test: bool [False]
             If True the calibration diameters are returned, so one can check if they are in the desired range.
+        wavelength, POPSdesign, mirrorJetDist, geometry:
+            Instrument parameters, see mie.makeMie_diameter_batch.
+        cache: str [None]
+            Folder in which the simulated responds curves are memoized, see simulate_responses. Curves are also
+            memoized in memory, so e.g. in a sweep over ior the single point calibration curve is only calculated once.
     Returns:
         Calibration instance
         if plot: (Calibration instance, Axes instance)
@@ -72,13 +161,10 @@ def generate_calibration(single_pnt_cali_d=508,
     if test:
         return cal_d
 
-    d, amp = mie.makeMie_diameter(noOfdiameters=no_pts, radiusRangeInMikroMeter=rr, IOR=ior)
-    ds = pd.Series(amp, d)
-    if ior == single_pnt_cali_ior:
-        ds_spc = ds
-    else:
-        d, amp = mie.makeMie_diameter(noOfdiameters=no_pts, radiusRangeInMikroMeter=rr, IOR=single_pnt_cali_ior)
-        ds_spc = pd.Series(amp, d)
+    responses = simulate_responses([ior, single_pnt_cali_ior], dr=dr, no_pts=no_pts, wavelength=wavelength,
+                                   POPSdesign=POPSdesign, mirrorJetDist=mirrorJetDist, geometry=geometry, cache=cache)
+    ds = responses[ior]
+    ds_spc = responses[single_pnt_cali_ior]
 
     ampm = ds.rolling(int(no_pts / no_cal_pts), center=True).mean()
 
@@ -308,9 +394,39 @@ def save_Calibration(calibrationInstance, fname):
     return
 
 class Calibration:
-    def __init__(self,dataTabel):
+    def __init__(self,dataTabel, lookup_table = True):
+        """
+        Arguments
+        ---------
+        dataTabel: pandas DataFrame with columns amp and d
+        lookup_table: bool
+            If True (default) calibrationFunction is a monotone lookup table (array_tools.LookupTable) of the spline
+            (calibrationFunctionSpline), which is much faster on large amplitude arrays. The maximum deviation from the
+            spline is in lookup_table.max_error.
+        """
         self.data = dataTabel
-        self.calibrationFunction = self.get_calibrationFunctionSpline()
+        self.calibrationFunctionSpline = self.get_calibrationFunctionSpline()
+        if lookup_table:
+            self.lookup_table = self.get_lookup_table()
+            self.calibrationFunction = self.lookup_table
+        else:
+            self.lookup_table = None
+            self.calibrationFunction = self.calibrationFunctionSpline
+
+    def get_lookup_table(self, no_pts = 2**14):
+        """Lookup table of the calibration spline over the amplitude range of the calibration data (equally spaced
+        in log10(amp)). Outside this range the table is continued as a power law, since the spline itself is not
+        necessarily monotonic there.
+
+        Returns
+        -------
+        array_tools.LookupTable instance
+        """
+        lut = array_tools.LookupTable(self.calibrationFunctionSpline, self.data.amp.min(), self.data.amp.max(),
+                                      no_pts = no_pts, log = True)
+        if lut.max_error > 1e-4:
+            warnings.warn('The calibration lookup table deviates by up to %.2g %% from the spline.' % (lut.max_error * 100))
+        return lut
         
     def get_interface_bins(self, n_bins, imin=1.4, imax=4.8, save=False, verbose = False):
         out = get_interface_bins(self, n_bins, imin=imin, imax=imax, save=save, verbose = verbose)
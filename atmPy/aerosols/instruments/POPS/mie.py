@@ -16,16 +16,86 @@ This temporary script file is located here:
 
 import os
 import sys
-import types
 
 import matplotlib.cm as mplcm
 import matplotlib.colors as colors
 import numpy as np
+import pandas as pd
 import pylab as plt
 from scipy.interpolate import interp1d
 
 from atmPy.aerosols.instruments.POPS import tools
 from atmPy.radiation.mie_scattering import bhmie
+from atmPy.radiation.mie_scattering import mie_cache
+
+
+_mirror_weights_cache = {}
+
+
+def _mirror_grid(dm, h, angle, nang):
+    """Off angles of the spherical mirror grid, see Mie.get_detectableIntensity for details.
+
+    Returns
+    -------
+    angleIndexArray: indices of the scattering angles (in Mie.xAxis) seen by the mirror
+    offAngleMatrix: nn x nn array, NaN outside the mirror
+    """
+    xAxis = np.linspace(0, 2 * np.pi, 2 * ((nang * 2) - 1))
+    rSphere = tools.sphereRadius_fromGeometry(h, dm)         # 1.
+    alphMax = tools.alphamax_fromGeometry(h, dm)
+    sSphere = tools.arc_length(rSphere, h)
+    angleRangeArray, angleIndexArray = tools.find_angleRange(angle, alphMax, xAxis)
+    stepWidth = sSphere/len(angleRangeArray)
+
+    nn = len(angleIndexArray)
+    angleMatrix = np.ones((nn,nn), dtype = int) * angleRangeArray
+
+    ArcLengthArray = abs(np.array(list(range(int(-nn / 2), 0, 1)) + list(range(0, int(nn / 2), 1))))
+    ArcLengthMatrix = np.ones((nn,nn))
+    ArcLengthMatrix = (ArcLengthMatrix * ArcLengthArray).transpose() * stepWidth
+
+    rs = tools.sphereSegment_radius(rSphere, angleMatrix - np.pi / 2.)
+    ss = tools.arc_length(rs, h)
+
+    ArcLengthMatrix[ArcLengthMatrix > ss/2.] = np.nan
+    offAngleMatrix = .5 * tools.segment_angle(rs, ArcLengthMatrix)
+    return angleIndexArray, offAngleMatrix
+
+
+def get_mirror_weights(mirror_diameter, mirror_jet_distance, nang, angle = np.pi / 2.):
+    """The light collected by the mirror is the sum over the mirror grid (nn x nn) of |S1|^2 and |S2|^2 weighted
+    by the squared sine and cosine of the off angle. Since S1 and S2 only depend on the scattering angle (the
+    column of the grid) the grid can be summed up beforehand, which leaves one weight per scattering angle for S1
+    and S2. The weights only depend on the geometry and are therefore cached.
+
+    Arguments
+    ---------
+    mirror_diameter: float, mm
+    mirror_jet_distance: float, mm
+        Distance from the particle jet to the plain defined by the top of the mirror.
+    nang: int
+        Number of angles used in the Mie calculations.
+    angle: float, rad
+        Angle between jet and mirror normal.
+
+    Returns
+    -------
+    dict: 'angles' is the slice of Mie.s1/Mie.s2 seen by the mirror, 'perpendicular', 'parallel', and 'natural' are
+    tuples of the weights for |S1|^2 and |S2|^2. The detectable intensity is
+    (abs(s1[angles])**2 * w_s1).sum() + (abs(s2[angles])**2 * w_s2).sum()
+    """
+    key = (float(mirror_diameter), float(mirror_jet_distance), float(angle), int(nang))
+    if key not in _mirror_weights_cache:
+        angleIndexArray, offAngleMatrix = _mirror_grid(*key)
+        valid = ~np.isnan(offAngleMatrix)
+        cos2 = np.where(valid, np.cos(offAngleMatrix) ** 2, 0).sum(axis=0)
+        sin2 = np.where(valid, np.sin(offAngleMatrix) ** 2, 0).sum(axis=0)
+        natural = .5 * valid.sum(axis=0)
+        _mirror_weights_cache[key] = {'angles': slice(angleIndexArray[0], angleIndexArray[-1] + 1),
+                                      'perpendicular': (cos2, sin2),
+                                      'parallel': (sin2, cos2),
+                                      'natural': (natural, natural)}
+    return _mirror_weights_cache[key]
 
 
 ###########################
@@ -73,15 +143,11 @@ def makeMie_diameter(radiusRangeInMikroMeter = [0.05,1.5],
     elif scale == 'log_20':
         dRange = np.logspace(np.log10(radiusRangeInMikroMeter[0]),np.log10(radiusRangeInMikroMeter[1]),noOfdiameters,base = 100) #radius range 
         
-    event = Mie(silent = True, design = POPSdesign, indexOfRef = IOR, diameter = 'dynamic') # Ref. for indexOfRef.  Patterson 2004
-    event.set_nang(noOfAngles)
-    event.POPSdimensions['mirror(top)-jet distance (mm)'] = float(mirrorJetDist)
-    
     singleLine = False
     
     if isinstance(WavelengthInUm,float):
         exWavelengthInUm=np.array([WavelengthInUm])
-    elif isinstance(WavelengthInUm,types.ListType):
+    elif isinstance(WavelengthInUm,list):
         exWavelengthInUm=np.array(WavelengthInUm)
     else:
         exWavelengthInUm = WavelengthInUm
@@ -113,16 +179,17 @@ def makeMie_diameter(radiusRangeInMikroMeter = [0.05,1.5],
     if len(exWavelengthInUm) == 1:
         singleLine = True
         
+    diameter = np.array(2 * np.array(dRange))
+    intensities = makeMie_diameter_batch(diameter, exWavelengthInUm, IOR,
+                                         noOfAngles = noOfAngles,
+                                         POPSdesign = POPSdesign,
+                                         geometry = geometry,
+                                         mirrorJetDist = mirrorJetDist,
+                                         as_array = True)[:, 0, :]
+
     output = np.zeros((exWavelengthInUm.shape[0]+1,dRange.shape[0]))
     for e,i in enumerate(exWavelengthInUm):
-        event.set_wavelength(i)
-        perpInt = []
-        for i in dRange:
-            event.set_r(i)
-            intensity =  event.get_detectableIntensity(geometry)
-            perpInt.append(intensity)
-        diameter = np.array(2 * np.array(dRange))
-        scatteringIntensity = np.array(perpInt)
+        scatteringIntensity = intensities[e]
 #         if broadened:     
         output[0]+= normalizer[e] * scatteringIntensity/normalizer.sum()
         if len(exWavelengthInUm) == 1:
@@ -137,6 +204,77 @@ def makeMie_diameter(radiusRangeInMikroMeter = [0.05,1.5],
     else:
         return diameter, output
     
+def makeMie_diameter_batch(diameters,
+                           wavelengths = .405,
+                           IOR = 1.45,
+                           noOfAngles = 100,
+                           POPSdesign = 'POPS 2',
+                           geometry = 'perpendicular',
+                           mirrorJetDist = 10.,
+                           as_array = False,
+                           chunksize = 10000):
+    """Intensity of the light scattered onto the detector for all combinations of diameters, wavelengths and
+    refractive indices. Unlike makeMie_diameter this does not create a Mie instance for each particle, the Mie
+    calculations are done for many particles at once and the detector is accounted for by the cached mirror weights
+    (see get_mirror_weights).
+
+    Arguments
+    ---------
+    diameters: float or array-like, um
+    wavelengths: float or array-like, um
+    IOR: complex or array-like
+        Refractive indices.
+    noOfAngles: int
+    POPSdesign: str
+        See Mie.set_dimensions.
+    geometry: 'perpendicular', 'parallel', or 'natural'
+        Polarization of the laser.
+    mirrorJetDist: float, mm
+    as_array: bool
+        If True a wavelength x refractive index x diameter array is returned.
+    chunksize: int
+        Number of particles calculated at once, limits the memory usage.
+
+    Returns
+    -------
+    pandas DataFrame with a MultiIndex (wavelength, refractive_index) and the diameters as columns, or a numpy array
+    (see as_array).
+    """
+    diameters = np.atleast_1d(np.asarray(diameters, dtype=float))
+    wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=float))
+    IOR = np.atleast_1d(np.asarray(IOR, dtype=np.complex128))
+    whatList = ('natural', 'parallel', 'perpendicular')
+    if geometry not in whatList:
+        raise ValueError('Geometry has to be one of the following: "%s", "%s", or "%s"? %s is not an option' % (
+            whatList[0], whatList[1], whatList[2], geometry))
+
+    dimensions = Mie(silent = True, design = POPSdesign, indexOfRef = 1., diameter = 'dynamic').POPSdimensions
+    weights = get_mirror_weights(dimensions['mirror diameter (mm)'], mirrorJetDist, noOfAngles,
+                                 angle = dimensions['angle: jet-mirrorNormal (rad)'])
+    w_s1, w_s2 = weights[geometry]
+
+    # Mie.s1 is S1 followed by its mirror image, map the angles seen by the mirror back to S1
+    noOfPts = 2 * noOfAngles - 1
+    angles = np.arange(2 * noOfPts)[weights['angles']]
+    angles = np.where(angles < noOfPts, angles, 2 * noOfPts - 1 - angles)
+
+    wl, n, d = np.meshgrid(wavelengths, IOR, diameters, indexing = 'ij')
+    x = (np.pi * d / wl).ravel()
+    n = n.ravel()
+    intensity = np.zeros(x.shape)
+    for start in range(0, x.shape[0], chunksize):
+        stop = start + chunksize
+        values = mie_cache.bhmie_cached(x[start:stop], n[start:stop], noOfAngles)
+        intensity[start:stop] = (np.abs(values['S1'][:, angles]) ** 2).dot(w_s1) + \
+                                (np.abs(values['S2'][:, angles]) ** 2).dot(w_s2)
+    intensity = intensity.reshape(wl.shape)
+
+    if as_array:
+        return intensity
+    index = pd.MultiIndex.from_product([wavelengths, IOR], names = ['wavelength', 'refractive_index'])
+    return pd.DataFrame(intensity.reshape(-1, diameters.shape[0]), index = index, columns = diameters)
+
+
 ###########################################################    
 class Mie():
     """ Creates a Mie object
@@ -348,8 +486,13 @@ class Mie():
     def do_bhmie_hagen(self):
         if not self.silent:
             self.print_current_parameter()
-        bhh = bhmie.bhmie_hagen(self.x, self.n, self.nang)
-        s1,s2,self.qext,self.qsca,self.qback,self.gsca = bhh.return_Values()
+        values = mie_cache.bhmie_cached(self.x, self.n, self.nang)
+        s1 = values['S1'][0]
+        s2 = values['S2'][0]
+        self.qext = values['extinction_efficiency'][0]
+        self.qsca = values['scattering_efficiency'][0]
+        self.qback = values['backscatter_efficiency'][0]
+        self.gsca = values['asymmetry_parameter'][0]
 #         data = (abs(self.s1))**2#/(np.pi * self.x**2 * self.qsca)
         s1_Reverse = s1[::-1]
         self.s1 = np.concatenate((s1,s1_Reverse)) 
@@ -362,62 +505,18 @@ class Mie():
             print(i, ' , ', self.YNatural[i])
             
     def get_mirror_grid(self):
-        np.set_printoptions(threshold=np.nan)
-        np.set_printoptions(precision=2)
-        
-        
-        dm = self.POPSdimensions['mirror diameter (mm)']
-        h = self.POPSdimensions['mirror(top)-jet distance (mm)']
-#         print 'h', h
-#         print 'dm', dm
-        rSphere = tools.sphereRadius_fromGeometry(h, dm)         # 1.
-        alphMax = tools.alphamax_fromGeometry(h, dm)
-        sSphere = tools.arc_length(rSphere, h)
-#         sSphereA = tools.arc_length_alpha(rSphere, alphMax * 2.)          #for test purposes
-#         angleRangeArray, dataRangeArray = tools.find_angleRange(self.POPSdimensions['angle: jet-mirrorNormal (rad)'],alphMax,self.xAxis, data)
-        angleRangeArray, angleIndexArray = tools.find_angleRange(self.POPSdimensions['angle: jet-mirrorNormal (rad)'], alphMax, self.xAxis)
-        stepWidth = sSphere/len(angleRangeArray)
-        
-        self.angleIndexArray = angleIndexArray
-        
-        nn = len(angleIndexArray)
-        indexMatrix = np.ones((nn,nn), dtype = int) * angleIndexArray
-        angleMatrix = np.ones((nn,nn), dtype = int) * angleRangeArray
-        
-#         
-#         offAngleMatrix = np.empty((nn,nn))
-#         offAngleMatrix[:] = 0 #np.NAN
-#         
-        yArcLenghtMatrix = np.empty((nn,nn))
-        yArcLenghtMatrix[:] = 0
-#         print 'nn', nn
-#         print 'stepWidth', stepWidth
-        ArcLengthArray = abs(np.array(list(range(int(-nn / 2), 0, 1)) + list(range(0, int(nn / 2), 1))))
-        ArcLengthMatrix = np.ones((nn,nn))
-        ArcLengthMatrix = (ArcLengthMatrix * ArcLengthArray).transpose() * stepWidth
-        
-#         print "ArcLengthMatrix"
-#         raw_input(ArcLengthMatrix.astype(int))
-        
-        
-        
-        rs = tools.sphereSegment_radius(rSphere, angleMatrix - np.pi / 2.)
-#         print h
-        ss = tools.arc_length(rs, h)
-        
-#         print "ss"
-#         raw_input(ss.astype(int))
-        
-        ArcLengthMatrix[ArcLengthMatrix > ss/2.] = np.NAN
-#         print "ArcLengthMatrix"
-#         raw_input(ArcLengthMatrix.astype(int))
-        
-        self.offAngleMatrix = .5 * tools.segment_angle(rs, ArcLengthMatrix)
-        
+        self.angleIndexArray, self.offAngleMatrix = _mirror_grid(self.POPSdimensions['mirror diameter (mm)'],
+                                                                 self.POPSdimensions['mirror(top)-jet distance (mm)'],
+                                                                 self.POPSdimensions['angle: jet-mirrorNormal (rad)'],
+                                                                 self.nang)
 
+    def get_mirror_weights(self):
+        """Weights which reduce the mirror grid to the scattering angles, see get_mirror_weights (module level)."""
+        return get_mirror_weights(self.POPSdimensions['mirror diameter (mm)'],
+                                  self.POPSdimensions['mirror(top)-jet distance (mm)'],
+                                  self.nang,
+                                  angle=self.POPSdimensions['angle: jet-mirrorNormal (rad)'])
 
-                	
-            
     def get_detectableIntensity(self, polarization = "perpendicular"):
         """ In this function I want to calculate a solid angle which is defined by the mirror and then all the light which is scattered into that angle.
             Parameters:
@@ -440,47 +539,17 @@ class Mie():
                 stepWidth = sSphere/len(angleRangeArray)
             """
         
-        #if isinstance(self, collections.Iterable) and not isinstance(a, types.StringTypes):
-        #    print 'bla'
         self.update_hagen()
-        self.update_geometry()
-#         mirror_grid = self.get_mirror_grid()
-#         raw_input('watewatte')
-        
+
         whatList = ('natural', 'parallel', 'perpendicular')
         if polarization not in whatList:
             raise ValueError('Geometry has to be one of the following: "%s", "%s", or "%s"? %s is not an option' % (
             whatList[0], whatList[1], whatList[2], polarization))
-        fIdx = self.angleIndexArray[0]
-        lIdx = self.angleIndexArray[-1]
-        s1Selection = self.s1[fIdx:lIdx+1]
-        s2Selection = self.s2[fIdx:lIdx+1]
-        
-        nn = len(self.angleIndexArray)
-        
-        s1Matrix = (abs(np.ones((nn,nn)) * s1Selection))**2
-        s2Matrix = (abs(np.ones((nn,nn)) * s2Selection))**2
-        naturalMatrix = (.5 * s1Matrix) + (.5 * s2Matrix)
-#         print 's1Matrix'
-#         raw_input(s1Matrix)
-        
-        if len(s1Selection) != nn:
-            raise ValueError('not possible %s %s'%(len(s1Selection),len(self.angleIndexArray)))
-
-        
-        if polarization == "parallel":
-            IntMatrix = ((np.cos(self.offAngleMatrix))**2 * s2Matrix) + ((np.sin(self.offAngleMatrix))**2 * s1Matrix)  
-        
-        elif polarization == "perpendicular":
-            IntMatrix = ((np.sin(self.offAngleMatrix))**2 * s2Matrix) + ((np.cos(self.offAngleMatrix))**2 * s1Matrix)  
-        
-        elif polarization == "natural":
-            naturalMatrix[np.isnan(self.offAngleMatrix)] = 0
-            IntMatrix = naturalMatrix 
-        
-        IntMatrix[np.isnan(IntMatrix)] = 0
-        integratedIntensity = IntMatrix.sum() 
 
+        weights = self.get_mirror_weights()
+        angles = weights['angles']
+        w_s1, w_s2 = weights[polarization]
+        integratedIntensity = (np.abs(self.s1[angles]) ** 2 * w_s1).sum() + (np.abs(self.s2[angles]) ** 2 * w_s2).sum()
         return integratedIntensity# * stepWidth**2
 
 def plot_polar(dataList, log = False):
@@ -1,7 +1,9 @@
+from concurrent import futures as _futures
 import datetime
 import os
 import warnings
-from struct import unpack, calcsize
+import mmap
+from struct import unpack, unpack_from, calcsize
 
 import numpy as np
 import pandas as pd
@@ -19,6 +21,13 @@ defaultBins = np.logspace(np.log10(140), np.log10(3000), 30)
 
 #######
 #### Peak file
+# defaults of _cleanPeaksArray for each file version. Version '01' stores seconds since midnight and log10 amplitudes,
+# the current version LabVIEW time stamps (seconds since 1904) and the raw 16 bit amplitudes.
+_clean_defaults = {'01': dict(time_max=1.e6, amplitude_range=(0, 2**16)),
+                   'current': dict(time_max=(datetime.datetime(2100, 1, 1) - datetime.datetime(1904, 1, 1)).total_seconds(),
+                                   amplitude_range=(0, 2**16))}
+
+
 def _read_PeakFile_Binary(fname, version = 'current', time_shift=0, skip_bites = 20):
     """returns a peak instance
     test_data_folder: ..."""
@@ -39,50 +48,96 @@ def _read_PeakFile_Binary(fname, version = 'current', time_shift=0, skip_bites =
     return peakInstance
 
 
-def read_binary(fname, time_shift = False ,version = 'current', ignore_error = False, skip_bites= 20):
+def _read_PeakFile_Binary_data(fname, version = 'current', time_shift=0, skip_bites = 20):
+    """Same as _read_PeakFile_Binary but returns the DataFrame (or False). Module level, so it can be used in worker
+    processes."""
+    out = _read_PeakFile_Binary(fname, version=version, time_shift=time_shift, skip_bites=skip_bites)
+    if not out:
+        return False
+    return out.data
+
+
+def _merge_peak_frames(frames):
+    """Concatenates the peak DataFrames of several files. The output arrays are allocated once for the total number
+    of peaks and filled file by file (in the given order), instead of copying the growing DataFrame for each file."""
+    total = sum(frame.shape[0] for frame in frames)
+    first = frames[0]
+    index = np.empty(total, dtype=first.index.dtype)
+    columns = dict((col, np.empty(total, dtype=first[col].dtype)) for col in first.columns)
+    start = 0
+    for frame in frames:
+        end = start + frame.shape[0]
+        index[start:end] = frame.index.values
+        for col in columns:
+            columns[col][start:end] = frame[col].values
+        start = end
+    return pd.DataFrame(columns, index=pd.Index(index, name=first.index.name), columns=first.columns)
+
+
+def read_binary(fname, time_shift = False ,version = 'current', ignore_error = False, skip_bites= 20, workers = 1):
     """Generates a single Peak instance from a file or list of files
 
     Arguments
     ---------
     fname: string or list of strings
+        If fname is a folder all peak files in it are read in the order of their names (which is chronological).
     time_shift: iterable
         e.g. (1,'h)
         see http://docs.scipy.org/doc/numpy/reference/arrays.datetime.html#datetime-units
     version: str
         'current' - current :-)
         '01': before summer-fall 2015
+    workers: int
+        Number of processes used to decode the files of a list of files. If None, the number of CPUs is used. The
+        peaks are merged in the order of the files, no matter which process finishes first.
     """
 
     m = None
 
     if type(fname) == str:
         if os.path.isdir(fname):
-            fname = os.listdir(fname)
+            fname = [os.path.join(fname, file) for file in sorted(os.listdir(fname))]
 
     if type(fname).__name__ == 'list':
-        first = True
+        files = []
         for file in fname:
             if 'Peak.bin' not in file:
                 print('%s is not a peak file ... skipped' % file)
                 continue
-            print('%s ... processed' % file)
-            mt = _read_PeakFile_Binary(file, version = version, time_shift=time_shift, skip_bites=skip_bites)
-
-            # skipping if above returned False and ignore_error = True
-            if not mt:
-                if ignore_error:
-                    txt = 'An error accured while trying to read file. File skipped!'
-                    print(txt)
-                    continue
-                else:
-                    txt = 'An error accured while trying to read file. Set ignore_error to True if you want this file tobe ignored.'
-                    raise  ValueError(txt)
-
-            if first:
-                m = mt
-                first = False
-            else:
-                m.data = pd.concat((m.data, mt.data))
+            files.append(file)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(int(workers), len(files)))
+        if workers == 1:
+            results = (_read_PeakFile_Binary_data(file, version=version, time_shift=time_shift, skip_bites=skip_bites)
+                       for file in files)
+            executor = None
+        else:
+            executor = _futures.ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_read_PeakFile_Binary_data, files, [version] * len(files),
+                                   [time_shift] * len(files), [skip_bites] * len(files))
+
+        try:
+            frames = []
+            for file, mt in zip(files, results):
+                # skipping if above returned False and ignore_error = True
+                if isinstance(mt, bool):
+                    if ignore_error:
+                        txt = 'An error accured while trying to read file. File skipped!'
+                        print(txt)
+                        continue
+                    else:
+                        txt = 'An error accured while trying to read file. Set ignore_error to True if you want this file tobe ignored.'
+                        raise  ValueError(txt)
+                print('%s ... processed' % file)
+                frames.append(mt)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if len(frames) > 0:
+            m = peaks(_merge_peak_frames(frames))
 
     else:
         m = _read_PeakFile_Binary(fname, version = version, time_shift=time_shift, skip_bites=skip_bites)
@@ -217,96 +272,397 @@ def read_cal_process_peakFile(fname, cal, bins, average_over_time=False, normali
     return dist
 
 
-def _BinaryFile2Array(fname):
-    entry_format = '>fLfBB?'
-    field_names = np.array(['timeSincMitnight', 'ticks', 'log10_amplitude', 'width', 'saturated', 'use'])
-    entry_size = calcsize(entry_format)
+def iter_binary(fname, block_size = 1000000, time_shift = False, version = 'current', skip_bites = 20, clean = False):
+    """Generator that yields the peaks of a file or list of files (see read_binary) in blocks of about block_size
+    peaks (peaks instances). Only one block is held in memory at a time.
+
+    Arguments
+    ---------
+    fname: string or list of strings
+    block_size: int
+        Number of peaks per block. The current version of the peak files is split at cluster boundaries, so blocks
+        can be slightly larger.
+    time_shift, version, skip_bites:
+        see read_binary
+    clean: bool or dict
+        If True _cleanPeaksArray is applied to each block, with the thresholds of the file version (_clean_defaults).
+        A dict is passed to _cleanPeaksArray as keyword arguments, overwriting these defaults (e.g.
+        dict(remove_saturated=True)).
+    """
+    if type(fname) == str:
+        if os.path.isdir(fname):
+            fname = [os.path.join(fname, file) for file in sorted(os.listdir(fname)) if 'Peak.bin' in file]
+        else:
+            fname = [fname]
+
+    for file in fname:
+        directory, filename = os.path.split(file)
+        if version == 'current':
+            blocks = _iter_binary2array_labview_clusters(file, skip=skip_bites, block_size=block_size)
+            kwargs = dict(log=False, since_midnight=False)
+        elif version == '01':
+            entry_count = int(os.path.getsize(file) / _peak_dtype_01.itemsize)
+            blocks = (_BinaryFile2Array(file, start=start, count=block_size)
+                      for start in range(0, entry_count, block_size))
+            kwargs = {}
+        else:
+            txt = 'This version does not exist: %s' % version
+            raise ValueError(txt)
+
+        kwargs_clean = dict(_clean_defaults[version])
+        if isinstance(clean, dict):
+            kwargs_clean.update(clean)
+
+        for data in blocks:
+            if clean:
+                data, report = _cleanPeaksArray(data, **kwargs_clean)
+            if data.shape[0] == 0:
+                continue
+            yield peaks(_PeakFileArray2dataFrame(data, filename, time_shift, **kwargs))
+
 
-    rein = open(fname, mode='rb')
-    entry_count = int(os.fstat(rein.fileno()).st_size / entry_size)
+class SizeDistAccumulator(object):
+    """Builds a size distribution time series from peaks that arrive in blocks (e.g. from iter_binary or from a
+    running instrument), without holding all peaks in memory.
 
-    data = np.zeros((entry_count , field_names.shape[0]))
+    The histograms of each block are added with add. The last time interval of a block can continue in the next
+    block, so it is carried over and only completed when a block with a later interval arrives (or get_distribution
+    is called). Memory scales with the number of time intervals, not with the number of peaks.
 
-    for i in range(entry_count):
-        record = rein.read(entry_size)
-        entry = np.array(unpack(entry_format, record))
-        data[i] = entry
-    rein.close()
+    Arguments
+    ---------
+    bins: array
+        bin edges
+    resolution: str, optional
+        time resolution, e.g. '10S', see peaks._peak2Distribution
+    distributionType: str
+        'number' or 'calibration', see peaks._peak2Distribution
+    """
+    def __init__(self, bins = defaultBins, resolution = None, distributionType = 'number'):
+        self.bins = np.asarray(bins)
+        self.resolution = resolution
+        self.distributionType = distributionType
+        self.no_of_peaks = 0
+        self._times = []
+        self._counts = []
+        self._too_big = []
+        self._carry = None
+
+    def add(self, peak_block):
+        """Adds the peaks of peak_block (peaks instance, calibrated unless distributionType is 'calibration')."""
+        self.no_of_peaks += peak_block.data.shape[0]
+        if not np.any(peak_block.data.Masked.values == 0):
+            return
+        times, deltaT, counts, too_big = peak_block._histogram(self.bins, distributionType=self.distributionType,
+                                                               resolution=self.resolution)
+        if self._carry:
+            carry_time, carry_counts, carry_too_big = self._carry
+            if times[0] == carry_time:
+                counts[0] += carry_counts
+                too_big[0] += carry_too_big
+            else:
+                self._times.append(np.array([carry_time]))
+                self._counts.append(carry_counts[np.newaxis, :])
+                self._too_big.append(np.array([carry_too_big]))
+        self._carry = (times[-1], counts[-1], too_big[-1])
+        self._times.append(times[:-1])
+        self._counts.append(counts[:-1])
+        self._too_big.append(too_big[:-1])
+
+    def get_distribution(self, differentialStyle = 'dNdDp'):
+        """Returns the SizeDist_TS of all peaks added so far (the same as peaks.peak2sizedistribution or
+        peaks.peak2peakHeightDistribution of all peaks)."""
+        if not self._carry:
+            raise ValueError('No peaks were added.')
+        times = np.concatenate(self._times + [np.array([self._carry[0]])])
+        counts = np.concatenate(self._counts + [self._carry[1][np.newaxis, :]])
+        too_big = np.concatenate(self._too_big + [np.array([self._carry[2]])])
+
+        if self.resolution is None:
+            deltaT = (times[1:] - times[:-1]) / np.timedelta64(1, 's')
+            deltaT = np.append(deltaT[0], deltaT)
+        else:
+            # intervals without peaks between blocks
+            step = pd.to_timedelta(self.resolution).to_timedelta64().astype('timedelta64[ns]')
+            pos = ((times - times[0]) // step).astype(int)
+            all_times = times[0] + np.arange(pos[-1] + 1) * step
+            all_counts = np.zeros((all_times.shape[0], counts.shape[1]))
+            all_too_big = np.zeros(all_times.shape[0])
+            all_counts[pos] = counts
+            all_too_big[pos] = too_big
+            times, counts, too_big = all_times, all_counts, all_too_big
+            deltaT = np.zeros(times.shape[0]) + step / np.timedelta64(1, 's')
+        return _counts2distribution(times, deltaT, counts, too_big, self.bins, distributionType=self.distributionType,
+                                    differentialStyle=differentialStyle)
+
+
+def read_cal_process_peakFile_streaming(fname, cal, bins = defaultBins, resolution = None, block_size = 1000000,
+                                        time_shift = False, version = 'current', skip_bites = 20, clean = False):
+    """Same as read_cal_process_peakFile, but the peaks are read, calibrated (and cleaned) block by block and
+    accumulated into the size distribution (see iter_binary and SizeDistAccumulator), so memory is bounded by
+    block_size rather than by the length of the files.
+
+    Arguments
+    ---------
+    fname: str or list of str
+        file(s) or folder
+    cal: calibration instance
+    bins: array like
+        bin-edges for binning of peak data to sizedistributions
+    resolution: str, optional
+        time resolution, e.g. '10S'. If None each time stamp in the peak files is a line in the size distribution.
+    block_size: int
+        number of peaks processed at a time
+
+    Returns
+    -------
+    size_dist_TS instance (dNdlogDp)
+    """
+    accumulator = SizeDistAccumulator(bins=bins, resolution=resolution)
+    for block in iter_binary(fname, block_size=block_size, time_shift=time_shift, version=version,
+                             skip_bites=skip_bites, clean=clean):
+        block.apply_calibration(cal)
+        accumulator.add(block)
+    return accumulator.get_distribution()
+
+
+# record layouts of the binary peak files
+_peak_dtype_01 = np.dtype([('timeSincMitnight', '>f4'), ('ticks', '>u4'), ('log10_amplitude', '>f4'), ('width', 'u1'),
+                           ('saturated', 'u1'), ('use', '?')])
+# current version: the peaks are written in LabVIEW clusters, each starts with a header consisting of a LabVIEW time
+# stamp (seconds since 1904 and fractions of a second in units of 2**-64 s) and the number of peaks in the cluster
+_cluster_header_format = '>QQi'
+_peak_dtype_labview = np.dtype([('ticks', '>u4'), ('amplitude', '>u2'), ('width', 'u1'), ('saturated', 'u1'),
+                                ('use', 'u1')])
+
+
+def _BinaryFile2Array(fname, start = 0, count = None):
+    """Reads peak files of version '01'. The records are read at once as a structured array from the memory mapped
+    file. If count is given only the records start to start + count are read."""
+    entry_count = int(os.path.getsize(fname) / _peak_dtype_01.itemsize)
+    stop = entry_count if count is None else min(start + count, entry_count)
+    data = np.zeros((max(stop - start, 0), len(_peak_dtype_01.names)), order='F')
+    if data.shape[0] == 0:
+        return data
+
+    records = np.memmap(fname, dtype=_peak_dtype_01, mode='r', shape=(entry_count,))
+    for e, name in enumerate(_peak_dtype_01.names):
+        data[:, e] = records[name][start:stop]
+    del records
     return data
 
 
-def _binary2array_labview_clusters(fname, skip = 20):
+def _labview_clusters(buffer, start, max_records=None):
+    """Finds the clusters in buffer starting at byte start.
 
-    def read_time(file, entry_format = '>QQ'):
-        entry_size = calcsize(entry_format)
-        record = file.read(entry_size)
-        et = unpack(entry_format, record)
-        subsec = et[1] * 2**-64
-        timet = et[0] + subsec
-        return timet
+    Each cluster header contains the position of the next one, so the headers are walked one after another. This
+    is O(number of clusters), the peak records themselves are not touched. Reading stops at the first cluster that
+    is incomplete (e.g. at the end of a file that was still written to), or once the clusters found contain at least
+    max_records peaks.
 
-    def read_array_length(file, entry_format = '>i'):
-        entry_size = calcsize(entry_format)
-        record = file.read(entry_size)
-        lengtht  = unpack(entry_format, record)[0]
-        return lengtht
+    Returns
+    -------
+    seconds, fractions, offsets (position of the first peak record), lengths (number of peak records): arrays
+    end: position after the last cluster found
+    """
+    header_size = calcsize(_cluster_header_format)
+    record_size = _peak_dtype_labview.itemsize
+    size = len(buffer)
+    seconds, fractions, offsets, lengths = [], [], [], []
+    no_records = 0
+    pos = start
+    while pos + header_size <= size:
+        if max_records and no_records >= max_records:
+            break
+        sec, frac, length = unpack_from(_cluster_header_format, buffer, pos)
+        end = pos + header_size + length * record_size
+        if length < 0 or end > size:
+            break
+        seconds.append(sec)
+        fractions.append(frac)
+        offsets.append(pos + header_size)
+        lengths.append(length)
+        no_records += length
+        pos = end
+    return (np.array(seconds, dtype=np.uint64), np.array(fractions, dtype=np.uint64), np.array(offsets, dtype=np.int64),
+            np.array(lengths, dtype=np.int64), pos)
+
+
+def _decode_labview_clusters(raw, seconds, fractions, offsets, lengths):
+    """Copies the peak records of the clusters (see _labview_clusters) from raw (the file as uint8 array) into a
+    single structured array and converts it to an array (peaks x 6): time, ticks, amplitude, width, saturated, use.
+    Returns None if there are no clusters or if use is not 0 or 1, which indicates a wrong header length."""
+    if lengths.shape[0] == 0:
+        return None
+
+    records = np.empty(lengths.sum(), dtype=_peak_dtype_labview)
+    records_bytes = records.view(np.uint8)
+    starts = np.concatenate(([0], lengths.cumsum())) * _peak_dtype_labview.itemsize
+    for e, (off, length) in enumerate(zip(offsets, lengths)):
+        records_bytes[starts[e]:starts[e + 1]] = raw[off:off + length * _peak_dtype_labview.itemsize]
+
+    use = records['use']
+    if np.any(np.logical_and(use != 1, use != 0)):
+        return None
+
+    # column major, so each column is written in one contiguous block
+    data = np.empty((records.shape[0], 6), order='F')
+    data[:, 0] = np.repeat(seconds.astype(float) + fractions.astype(float) * 2**-64, lengths)
+    for e, name in enumerate(_peak_dtype_labview.names):
+        data[:, e + 1] = records[name]
+    return data
 
-    def read_array(rein, length, time, entry_format = '>LHBBB'):
-        entry_size = calcsize(entry_format)
 
-        thearray = np.zeros((length,6))
+def _iter_binary2array_labview_clusters(fname, skip = 20, block_size = None):
+    """Same as _binary2array_labview_clusters, but yields the peaks in blocks of whole clusters with about
+    block_size peaks (all peaks in one block if None). Only the current block is held in memory."""
+    if os.path.getsize(fname) == 0:
+        return
 
-        for i in range(length):
-            record = rein.read(entry_size)
-            entry = unpack(entry_format, record)
-            thearray[i,0] = time
-            thearray[i,1:] = entry
-        return thearray
+    with open(fname, mode='rb') as rein:
+        buffer = mmap.mmap(rein.fileno(), 0, access=mmap.ACCESS_READ)
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    try:
+        # If a peak file was created on startup it has a different header length compared to when it was created
+        # because the maximum file size was reached. If the structure is not correct (use has to be 0 or 1, and
+        # there has to be at least one cluster) the header length is adjusted.
+        for skip in (skip, 0):
+            clusters = _labview_clusters(buffer, skip, max_records=block_size)
+            data = _decode_labview_clusters(raw, *clusters[:4])
+            if not isinstance(data, type(None)):
+                break
+        else:
+            txt = "Sorry, this should not happen ... need fixn!!"
+            warnings.warn(txt)
+            return
 
-    while 1:
-        wrong_skip = False
-        rein = open(fname, mode='rb')
-        rein.read(skip) # This is some type of header ... no idea what exactly
-        array_list = []
         while 1:
-            try:
-                time = read_time(rein)
-                length = read_array_length(rein)
-                array = read_array(rein, length,time)
-                array_list.append(array)
-            except:
+            yield data
+            clusters = _labview_clusters(buffer, clusters[4], max_records=block_size)
+            if clusters[3].shape[0] == 0:
                 break
-
-            lc = array[:,-1]
-
-            # If a peak file was created on startup it will have a different header
-            # length compared to when it was created because the maximum file size
-            # was reached. The following test if the structure was correct an will
-            # adjust the header length if necessary.
-            if np.any(np.logical_and(lc != 1, lc != 0)):
-                if skip == 0:
-                    txt = "Sorry, this should not happen ... need fixn!!"
-                    # raise ValueError(txt)
-                    warnings.warn(txt)
-                    return False
-                wrong_skip = True
-                skip = 0
+            data = _decode_labview_clusters(raw, *clusters[:4])
+            if isinstance(data, type(None)):
+                warnings.warn('Binary file %s is corrupt after %i bytes, the rest is ignored.' % (fname, clusters[2][0]))
                 break
+    finally:
+        del raw
+        buffer.close()
 
-        rein.close()
 
-        if wrong_skip:
-            continue
-        else:
-            # looks like for short files the above skip test does not work ... quickfix:
-            try:
-                full_array = np.concatenate(array_list)
-            except ValueError:
-                skip = 0
-                continue
-            break
+def _binary2array_labview_clusters(fname, skip = 20):
+    """Reads peak files of the current version.
+
+    The file is memory mapped, the cluster headers are located by _labview_clusters and the peak records of all
+    clusters are copied into a single structured array, from which the columns are converted at once.
 
-    return full_array
+    Returns
+    -------
+    array (peaks x 6): time, ticks, amplitude, width, saturated, use
+    False if the file could not be read.
+    """
+    blocks = list(_iter_binary2array_labview_clusters(fname, skip=skip))
+    if len(blocks) == 0:
+        return False
+    return blocks[0]
+
+
+def _write_synthetic_peak_file(fname, size_mb, peaks_per_cluster=100, start=3.5e9):
+    """Writes a peak file (current version) of about size_mb MB with random amplitudes and widths. Each cluster has
+    peaks_per_cluster peaks, clusters are 0.1 s apart starting at start (seconds since 1904)."""
+    header_size = calcsize(_cluster_header_format)
+    cluster_size = header_size + peaks_per_cluster * _peak_dtype_labview.itemsize
+    no_of_clusters = int(size_mb * 1e6 / cluster_size)
+    cluster_dtype = np.dtype([('seconds', '>u8'), ('fraction', '>u8'), ('length', '>i4'),
+                              ('peaks', _peak_dtype_labview, (peaks_per_cluster,))])
+    with open(fname, 'wb') as out:
+        out.write(b'\x00' * 20)
+        chunksize = 10000
+        for chunk_start in range(0, no_of_clusters, chunksize):
+            cluster_no = np.arange(chunk_start, min(chunk_start + chunksize, no_of_clusters))
+            clusters = np.zeros(cluster_no.shape[0], dtype=cluster_dtype)
+            clusters['seconds'] = start + cluster_no // 10
+            clusters['fraction'] = (cluster_no % 10).astype(np.uint64) * np.uint64(2**64 // 10)
+            clusters['length'] = peaks_per_cluster
+            clusters['peaks']['ticks'] = np.arange(peaks_per_cluster)
+            clusters['peaks']['amplitude'] = np.random.randint(30, 65000, (cluster_no.shape[0], peaks_per_cluster))
+            clusters['peaks']['width'] = np.random.randint(2, 100, (cluster_no.shape[0], peaks_per_cluster))
+            clusters['peaks']['use'] = 1
+            clusters.tofile(out)
+    return no_of_clusters
+
+
+def benchmark_read_binary(size_mb=1000, peaks_per_cluster=100, no_of_peaks_loop=100000, fname=None):
+    """Creates a synthetic peak file of about size_mb MB and times _binary2array_labview_clusters. The record by
+    record decoding with struct.unpack (as it was done before) is timed for no_of_peaks_loop peaks and extrapolated.
+    """
+    import tempfile
+    import time
+
+    remove = False
+    if not fname:
+        fd, fname = tempfile.mkstemp(suffix='_Peak.bin')
+        os.close(fd)
+        remove = True
+    try:
+        _write_synthetic_peak_file(fname, size_mb, peaks_per_cluster=peaks_per_cluster)
+
+        start = time.time()
+        data = _binary2array_labview_clusters(fname)
+        time_memmap = time.time() - start
+
+        start = time.time()
+        with open(fname, 'rb') as rein:
+            rein.read(20)
+            entry_size = calcsize('>LHBBB')
+            no_read = 0
+            while no_read < no_of_peaks_loop:
+                et = unpack('>QQ', rein.read(16))
+                length = unpack('>i', rein.read(4))[0]
+                thearray = np.zeros((length, 6))
+                for i in range(length):
+                    thearray[i, 0] = et[0] + et[1] * 2**-64
+                    thearray[i, 1:] = unpack('>LHBBB', rein.read(entry_size))
+                no_read += length
+        time_loop = (time.time() - start) * data.shape[0] / no_read
+        max_dev = np.abs(thearray - data[no_read - length:no_read]).max()
+    finally:
+        if remove:
+            os.remove(fname)
+
+    print('%i peaks (%.0f MB)' % (data.shape[0], size_mb))
+    print('struct.unpack (extrapolated): %.1f s' % time_loop)
+    print('memory mapped: %.1f s (speedup: %.1f)' % (time_memmap, time_loop / time_memmap))
+    print('max. deviation: %s' % max_dev)
+    return time_loop, time_memmap
+
+
+def benchmark_read_binary_parallel(no_of_files=8, size_mb=50, workers=None):
+    """Reads no_of_files synthetic peak files of size_mb MB each with read_binary using 1 to workers processes (all
+    CPUs if None) and prints the time for each number of workers."""
+    import tempfile
+    import time
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    times = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for e in range(no_of_files):
+            fname = os.path.join(folder, '20160101_%02i0000_Peak.bin' % e)
+            _write_synthetic_peak_file(fname, size_mb, start=3.5e9 + e * 3600)
+
+        no_of_workers = 1
+        while 1:
+            start = time.time()
+            out = read_binary(folder, workers=no_of_workers)
+            times[no_of_workers] = time.time() - start
+            print('%i workers: %.1f s (speedup: %.1f)' % (no_of_workers, times[no_of_workers],
+                                                          times[1] / times[no_of_workers]))
+            if no_of_workers >= workers:
+                break
+            no_of_workers = min(no_of_workers * 2, workers)
+    print('%i peaks, index monotonic: %s' % (out.data.shape[0], out.data.index.is_monotonic_increasing))
+    return times
 
 
 def _PeakFileArray2dataFrame(data,fname,time_shift, log = True, since_midnight = True):
@@ -354,7 +710,7 @@ def _PeakFileArray2dataFrame(data,fname,time_shift, log = True, since_midnight =
 
     # corrupt file, somewhat different though
     except OverflowError:
-        data, report = _cleanPeaksArray(data)
+        data, report = _cleanPeaksArray(data, **_clean_defaults['01' if since_midnight else 'current'])
         warnings.warn('Binary file %s is corrupt. Will try to fix it. if no exception accured it probably worked\nReport:\n%s'%(fname,report))
         
         
@@ -372,64 +728,148 @@ def _PeakFileArray2dataFrame(data,fname,time_shift, log = True, since_midnight =
     dataTable.Masked = np.abs(1. - dataTable.Masked).astype(np.int8)
     return dataTable
 
-def _cleanPeaksArray(PeakArray):
-    """tries to remove data points where obviously something went wrong. Returns the cleaned array."""
-    BarrayClean = PeakArray.copy()
-    startShape = BarrayClean.shape
-    startstartShape = BarrayClean.shape
-
-#    print BarrayClean.shape
-    Tmax = 1.e6 #unless you are measuring for more than 2 weeks this should be ok
-    BarrayClean = BarrayClean[BarrayClean[:,0] < Tmax]
-
-    pointsRem = startShape[0] - BarrayClean.shape[0]
-    report = '%s (%.5f%%) datapoints removed due to bad Time (quickceck)\n'%(pointsRem, pointsRem/float(startShape[0]))
-    startShape = BarrayClean.shape
-    ampMax = 2.*16 #the maximum you can measure with a 16 bit A2D converter
-    BarrayClean = BarrayClean[BarrayClean[:,2] < ampMax]
-    BarrayClean = BarrayClean[BarrayClean[:,2] > 0]
-
-    pointsRem = startShape[0] - BarrayClean.shape[0]
-    report += '%s (%.5f%%) datapoints removed due to bad Amplitude.\n'%(pointsRem, pointsRem/float(startShape[0]))
-    startShape = BarrayClean.shape
-    BarrayClean = BarrayClean[np.logical_or(BarrayClean[:,-1] == 1, BarrayClean[:,-1] == 0)]
-
-    pointsRem = startShape[0] - BarrayClean.shape[0]
-    report += '%s (%.5f%%) datapoints removed due to bad Used.\n'%(pointsRem, pointsRem/float(startShape[0]))
-    startShape = BarrayClean.shape
-    BarrayClean = BarrayClean[BarrayClean[:,3] < 1000]
-    BarrayClean = BarrayClean[BarrayClean[:,3] > 1]
-
-    pointsRem = startShape[0] - BarrayClean.shape[0]
-    report +='%s (%.5f%%) datapoints removed due to bad Width.\n'%(pointsRem, pointsRem/float(startShape[0]))
-    startShape = BarrayClean.shape
-    BarUni = np.unique(BarrayClean[:,0])
-    BarUniInt = BarUni[1:]- BarUni[:-1]
-    timeMed = np.median(BarUniInt)
-
-    lastTime = BarrayClean[0,0] #first entry in the time
-    counterToHigh = 0
-    counterToLow = 0
-    for e,i in enumerate(BarrayClean):
-        if i[0] - lastTime > timeMed * 1.1:
-            i[0] = np.nan
-            counterToHigh += 1
-        elif i[0] - lastTime < 0:
-            i[0] = np.nan
-            counterToLow += 1
-        else:
-            lastTime = i[0]
+def _time_continuity_mask(time, max_step):
+    """Mask of the peaks whose time stamp is not smaller than and at most max_step larger than that of the previous
+    valid peak (the first peak is valid).
+
+    Where the time steps between consecutive peaks are fine (the vast majority) the previous valid peak is simply
+    the previous peak, so the array is only searched from one bad step to the next. After a bad step the first peak
+    that fits to the last valid one is searched for in windows of growing size. This is linear in the number of
+    peaks.
+    """
+    no_peaks = time.shape[0]
+    keep = np.zeros(no_peaks, dtype=bool)
+    if no_peaks == 0:
+        return keep
+    step = time[1:] - time[:-1]
+    bad = np.flatnonzero(np.logical_or(step < 0, step > max_step)) + 1
+
+    pos = 0
+    while 1:
+        next_bad = np.searchsorted(bad, pos + 1)
+        end = bad[next_bad] if next_bad < bad.shape[0] else no_peaks
+        keep[pos:end] = True
+        if end == no_peaks:
+            break
+        last = time[end - 1]
+        start = end + 1
+        window = 64
+        pos = None
+        while start < no_peaks:
+            dt = time[start:start + window] - last
+            fits = np.logical_and(dt >= 0, dt <= max_step)
+            if fits.any():
+                pos = start + fits.argmax()
+                break
+            start += window
+            window *= 2
+        if pos is None:
+            break
+    return keep
+
+
+def _cleanPeaksArray(PeakArray, time_max = 1.e6, amplitude_range = (0, 2**16), width_range = (1, 1000),
+                     time_tolerance = 1.1, remove_saturated = False, return_statistics = False):
+    """tries to remove data points where obviously something went wrong. Returns the cleaned array.
 
-    BarrayClean = BarrayClean[~np.isnan(BarrayClean[:,0])]
+    Each criterion is a mask on the whole array, all of them scale linearly with the number of peaks.
+
+    Arguments
+    ---------
+    PeakArray: array (peaks x 6): time, ticks, amplitude, width, saturated, use
+    time_max: float
+        Peaks with larger time stamps are removed. The default is ok unless you are measuring for more than 2 weeks.
+    amplitude_range: tuple
+        Peaks with amplitudes outside (excluding the limits) are removed. The default is the range of the 16 bit
+        detector signal.
+    width_range: tuple
+        Peaks with widths outside (excluding the limits) are removed.
+    time_tolerance: float or None
+        Peaks whose time stamp is smaller than that of the previous valid peak, or larger by more than
+        time_tolerance times the median time step, are removed. None switches this check off.
+    remove_saturated: bool
+        If saturated peaks are removed.
+    return_statistics: bool
+        If True a pandas Series with the number of peaks removed by each criterion is returned in addition.
 
+    Returns
+    -------
+    cleaned array, report (str)[, statistics]
+    """
+    startstartShape = PeakArray.shape
+    statistics = pd.Series(0, index=['time', 'amplitude', 'use', 'width', 'saturated', 'time_continuity'],
+                           name='peaks removed')
+    report = ''
+
+    # The criteria are applied one after another, a peak is only counted for the first criterion that removes it.
+    keep = np.ones(PeakArray.shape[0], dtype=bool)
+    def apply(mask, criterion, txt):
+        before = keep.sum()
+        pointsRem = before - np.logical_and(keep, mask).sum()
+        keep[~ mask] = False
+        statistics[criterion] = pointsRem
+        return txt % (pointsRem, pointsRem / float(max(before, 1)))
+
+    report += apply(PeakArray[:,0] < time_max, 'time',
+                    '%s (%.5f%%) datapoints removed due to bad Time (quickceck)\n')
+    amp = PeakArray[:,2]
+    report += apply(np.logical_and(amp < amplitude_range[1], amp > amplitude_range[0]), 'amplitude',
+                    '%s (%.5f%%) datapoints removed due to bad Amplitude.\n')
+    report += apply(np.logical_or(PeakArray[:,-1] == 1, PeakArray[:,-1] == 0), 'use',
+                    '%s (%.5f%%) datapoints removed due to bad Used.\n')
+    width = PeakArray[:,3]
+    report += apply(np.logical_and(width < width_range[1], width > width_range[0]), 'width',
+                    '%s (%.5f%%) datapoints removed due to bad Width.\n')
+    if remove_saturated:
+        report += apply(PeakArray[:,4] == 0, 'saturated', '%s (%.5f%%) datapoints removed due to saturation.\n')
+    BarrayClean = PeakArray[keep]
+
+    if time_tolerance and BarrayClean.shape[0] > 0:
+        BarUni = np.unique(BarrayClean[:,0])
+        BarUniInt = BarUni[1:]- BarUni[:-1]
+        timeMed = np.median(BarUniInt)
+        mask = _time_continuity_mask(BarrayClean[:,0], timeMed * time_tolerance)
+        pointsRem = mask.shape[0] - mask.sum()
+        statistics['time_continuity'] = pointsRem
+        report += '%s (%.5f%%) datapoints removed due to bad Time (more elaborate check).\n' % (pointsRem, pointsRem / float(mask.shape[0]))
+        BarrayClean = BarrayClean[mask]
 
-    pointsRem = startShape[0] - BarrayClean.shape[0]
-    report += '%s (%.5f%%) datapoints removed due to bad Time (more elaborate check).\n'%(pointsRem, pointsRem/float(startShape[0]))
-    startShape = BarrayClean.shape
     pointsRem = startstartShape[0] - BarrayClean.shape[0]
-    report += 'All together %s (%.5f%%) datapoints removed.'%(pointsRem, pointsRem/float(startstartShape[0]))
+    report += 'All together %s (%.5f%%) datapoints removed.'%(pointsRem, pointsRem/float(max(startstartShape[0], 1)))
+    if return_statistics:
+        return BarrayClean, report, statistics
     return BarrayClean, report
 
+def _counts2distribution(unique, deltaT_sl, N, too_big, bins, distributionType = 'number', differentialStyle = False):
+    """Turns the histograms of peaks._histogram into a SizeDist_TS (see peaks._peak2Distribution)."""
+    N = N / deltaT_sl[:, np.newaxis]
+    too_big = too_big / deltaT_sl
+    binwidth = bins[1:] - bins[:-1]
+
+    if not differentialStyle:
+        pass
+
+    elif differentialStyle == 'dNdDp':
+        N = N/binwidth
+    else:
+        raise ValueError('wrong type for argument "differentialStyle"')
+
+    binstr = bins.astype(int).astype(str)
+    cols=[]
+    for e,i in enumerate(binstr[:-1]):
+        cols.append(i+'-'+binstr[e+1])
+    dataFrame = pd.DataFrame(N, columns=cols, index = unique)
+    # too_big = pd.DataFrame(too_big, columns=['# too big'])
+    too_big = _timeseries.TimeSeries(pd.DataFrame(too_big, columns=['# too big'], index = unique))
+    if distributionType == 'calibration':
+        return sizedistribution.SizeDist_TS(dataFrame, bins, 'calibration')
+    else:
+        dist = sizedistribution.SizeDist_TS(dataFrame, bins, 'dNdDp')
+        dist = dist.convert2dNdlogDp()
+        dist.particle_number_concentration_outside_range = too_big
+        return dist
+
+
 class peaks(object):
     def __init__(self,dataFrame):
         self.data = dataFrame
@@ -484,31 +924,64 @@ class peaks(object):
     ##########
     ##### Analytics
         
-    def get_countRate(self,average = None):
+    def _time_bins(self, resolution = None):
+        """Assigns the peaks to time intervals.
+
+        Parameters
+        ----------
+        resolution: str or timedelta, optional
+            e.g. '10S'. If None, each unique time stamp of the not masked peaks is an interval (this is the time
+            resolution the peaks were recorded with).
+
+        Returns
+        -------
+        times: array of datetime64, start of each interval
+        deltaT: array, length of each interval in seconds. Without resolution this is the time since the previous
+            time stamp (for the first one the time to the second).
+        label: function, that returns the index of the interval for an array of time stamps, -1 for time stamps
+            that do not belong to any interval.
+        """
+        notMasked = self.data.Masked.values == 0
+        if resolution is None:
+            times = np.unique(self.data.index.values[notMasked])
+            deltaT = (times[1:] - times[:-1]) / np.timedelta64(1, 's')
+            deltaT = np.append(deltaT[0], deltaT)
+
+            def label(t):
+                pos = np.searchsorted(times, t)
+                pos[pos == times.shape[0]] = 0
+                return np.where(times[pos] == t, pos, -1)
+        else:
+            resolution = pd.to_timedelta(resolution).to_timedelta64().astype('timedelta64[ns]')
+            step = resolution.astype(np.int64)
+            ns = self.data.index.values.astype('datetime64[ns]').astype(np.int64)[notMasked] // step
+            first, last = ns.min(), ns.max()
+            times = (np.arange(first, last + 1) * step).astype('datetime64[ns]')
+            deltaT = np.zeros(times.shape[0]) + resolution / np.timedelta64(1, 's')
+
+            def label(t):
+                pos = t.astype('datetime64[ns]').astype(np.int64) // step - first
+                return np.where((pos >= 0) & (pos < times.shape[0]), pos, -1)
+        return times, deltaT, label
+
+    def get_countRate(self,average = None, resolution = None):
         """average: string, e.g. "5S" for 5 seconds
+        resolution: string, e.g. "10S", the peaks are counted in intervals of this length (see _time_bins).
         returns a pandas dataframe"""
-        notMasked = np.where(self.data.Masked == 0)
-        unique = np.unique(self.data.index.values[notMasked])
-        numbers = np.zeros(unique.shape)
-        deltaT = np.zeros(unique.shape)
-        countsPerSec = np.zeros(unique.shape)
-        dt = unique[1]-unique[0]
-        for e,i in enumerate(unique):
-            if e:
-                dt = unique[e] - unique[e-1]
-            numbers[e] =  float(len(np.where(self.data.index.values[notMasked] == i)[0]))
-            deltaT[e] = dt / np.timedelta64(1, 's') # delta in seconds
-            countsPerSec[e] = numbers[e] / deltaT[e]
-    
-        countRate = pd.DataFrame(np.array([numbers,deltaT,countsPerSec]).transpose(), index = unique, columns=['No_of_particles', 'DeltaT_s', 'CountRate_s'])    
+        unique, deltaT, label = self._time_bins(resolution)
+        notMasked = self.data.Masked.values == 0
+        numbers = np.bincount(label(self.data.index.values[notMasked]), minlength=unique.shape[0]).astype(float)
+        countsPerSec = numbers / deltaT
+
+        countRate = pd.DataFrame(np.array([numbers,deltaT,countsPerSec]).transpose(), index = unique, columns=['No_of_particles', 'DeltaT_s', 'CountRate_s'])
         if average:
             countRate = countRate.resample(average,closed = 'right', label='center')
         return countRate
-        
 
-    
-    
-    def _peak2Distribution(self, bins=defaultBins, distributionType = 'number', differentialStyle = False):
+
+
+
+    def _peak2Distribution(self, bins=defaultBins, distributionType = 'number', differentialStyle = False, resolution = None):
         """Action required: clean up!
         Returns the particle size distribution normalized in various ways
         distributionType
@@ -521,74 +994,63 @@ class peaks(object):
         differentialStyle:\t     if False a raw histogram will be created, else:
             \t dNdDp: \t      distribution normalized to the bin width, bincenters are given by (Dn+Dn+1)/2
             \t dNdlogDp:\t    distribution normalized to the log of the bin width, bincenters are given by 10**((logDn+logDn+1)/2)
-    
-        """
-        notMasked = np.where(self.data.Masked == 0)
-        # too_big_condi = np.where(self.data.Masked == 2)
+        resolution:\t     time resolution, e.g. '10S'. If None each time stamp in the peak data is a line in the size
+            distribution (see _time_bins).
 
-        unique = np.unique(self.data.index.values[notMasked])
-        N = np.zeros((unique.shape[0],bins.shape[0]-1))
-        too_big = np.zeros(unique.shape[0])
-    
-        for e,i in enumerate(unique):
-            condi = np.where(np.logical_and(self.data.Masked == 0, self.data.index.values == i))
-            if distributionType == 'calibration':
-                process = self.data.Amplitude.values[condi]
-            else:
-                process = self.data.Diameter.values[condi]
-            n,edg = np.histogram(process, bins = bins)
-            N[e] = n
-            too_big[e] = np.logical_and(self.data.Masked == 2, self.data.index.values == i).sum()
-    
-        N = N.astype(np.float)
-        too_big = too_big.astype(np.float)
+        The peaks are sorted into (time interval, size bin) in one go, so this scales with the number of peaks rather
+        than with the number of peaks times the number of time stamps.
+        """
+        bins = np.asarray(bins)
+        unique, deltaT_sl, N, too_big = self._histogram(bins, distributionType=distributionType, resolution=resolution)
+        return _counts2distribution(unique, deltaT_sl, N, too_big, bins, distributionType=distributionType,
+                                    differentialStyle=differentialStyle)
+
+    def _histogram(self, bins, distributionType = 'number', resolution = None):
+        """Number of peaks in each (time interval, size bin) and of peaks too big for the calibration in each time
+        interval (see _time_bins and _peak2Distribution).
+
+        Returns
+        -------
+        times, deltaT, counts (times x bins), too_big
+        """
+        masked = self.data.Masked.values
+        notMasked = masked == 0
+        times = self.data.index.values
 
-        deltaT = (unique[1:]-unique[:-1]) / np.timedelta64(1,'s')
+        unique, deltaT_sl, label = self._time_bins(resolution)
+        no_bins = bins.shape[0] - 1
 
-        deltaT_sl = np.append(deltaT[0],deltaT)
-        deltaT = np.repeat(np.array([deltaT_sl]),bins.shape[0]-1, axis=0)
-        N/=deltaT.transpose()
-        too_big /= deltaT_sl.transpose()
-        binwidth = edg[1:] - edg[:-1]
-    
-        if not differentialStyle:
-            pass
-    
-        elif differentialStyle == 'dNdDp':
-            N = N/binwidth
-        else:
-            raise ValueError('wrong type for argument "differentialStyle"')      
-
-        binstr = bins.astype(int).astype(str)
-        cols=[]
-        for e,i in enumerate(binstr[:-1]):
-            cols.append(i+'-'+binstr[e+1])
-        dataFrame = pd.DataFrame(N, columns=cols, index = unique)
-        # too_big = pd.DataFrame(too_big, columns=['# too big'])
-        too_big = _timeseries.TimeSeries(pd.DataFrame(too_big, columns=['# too big'], index = unique))
         if distributionType == 'calibration':
-            return sizedistribution.SizeDist_TS(dataFrame, bins, 'calibration')
+            process = self.data.Amplitude.values[notMasked]
         else:
-            dist = sizedistribution.SizeDist_TS(dataFrame, bins, 'dNdDp')
-            dist = dist.convert2dNdlogDp()
-            dist.particle_number_concentration_outside_range = too_big
-            return dist
-        
+            process = self.data.Diameter.values[notMasked]
+        # same as np.histogram: bins[i] <= value < bins[i+1], the last bin includes its upper edge
+        size_bin = np.searchsorted(bins, process, side='right') - 1
+        size_bin[process == bins[-1]] = no_bins - 1
+        time_bin = label(times[notMasked])
+        valid = (size_bin >= 0) & (size_bin < no_bins) & (time_bin >= 0)
+        N = np.bincount(time_bin[valid] * no_bins + size_bin[valid], minlength=unique.shape[0] * no_bins)
+        N = N.reshape(unique.shape[0], no_bins).astype(float)
+
+        too_big_bin = label(times[masked == 2])
+        too_big = np.bincount(too_big_bin[too_big_bin >= 0], minlength=unique.shape[0]).astype(float)
+        return unique, deltaT_sl, N, too_big
+
 #    def peak2numberdistribution_dNdlogDp(self, bins = defaultBins):
 #        return self._peak2Distribution(bins = bins, differentialStyle='dNdlogDp')
 #        
 #    def peak2numberconcentration(self, bins = defaultBins):
 #        return self._peak2Distribution(bins = bins)
-    def peak2peakHeightDistribution(self, bins = np.logspace(np.log10(35),np.log10(65000), 200)):
+    def peak2peakHeightDistribution(self, bins = np.logspace(np.log10(35),np.log10(65000), 200), resolution = None):
         """see doc-string of _peak2Distribution"""
-        return self._peak2Distribution(bins = bins,distributionType = 'calibration',differentialStyle = 'dNdDp')
+        return self._peak2Distribution(bins = bins,distributionType = 'calibration',differentialStyle = 'dNdDp', resolution = resolution)
         
-    def peak2sizedistribution(self, bins = 'default'):
+    def peak2sizedistribution(self, bins = 'default', resolution = None):
         """see doc-string of _peak2Distribution"""
         if type(bins) == str:
             if bins == 'default':
                 bins = defaultBins
-        dist = self._peak2Distribution(bins=bins, differentialStyle='dNdDp')
+        dist = self._peak2Distribution(bins=bins, differentialStyle='dNdDp', resolution = resolution)
         return dist
         
 #    def peak2calibration(self, bins = 200, ampMin = 20):
@@ -5,32 +5,90 @@ Created on Thu Feb 26 10:41:17 2015
 @author: htelg
 """
 import os
-from struct import unpack, calcsize
 import numpy as np
 
-def read(fname):
-    ''' load a raw_file and returns a numpy array. 
-    Note, these files have no x axes. The axes depends on the sampling rate of the particular POPS daughter board.
-    Usually this is 4 MHz, however, better check!'''
-    entry_format = '>h'
-    entry_size = calcsize(entry_format)
+# the detector signal is written as big endian 16 bit integers
+_raw_dtype = np.dtype('>i2')
+
+
+class RawFile(object):
+    """Memory mapped raw file. Opening does not read anything (constant time, no matter how large the file is), data
+    is only read when sliced. Slicing returns float arrays like read.
 
-    rein = open(fname, mode='rb')
-    entry_count = int(os.fstat(rein.fileno()).st_size / entry_size)
+    Examples
+    --------
+    >>> raw = RawFile(fname)
+    >>> len(raw)                   # number of samples
+    >>> raw[4000000:8000000]       # second second of a 4 MHz file
+    >>> raw[::1000]                # every 1000th sample
+    >>> mn, mx = raw.envelope(1000)  # min and max of each 1000 samples, e.g. for preview plots
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        entry_count = int(os.path.getsize(fname) / _raw_dtype.itemsize)
+        if entry_count == 0:
+            self.data = np.zeros(0, dtype=_raw_dtype)
+        else:
+            self.data = np.memmap(fname, dtype=_raw_dtype, mode='r', shape=(entry_count,))
 
+    def __len__(self):
+        return self.data.shape[0]
 
-    raus = np.zeros(entry_count)
+    @property
+    def shape(self):
+        return self.data.shape
 
-    for e,r in enumerate(raus):
-        record = rein.read(entry_size)
-        entry, = unpack(entry_format, record)
-    #     print entry
+    def __getitem__(self, key):
+        out = self.data[key]
+        if np.ndim(out) == 0:
+            return float(out)
+        return np.array(out, dtype=float)
 
+    def envelope(self, step, start = None, stop = None, chunksize = 10000000):
+        """Minimum and maximum of each step samples between start and stop. Unlike simple decimation (raw[::step])
+        this does not miss short peaks. The file is processed in chunks of about chunksize samples.
 
-        if e == -1:
-            # print entry
-            break
-        raus[e] = float(entry)
+        Returns
+        -------
+        min, max: float arrays
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        step = int(step)
+        no_points = int(np.ceil((stop - start) / float(step)))
+        mins = np.zeros(no_points)
+        maxs = np.zeros(no_points)
+        chunk = max(chunksize // step, 1) * step
+        for e, pos in enumerate(range(start, stop, chunk)):
+            data = np.asarray(self.data[pos:min(pos + chunk, stop)])
+            no_full = data.shape[0] // step
+            first = e * (chunk // step)
+            if no_full:
+                blocks = data[:no_full * step].reshape(no_full, step)
+                mins[first:first + no_full] = blocks.min(axis=1)
+                maxs[first:first + no_full] = blocks.max(axis=1)
+            if data.shape[0] > no_full * step:
+                rest = data[no_full * step:]
+                mins[first + no_full] = rest.min()
+                maxs[first + no_full] = rest.max()
+        return mins, maxs
+
+
+def read(fname, start = None, stop = None, step = None, lazy = False):
+    ''' load a raw_file and returns a numpy array.
+    Note, these files have no x axes. The axes depends on the sampling rate of the particular POPS daughter board.
+    Usually this is 4 MHz, however, better check!
 
-    rein.close()
-    return raus
\ No newline at end of file
+    Arguments
+    ---------
+    fname: str
+    start, stop: int, optional
+        Only the samples start to stop (excluding) are read.
+    step: int, optional
+        Decimation, only every step-th sample is read (e.g. for preview plots, see also RawFile.envelope).
+    lazy: bool
+        If True a RawFile instance is returned, which reads data only when sliced.
+    '''
+    raw = RawFile(fname)
+    if lazy:
+        return raw
+    return raw[start:stop:step]
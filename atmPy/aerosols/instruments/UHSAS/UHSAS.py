@@ -15,6 +15,7 @@ import pylab as plt
 from scipy.interpolate import UnivariateSpline
 
 from atmPy.general import timeseries
+from atmPy.tools import array_tools
 from atmPy.aerosols.size_distribution import sizedistribution
 
 
@@ -181,9 +182,37 @@ data = """120., 19.5
     return calibrationInstance
 
 class calibration:
-    def __init__(self,dataTabel):
+    def __init__(self,dataTabel, lookup_table = True):
+        """
+        Arguments
+        ---------
+        dataTabel: pandas DataFrame with columns bin_no and d
+        lookup_table: bool
+            If True (default) calibrationFunction is a monotone lookup table (array_tools.LookupTable) of the spline
+            (calibrationFunctionSpline). The maximum deviation from the spline is in lookup_table.max_error.
+        """
         self.data = dataTabel
-        self.calibrationFunction = self.get_calibrationFunctionSpline()
+        self.calibrationFunctionSpline = self.get_calibrationFunctionSpline()
+        if lookup_table:
+            self.lookup_table = self.get_lookup_table()
+            self.calibrationFunction = self.lookup_table
+        else:
+            self.lookup_table = None
+            self.calibrationFunction = self.calibrationFunctionSpline
+
+    def get_lookup_table(self, no_pts = 2**14):
+        """Lookup table of the calibration spline over the bin number range of the calibration data. Outside this
+        range the table is continued linearly, since the spline itself is not necessarily monotonic there.
+
+        Returns
+        -------
+        array_tools.LookupTable instance
+        """
+        lut = array_tools.LookupTable(self.calibrationFunctionSpline, self.data.bin_no.min(), self.data.bin_no.max(),
+                                      no_pts = no_pts, log = False)
+        if lut.max_error > 1e-4:
+            warnings.warn('The calibration lookup table deviates by up to %.2g %% from the spline.' % (lut.max_error * 100))
+        return lut
 
     def save_csv(self,fname):
 #         save_Calibration(self,test_data_folder)
@@ -253,7 +282,7 @@ class calibration:
     def apply_on(self, dist, limit_to_cal_range = True):
         dist_t = dist.copy()
         bins_no = np.arange(dist_t.bins.shape[0])
-        cal_f = self.get_calibrationFunctionSpline()
+        cal_f = self.calibrationFunction
 
         new_d = cal_f(bins_no)
         df = pd.DataFrame(np.array([bins_no, new_d]).transpose(), columns = ['bin_no','d'])
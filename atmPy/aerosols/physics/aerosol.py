@@ -1,10 +1,31 @@
 # -*- coding: utf-8 -*-
 from math import pi,exp,log10,sqrt,log
 
+import numpy as np
+import pandas as pd
 from scipy.optimize import fsolve
 
 from atmPy.general import constants
 
+# mobility-diameter tables, one for each gas condition, see _mobility_table
+_mobility_tables = {}
+
+# coefficients of Wiedensohler's approximation of the charge distribution for -2 to 2 charges
+_wiedensohler_coefficients = np.array([[-26.3328, 35.9044, -21.4608, 7.0867, -1.3088, 0.1051],
+                                       [-2.3197, 0.6175, 0.6201, -0.1105, -0.1260, 0.0297],
+                                       [-0.0003, -0.1014, 0.3073, -0.3372, 0.1023, -0.0105],
+                                       #  a[4] has been modified from the original publication
+                                       [-2.3484, 0.6044, 0.4800, 0.0013, -0.1553, 0.0320],
+                                       # a[5] has been modified from original publication
+                                       [-44.4756, 79.3772, -62.8900, 26.4492, -5.7480, 0.5049]])
+
+
+def _scalar_or_array(value):
+    """Returns a float for 0-d results, so scalar calls behave as before."""
+    if np.ndim(value) == 0:
+        return float(value)
+    return value
+
 
 def z(d, gas, n):
     """
@@ -12,23 +33,25 @@ def z(d, gas, n):
     
     Parameters
     -----------
-    d:      float
+    d:      float or array-like
             diameter in nm
     gas:    object of type gas
             Object that defines the gas calculations
-    n:      int
-            number of charges
+    n:      int or array-like
+            number of charges (broadcasts against d)
     
     Returns
     ---------   
-    Electrical mobility in m2/V*s as defined in Hinds (1999), p. 322, eq. 15.21.
+    Electrical mobility in m2/V*s as defined in Hinds (1999), p. 322, eq. 15.21. Float if all inputs are scalars,
+    otherwise an array.
     """
       
     try:
-        return n * constants.e * cc(d, gas) / (3 * pi * gas.mu() * d * 1e-9)
+        out = np.asarray(n) * constants.e * cc(d, gas) / (3 * pi * gas.mu() * np.asarray(d, dtype=float) * 1e-9)
     except AttributeError:
         print('Incorrect type selected for attribute "gas".')
         return 0
+    return _scalar_or_array(out)
 
 
 def z2d(zin, gas, n=1):
@@ -57,20 +80,83 @@ def z2d(zin, gas, n=1):
     return fsolve(f, d0)[0]
 
 
+def _cc(d, mfp):
+    """Cunningham correction factor of an array of diameters, d and mfp in microns (see cc)."""
+    return (1.05*np.exp(-0.39*d/mfp)+2.34)*mfp/d+1
+
+
+def _mobility_table(mu, mfp, d_min=0.1, d_max=1e5, no_pts=1000):
+    """
+    Table of ln(mobility) of singly charged particles and the corresponding ln(diameter) (nm) for the gas viscosity
+    mu and mean free path mfp.  The table is ordered by increasing mobility and memoized.
+    """
+    key = (float(mu), float(mfp))
+    if key not in _mobility_tables:
+        if len(_mobility_tables) > 1000:
+            _mobility_tables.clear()
+        d = np.logspace(log10(d_min), log10(d_max), no_pts)
+        zz = constants.e * _cc(d*1e-3, mfp) / (3 * pi * mu * d * 1e-9)
+        _mobility_tables[key] = (np.log(zz[::-1]), np.log(d[::-1]))
+    return _mobility_tables[key]
+
+
+def z2d_vectorized(zin, gas, n=1, rtol=1e-10, max_iter=20):
+    """
+    Vectorized version of z2d.  The diameters are first guessed from a monotone mobility-diameter table for the gas
+    conditions and then refined by Newton steps (in log space) until the relative change is smaller than rtol.
+
+    Parameters
+    -----------
+    zin:        float or array-like
+                Electrical mobility in m2/Vs
+    gas:        gas object
+                Gas object defining properties of variables related to gases
+    n:          float, optional, default = 1
+                Number of charges
+    rtol:       float, optional
+                Relative tolerance of the diameter
+    max_iter:   int, optional
+                Maximum number of Newton steps
+
+    Returns
+    -------
+    Diameter of particles in nanometers (array).
+    """
+    mu = gas.mu()
+    mfp = gas.l()
+    ln_zin = np.log(np.asarray(zin, dtype=float) / n)
+    ln_z_table, ln_d_table = _mobility_table(mu, mfp)
+
+    ln_d = np.interp(ln_zin, ln_z_table, ln_d_table)
+    for i in range(max_iter):
+        d = np.exp(ln_d)
+        c = _cc(d*1e-3, mfp)
+        ln_z = np.log(constants.e * c / (3 * pi * mu * d * 1e-9))
+
+        # d ln(z)/d ln(d), see cc for the Cunningham correction factor
+        slope = (1 - c - 0.4095*np.exp(-0.39*d*1e-3/mfp))/c - 1
+        step = (ln_z - ln_zin)/slope
+        ln_d -= step
+        if not np.any(np.abs(step) > rtol):
+            break
+    return np.exp(ln_d)
+
+
 def cc(d, gas):
     """
     Calculate Cunningham correction factor.
 
     Parameters
     -----------
-    d:      float
+    d:      float or array-like
             Particle diameter in nanometers.
     gas:    Gas object
             gas object from the atmosphere package
 
     Returns
     --------
-    Cunningham correction factor as a function of diameter and mean free path.
+    Cunningham correction factor as a function of diameter and mean free path. Float if d is a scalar, otherwise an
+    array.
 
     Notes
     -------
@@ -78,12 +164,12 @@ def cc(d, gas):
     """
     
     # Convert diameter to microns.
-    d = float(d)*1e-3
+    d = np.asarray(d, dtype=float)*1e-3
     # Get the mean free path
     try:
 
         mfp = gas.l()
-        return (1.05*exp(-0.39*d/mfp)+2.34)*mfp/d+1
+        return _scalar_or_array(_cc(d, mfp))
         
     except AttributeError:
         print('Invalid type entered for "gas".  Should be of type atmosphere.gas".')
@@ -119,16 +205,19 @@ def ndistr(dp, n=-1, t=20):
 
     Parameters
     -----------
-    dp: float
+    dp: float or array-like
         diameter of particle in nm
-    n:  int
+    n:  int or array-like
         number of charges
-    t:  float
+    t:  float or array-like
         temperature in degree C
 
+    All parameters broadcast against each other, e.g. ndistr(d[:, None], [-2, -1, 1, 2]) gives the charging efficiency
+    of all diameters and charges at once (see also charge_distribution).
+
     Returns
     --------
-    Charging efficiency
+    Charging efficiency. Float if all inputs are scalars, otherwise an array.
 
     Notes
     ------
@@ -136,48 +225,33 @@ def ndistr(dp, n=-1, t=20):
     * For particles larger than 1 micron, uses Gunn (1956), J. Colloid Sci., 11, 661.
     """
     
-    dp = float(dp)
-    a = [0, 0, 0, 0, 0]
-    if (abs(n) > 1 and dp < 20) or (dp <= 70 and abs(n) > 2):
+    dp, n, t = np.broadcast_arrays(np.asarray(dp, dtype=float), np.asarray(n), np.asarray(t, dtype=float))
+    n_abs = np.abs(n)
+    out = np.zeros(dp.shape)
 
-        # Particles less than 20 nm can carry at most 1 charge.
-        # Particles less than 70 nm can carry at most 2 charges.
-        return 0
+    # Particles less than 20 nm can carry at most 1 charge.
+    # Particles less than 70 nm can carry at most 2 charges.
+    zero = ((n_abs > 1) & (dp < 20)) | ((dp <= 70) & (n_abs > 2))
 
     # Use Wiedensohler if the particle size is less than a micron and the number of
     # charges is less than or equal to 2.
-    elif dp <= 1000 and abs(n) <= 2:
-        if n == -2:
-            a = [-26.3328, 35.9044, -21.4608, 7.0867, -1.3088, 0.1051]
-
-        elif n == -1:
-            a = [-2.3197, 0.6175, 0.6201, -0.1105, -0.1260, 0.0297]
-        elif n == 0:
-            a = [-0.0003, -0.1014, 0.3073, -0.3372, 0.1023, -0.0105]
-        elif n == 1:
-
-            #  a[4] has been modified from the original publication
-            a = [-2.3484, 0.6044, 0.4800, 0.0013, -0.1553, 0.0320]
-        elif n == 2:
-
-            # a[5] has been modified from original publication
-            a = [-44.4756, 79.3772, -62.8900, 26.4492, -5.7480, 0.5049]
-
-        power = 0
-
-        for i, e in enumerate(a):
-            power += e*log10(dp)**i
-
-        return 10**power
+    wiedensohler = ~zero & (dp <= 1000) & (n_abs <= 2)
+    if np.any(wiedensohler):
+        a = _wiedensohler_coefficients[n[wiedensohler].astype(int) + 2]
+        log_dp = np.log10(dp[wiedensohler])
+        power = np.zeros(log_dp.shape)
+        for i in range(a.shape[1]):
+            power += a[:, i]*log_dp**i
+        out[wiedensohler] = 10**power
 
     # Use Gunn if the particle size is > 1 micron or the number of charges is > 2
-    else:
-
+    gunn = ~zero & ~wiedensohler
+    if np.any(gunn):
         #  convert [°C] to [K]
-        t += 273.15
+        tk = t[gunn] + 273.15
 
         # convert [nm] to [m]
-        dp *= 1e-9
+        dm = dp[gunn] * 1e-9
 
         # ratio of positive and negative ion concentrations
         ionconcrat = 1
@@ -185,9 +259,33 @@ def ndistr(dp, n=-1, t=20):
         # ratio of positive and negative ion mobilities
         ionmobrat = 0.875
 
-        f1 = constants.e / sqrt(4 * pi ** 2 * constants.eps0 * dp * constants.k * t)
-        f2 = 2*pi * constants.eps0 * dp * constants.k * t / constants.e ** 2
-        return f1*exp(-1*(n-f2*log(ionconcrat*ionmobrat))**2/(2*f2))
+        f1 = constants.e / np.sqrt(4 * pi ** 2 * constants.eps0 * dm * constants.k * tk)
+        f2 = 2*pi * constants.eps0 * dm * constants.k * tk / constants.e ** 2
+        out[gunn] = f1*np.exp(-1*(n[gunn]-f2*log(ionconcrat*ionmobrat))**2/(2*f2))
+
+    return _scalar_or_array(out)
+
+
+def charge_distribution(dp, charges=(-2, -1, 0, 1, 2), t=20):
+    """
+    Bipolar charge distribution for all diameters and charges at once.
+
+    Parameters
+    -----------
+    dp:         array-like
+                diameters in nm
+    charges:    array-like
+                numbers of charges
+    t:          float
+                temperature in degree C
+
+    Returns
+    --------
+    pandas DataFrame with the diameters as index and the charges as columns.
+    """
+    dp = np.atleast_1d(np.asarray(dp, dtype=float))
+    charges = np.atleast_1d(charges)
+    return pd.DataFrame(ndistr(dp[:, None], charges[None, :], t), index=dp, columns=charges)
 
 
 def d50(n, rhop, q, gas, dj):
@@ -230,4 +328,34 @@ def d50(n, rhop, q, gas, dj):
     f = lambda x: (d50cc/float(x))**2-cc(float(x*1e-6), gas)
     
     # Find the D50 of the impactor
-    return fsolve(f, 0.1)
\ No newline at end of file
+    return fsolve(f, 0.1)
+
+
+def benchmark(gas, no_of_diameters=1000000, no_of_loop_diameters=10000):
+    """
+    Compares the vectorized mobility (z), Cunningham correction (cc), and charge distribution (ndistr) of
+    no_of_diameters diameters to calling them in a loop. The loop is timed on no_of_loop_diameters diameters and
+    extrapolated.
+    """
+    import time
+    d = np.logspace(0, 4, no_of_diameters)
+    d_loop = d[::max(no_of_diameters // no_of_loop_diameters, 1)]
+    factor = float(d.shape[0]) / d_loop.shape[0]
+
+    charges = np.arange(-6, 7)
+    for name, vectorized, loop in (('z', lambda: z(d, gas, 1), lambda: [z(i, gas, 1) for i in d_loop]),
+                                   ('cc', lambda: cc(d, gas), lambda: [cc(i, gas) for i in d_loop]),
+                                   ('ndistr', lambda: ndistr(d, -1), lambda: [ndistr(i, -1) for i in d_loop]),
+                                   ('charge_distribution (%i charges)' % charges.shape[0],
+                                    lambda: ndistr(d[:, None], charges[None, :]),
+                                    lambda: [[ndistr(i, j) for j in charges] for i in d_loop])):
+        start = time.time()
+        vectorized()
+        time_vec = time.time() - start
+
+        start = time.time()
+        loop()
+        time_loop = (time.time() - start) * factor
+
+        print('%s: loop %.2f s (extrapolated), vectorized %.3f s, speedup: %.0f' % (name, time_loop, time_vec,
+                                                                                 time_loop / time_vec))
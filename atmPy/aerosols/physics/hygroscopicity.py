@@ -1,5 +1,4 @@
 import numpy as _np
-from scipy.optimize import fsolve as _fsolve
 from scipy.optimize import curve_fit as _curve_fit
 from scipy import signal as _signal
 import pandas as _pd
@@ -9,6 +8,7 @@ from atmPy.tools import math_functions as _math_functions
 from atmPy.tools import plt_tools as _plt_tools
 import matplotlib.pylab as _plt
 from  atmPy.aerosols.size_distribution import sizedistribution as _sizedistribution
+from atmPy.aerosols.physics import optical_properties as _optical_properties
 
 
 
@@ -83,9 +83,111 @@ def kappa_simple(k, RH, refractive_index = None, inverse = False):
     return out
 
 
-def kappa_from_fofrh_and_sizedist(f_of_RH, dist, wavelength, RH, verbose = False, f_of_RH_collumn = None):
+def _kappa_from_fofrh_grid(f_of_RH, dist, wavelength, gf_grid=None, xtol=1e-4, quantity='scattering',
+                           verbose=False):
+    """Growth factor for each row of dist at which the scattering (or extinction) coefficient increases by f_of_RH.
+
+    The scattering (or extinction) coefficient of all rows is calculated as a function of the growth factor on
+    gf_grid (growth by _growth_shift, the refractive index is that of the dry particles). The first grid interval in
+    which f(RH) is crossed is then narrowed down by bisection until it is smaller than xtol and the growth factor is
+    linearly interpolated within it. All rows are processed at once. Mie calculations are only done once for the bins of the
+    extended bin grid and the refractive indices (see optical_properties._RefractiveIndexInterpolation).
+
+    Parameters
+    ----------
+    f_of_RH: array
+        f(RH) for each row of dist
+    dist: SizeDist
+    wavelength: float
+        in nm
+    gf_grid: array, optional
+        Growth factors to start with, have to start with 1. Default: 1 to 2.5 in steps of 0.02.
+    xtol: float
+        Tolerance of the growth factor.
+    quantity: str ['scattering', 'extinction']
+        The optical quantity f_of_RH refers to.
+
+    Returns
+    -------
+    array: growth factors, NaN where f(RH) was not reached within gf_grid.
+    """
+    if isinstance(gf_grid, type(None)):
+        gf_grid = _np.linspace(1, 2.5, 76)
+    gf_grid = _np.asarray(gf_grid, dtype=float)
+    if gf_grid[0] != 1 or _np.any(_np.diff(gf_grid) <= 0):
+        raise ValueError('gf_grid has to be increasing and start with 1.')
+    if quantity not in ('scattering', 'extinction'):
+        raise ValueError("quantity has to be 'scattering' or 'extinction', not %s." % quantity)
+
+    sd = dist.convert2numberconcentration()
+    data = sd.data.values.astype(float)
+    no_rows = data.shape[0]
+    f_of_RH = _np.asarray(f_of_RH, dtype=float)
+
+    n = sd.parameters4reductions.refractive_index.value
+    if isinstance(n, type(None)):
+        raise ValueError('Refractive index is not specified. Set parameters4reductions.refractive_index.')
+    if type(n).__name__ == 'DataFrame':
+        n = n.iloc[:, 0].values
+    n = _np.broadcast_to(_np.asarray(n, dtype=_np.complex128), (no_rows,))
+
+    # all growth factors tried end up on the same extended bin grid, the Mie calculations are done once for it
+    _, bins_ext = _growth_shift(data[:1], sd.bins, gf_grid[-1:])
+    diam = ((bins_ext[1:] + bins_ext[:-1]) / 2.) / 1000.
+    valid = ~ _np.isnan(n)
+    n_interpolation = _optical_properties._RefractiveIndexInterpolation(diam, wavelength / 1000., n[valid],
+                                                                        noOfAngles=2)
+    weights = n_interpolation.node_weights(n).reshape(no_rows, -1)
+    cross = n_interpolation._sca if quantity == 'scattering' else n_interpolation._ext
+    scatt_cross = weights.dot(cross.reshape(weights.shape[1], -1))
+    scatt_cross[~ valid] = _np.nan
+
+    def scattering(gf):
+        grown, _ = _growth_shift(data, sd.bins, gf)
+        grown = _np.nan_to_num(grown)
+        return (grown * scatt_cross[:, :grown.shape[1]]).sum(axis=1)
+
+    scatt = _np.array([scattering(_np.full(no_rows, gf)) for gf in gf_grid]).transpose()
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        f_grid = scatt / scatt[:, :1]
+
+    # first crossing of f(RH) along the grid
+    reached = f_grid >= f_of_RH[:, _np.newaxis]
+    reached[:, 0] = False
+    upper = reached.argmax(axis=1)
+    ok = reached.any(axis=1) & (f_of_RH >= 1) & (scatt[:, 0] > 0)
+    rows = _np.arange(no_rows)
+    upper[~ ok] = 1
+    lo, hi = gf_grid[upper - 1], gf_grid[upper]
+    f_lo, f_hi = f_grid[rows, upper - 1], f_grid[rows, upper]
+
+    while (hi - lo).max() > xtol:
+        mid = (lo + hi) / 2.
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            f_mid = scattering(mid) / scatt[:, 0]
+        below = f_mid < f_of_RH
+        lo = _np.where(below, mid, lo)
+        f_lo = _np.where(below, f_mid, f_lo)
+        hi = _np.where(below, hi, mid)
+        f_hi = _np.where(below, f_hi, f_mid)
+        if verbose:
+            print('bisection, max. interval: %s' % (hi - lo).max())
+
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        gf = lo + (hi - lo) * (f_of_RH - f_lo) / (f_hi - f_lo)
+    gf = _np.where(f_hi == f_lo, lo, gf)
+    gf[~ ok] = _np.nan
+    return gf
+
+
+def kappa_from_fofrh_and_sizedist(f_of_RH, dist, wavelength, RH, verbose = False, f_of_RH_collumn = None,
+                                  gf_grid = None, xtol = 1e-4, quantity = 'scattering'):
     """
     Calculates kappa from f of RH and a size distribution.
+
+    f of RH is calculated from the scattering (or extinction, see quantity) coefficient for all rows at once on a grid of growth factors and
+    inverted by bisection (see _kappa_from_fofrh_grid). A day of 1-min data takes seconds.
+
     Parameters
     ----------
     f_of_RH: TimeSeries
@@ -96,27 +198,19 @@ def kappa_from_fofrh_and_sizedist(f_of_RH, dist, wavelength, RH, verbose = False
     column: string
         when f_of_RH has more than one collumn name the one to be used
     verbose: bool
+    gf_grid: array, optional
+        Growth factors from which the bisection starts.
+    xtol: float
+        Tolerance of the growth factor.
+    quantity: str ['scattering', 'extinction']
+        The optical quantity f_of_RH refers to. Default is 'scattering' (nephelometer measurements, e.g.
+        f_RH_scatt_2p of the ARM products). Earlier versions of this function always used the extinction
+        coefficient.
 
     Returns
     -------
     TimeSeries
     """
-
-    def minimize_this(gf, sr, f_rh_soll, ext, wavelength, verbose = False):
-        gf = float(gf)
-        sr_g = sr.apply_growth(gf, how='shift_bins')
-        sr_g_opt = sr_g.calculate_optical_properties(wavelength)
-        ext_g = sr_g_opt.extinction_coeff_sum_along_d.data.values[0][0]
-        f_RH = ext_g / ext
-        out = f_RH - f_rh_soll
-
-        if verbose:
-            print('test growhtfactor: %s'%gf)
-            print('f of RH soll/is: %s/%s'%(f_rh_soll,f_RH))
-            print('diviation from soll: %s'%out)
-            print('---------')
-        return out
-
     # make sure f_of_RH has only one collumn
     if f_of_RH.data.shape[1] > 1:
         if not f_of_RH_collumn:
@@ -125,56 +219,17 @@ def kappa_from_fofrh_and_sizedist(f_of_RH, dist, wavelength, RH, verbose = False
         else:
             f_of_RH = f_of_RH._del_all_columns_but(f_of_RH_collumn)
 
-    n_values = dist.data.shape[0]
-    gf_calc = _np.zeros(n_values)
-    kappa_calc = _np.zeros(n_values)
     f_of_RH_aligned = f_of_RH.align_to(dist)
-    for e in range(n_values):
-        frhsoll = f_of_RH_aligned.data.values[e][0]
-        if _np.isnan(frhsoll):
-            kappa_calc[e] = _np.nan
-            gf_calc[e]  = _np.nan
-            continue
-
-        if type(dist.index_of_refraction).__name__ == 'float':
-            ior = dist.index_of_refraction
-        else:
-            ior = dist.index_of_refraction.iloc[e][0]
-        if _np.isnan(ior):
-            kappa_calc[e] = _np.nan
-            gf_calc[e]  = _np.nan
-            continue
+    gf_calc = _kappa_from_fofrh_grid(f_of_RH_aligned.data.values[:, 0], dist, wavelength, gf_grid=gf_grid, xtol=xtol,
+                                     quantity=quantity, verbose=verbose)
+    kappa_calc = kappa_simple(gf_calc, RH, inverse=True)
 
-        sr = dist.copy()
-        sr.data = sr.data.iloc[[e],:]
-        sr.index_of_refraction = ior
-        sr_opt = sr.calculate_optical_properties(wavelength)
-        ext = sr_opt.extinction_coeff_sum_along_d.data.values[0][0]
-
-
-        if ext == 0:
-            kappa_calc[e] = _np.nan
-            gf_calc[e]  = _np.nan
-            continue
-
-        if verbose:
-            print('goal for f_rh: %s'%frhsoll)
-            print('=======')
-
-        gf_out = _fsolve(minimize_this, 1, args = (sr, frhsoll, ext, wavelength, verbose), factor=0.5, xtol = 0.005)
-        gf_calc[e] = gf_out
-
-        if verbose:
-            print('resulting gf: %s'%gf_out)
-            print('=======\n')
-
-        kappa_calc[e] = kappa_simple(gf_out, RH, inverse=True)
     ts_kappa = _timeseries.TimeSeries(_pd.DataFrame(kappa_calc, index = f_of_RH_aligned.data.index, columns= ['kappa']))
     ts_kappa._data_period = f_of_RH_aligned._data_period
     ts_kappa._y_label = '$\kappa$'
 
     ts_gf = _timeseries.TimeSeries(_pd.DataFrame(gf_calc, index = f_of_RH_aligned.data.index, columns= ['growth factor']))
-    ts_kappa._data_period = f_of_RH_aligned._data_period
+    ts_gf._data_period = f_of_RH_aligned._data_period
     ts_gf._y_label = 'growth factor$'
     return ts_kappa, ts_gf
 
@@ -593,77 +648,93 @@ def calc_mixing_state(growth_modes):
     return ms
 
 
-#### try to make this work with changin gf
-def apply_growth2sizedist(sd, gf):
-    def apply_growth_factor_gf_const(data, gf, bins):
-        if gf == 1.:
-            return data.copy(), bins.copy()
-        if _np.isnan(gf):
-            data = data.copy()
-            data.iloc[:, :] = _np.nan
-            return data, bins.copy()
-
-        gfp = gf - 1
-        width = bins[1:] - bins[:-1]
-        widthlog = _np.log10(bins[1:]) - _np.log10(bins[:-1])
-        width_in_percent_of_low_bin_edge = width / bins[:-1]
-        no_extra_bins = int(_np.ceil(gfp / width_in_percent_of_low_bin_edge[-1]))
-
-        # new / extra bins
-        extra_bins = _np.zeros(no_extra_bins)
-        extra_bins[:] = widthlog[-1]
-        extra_bins = extra_bins.cumsum()
-        extra_bins += _np.log10(bins[-1])
-        extra_bins = 10 ** extra_bins
-        bins_new = _np.append(bins, extra_bins)
-        # width_new = bins_new[1:] - bins_new[:-1]
-        # widthlog_new = _np.log10(bins_new[1:]) - _np.log10(bins_new[:-1])
-        # width_in_percent_of_low_bin_edge_extra_bins = width_new / bins_new[:-1]
-        bins_grown = bins_new * gf
-
-        i = no_extra_bins
-        while 1:
-            end = i - 1
-            if end == 0:
-                end = None
-            else:
-                end = -end
-            in_first_bin = (bins_new[i:] - bins_grown[:-i]) / (bins_grown[1:end] - bins_grown[:-i])
-            if _np.any(in_first_bin >= 1):
-                #             break
-                i -= 1
-                continue
-            else:
-                break
-        in_second_bin = (bins_grown[1:end] - bins_new[i:]) / (bins_grown[1:end] - bins_grown[:-i])
-        if _np.any(in_second_bin < 0):
-            txt = 'This should not be possible'
-            raise ValueError(txt)
+def _growth_shift(data, bins, gf):
+    """Shifts the number concentrations of all rows in data (rows x bins) according to the growth factor of each row.
 
-        # data with extra bins
-        bincenters_new = ((bins_new[1:] + bins_new[:-1]) / 2).astype(_np.float32)
-        bincenters = ((bins[1:] + bins[:-1]) / 2).astype(_np.float32) # depending how data was created (POPS, ARM, ...) the type
-        data.columns = bincenters                               # can vary between float32 and float64, this is to unify them.
-        df = _pd.DataFrame(columns=bincenters_new)
-        data = _pd.concat([df, data])
-
-        #######
-        # print('shape_data_new', data.shape)
-        # print('shape_data_slice', data.iloc[:, :end].values.shape)
-        # print('shape_firstb', in_first_bin.shape)
-        # print('+++++++++++')
-        ######
-        # shift and make new data
-        data_in_first_bin = data.iloc[:, :end].values * in_first_bin
-        data_in_second_bin = data.iloc[:, :end].values * in_second_bin
-        dffb = _pd.DataFrame(data_in_first_bin, columns=data.iloc[:, i - 1:].columns)
-        dfsb = _pd.DataFrame(data_in_second_bin[:, :-1], columns=data.iloc[:, i:].columns)
-        dffsb = dffb + dfsb
-        data_t = _pd.concat([df, dffsb])
-        data_new = _pd.DataFrame(data_t)
-        data_new.index = data.index
-        return data_new.astype(float), bins_new
+    Each grown bin [gf * b_k, gf * b_k+1] straddles one bin edge of the (extended) original bin grid; its content is
+    split between the two bins next to that edge in proportion to the overlap. All rows share the same extended grid
+    (the original bins plus as many log-equidistant extra bins as the largest growth factor requires), so the
+    redistribution of all rows is done at once: the overlap fractions form a band of two diagonals per row which is
+    applied with a single element-wise multiplication and a scatter into the extended grid.
 
+    As before, the lowest shifted bins, the part of the largest bin that ends up beyond the grid, and the part of
+    the smallest bin that ends up below the first filled bin are NaN/dropped. Rows with a growth factor of NaN are
+    NaN, rows with a growth factor of 1 are unchanged.
+
+    Parameters
+    ----------
+    data: 2D array
+        number concentrations (rows x bins)
+    bins: array
+        bin edges
+    gf: array
+        growth factor of each row
+
+    Returns
+    -------
+    data_new: 2D array (rows x bins of extended grid)
+    bins_new: array, the extended bin edges
+    """
+    data = _np.asarray(data, dtype=float)
+    gf = _np.asarray(gf, dtype=float)
+    no_bins = bins.shape[0] - 1
+    valid = ~ _np.isnan(gf)
+    if _np.any(gf[valid] < 1):
+        raise ValueError('Growth factors smaller than 1 (shrinking) are not supported.')
+
+    width = bins[1:] - bins[:-1]
+    widthlog = _np.log10(bins[1:]) - _np.log10(bins[:-1])
+    width_in_percent_of_low_bin_edge = width / bins[:-1]
+    no_extra_bins = _np.zeros(gf.shape, dtype=int)
+    no_extra_bins[valid] = _np.ceil((gf[valid] - 1) / width_in_percent_of_low_bin_edge[-1]).astype(int)
+    no_extra_max = no_extra_bins.max() if no_extra_bins.shape[0] else 0
+
+    # new / extra bins, common to all rows
+    extra_bins = _np.zeros(no_extra_max)
+    extra_bins[:] = widthlog[-1]
+    extra_bins = extra_bins.cumsum()
+    extra_bins += _np.log10(bins[-1])
+    extra_bins = 10 ** extra_bins
+    bins_new = _np.append(bins, extra_bins)
+
+    # Shift (in bins) of each row: the largest i <= no_extra_bins for which the edge bins_new[k + i] is below the
+    # upper edge of the grown bin k for all k (grown bins that reach into the extra bins included).
+    # max_ratio[i, e] is the smallest growth factor for which this holds, given e extra bins.
+    max_ratio = _np.full((no_extra_max + 1, no_extra_max + 1), _np.inf)
+    for e in range(1, no_extra_max + 1):
+        for i in range(1, e + 1):
+            k = _np.arange(no_bins + e - i + 1)
+            max_ratio[i, e] = (bins_new[k + i] / bins_new[k + 1]).max()
+    shift = _np.zeros(gf.shape, dtype=int)
+    for i in range(1, no_extra_max + 1):
+        shift = _np.where(valid & (i <= no_extra_bins) & (gf > max_ratio[i, no_extra_bins]), i, shift)
+
+    data_new = _np.full((data.shape[0], no_bins + no_extra_max), _np.nan)
+    grow = valid & (gf != 1)
+    unchanged = gf == 1
+    data_new[unchanged, :no_bins] = data[unchanged]
+
+    rows = _np.where(grow)[0]
+    if rows.shape[0]:
+        if _np.any(shift[rows] == 0):
+            raise ValueError('This should not be possible')
+        gfr = gf[rows][:, _np.newaxis]
+        sh = shift[rows][:, _np.newaxis]
+        k = _np.arange(no_bins)
+        lower = bins_new[k] * gfr
+        upper = bins_new[k + 1] * gfr
+        edge = bins_new[k + sh]
+        in_first_bin = (edge - lower) / (upper - lower)
+        in_second_bin = (upper - edge) / (upper - lower)
+
+        # the band: new bin k + shift receives the upper part of grown bin k and the lower part of grown bin k + 1
+        values = data[rows, :-1] * in_second_bin[:, :-1] + data[rows, 1:] * in_first_bin[:, 1:]
+        columns = k[:-1] + sh
+        data_new[rows[:, _np.newaxis], columns] = values
+    return data_new, bins_new
+
+
+def apply_growth2sizedist(sd, gf):
     sd = sd.convert2numberconcentration()
 
     # ensure that gf is either float or ndarray
@@ -680,25 +751,26 @@ def apply_growth2sizedist(sd, gf):
         if unique.shape[0] == 1:
             gf = unique[0]
 
-    # if gf is still ndarray, loop through all gf
     if type(gf).__name__ == 'ndarray':
         # ensure that length is correct
         if gf.shape[0] != sd.data.shape[0]:
             txt = 'length of growhfactor (shape: {}) does not match that of the size distribution (shape: {}).'.format(
                 gf.shape, sd.data.shape)
             raise ValueError(txt)
-        data_new_list = []
-        bins_list = []
-        for e, gfs in enumerate(gf):
-            data_new, bins_new = apply_growth_factor_gf_const(sd.data.iloc[[e], :], gfs, sd.bins)
-            data_new_list.append(data_new)
-            bins_list.append(bins_new)
-
-        bins_list.sort(key=lambda x: x.max())
-        bins_new = bins_list[-1]
-        data_new = _pd.concat(data_new_list)
+        data_new, bins_new = _growth_shift(sd.data.values, sd.bins, gf)
+    elif gf == 1. or _np.isnan(gf):
+        data_new = sd.data.copy()
+        if _np.isnan(gf):
+            data_new.iloc[:, :] = _np.nan
+        bins_new = sd.bins.copy()
     else:
-        data_new, bins_new = apply_growth_factor_gf_const(sd.data, gf, sd.bins)
+        data_new, bins_new = _growth_shift(sd.data.values, sd.bins, _np.full(sd.data.shape[0], gf))
+
+    if not isinstance(data_new, _pd.DataFrame):
+        # depending how data was created (POPS, ARM, ...) the type of the bincenters can vary between float32 and
+        # float64, this is to unify them.
+        bincenters_new = ((bins_new[1:] + bins_new[:-1]) / 2).astype(_np.float32)
+        data_new = _pd.DataFrame(data_new, index=sd.data.index, columns=bincenters_new)
 
     if type(sd).__name__ == "SizeDist_LS":
         sd_grown = type(sd)(data_new, bins_new, 'numberConcentration', sd.layerbounderies)
@@ -8,10 +8,14 @@ from atmPy.aerosols.size_distribution import moments as _sizedist_moment_convers
 from atmPy.general import timeseries as _timeseries
 from atmPy.general import vertical_profile as _vertical_profile
 from atmPy.radiation.mie_scattering import bhmie as _bhmie
+from atmPy.radiation.mie_scattering import mie_cache as _mie_cache
+from atmPy.radiation.mie_scattering import mie_kernels as _mie_kernels
 # import atmPy.aerosols.size_distribution.sizedistribution as _sizedistribution
 from  atmPy.aerosols.size_distribution import sizedistribution as _sizedistribution
 import warnings as _warnings
 
+from netCDF4 import Dataset as _Dataset
+
 
 # Todo: Docstring is wrong
 # todo: This function can be sped up by breaking it apart. Then have OpticalProperties
@@ -50,6 +54,7 @@ def size_dist2optical_properties(op, sd, aod=False, noOfAngles=100):
     sd.parameters4reductions._check_opt_prop_param_exist()
     wavelength = sd.parameters4reductions.wavelength.value
     n = sd.parameters4reductions.refractive_index.value
+    core = _get_core(sd)
     out = {}
     sdls = sd.convert2numberconcentration()
     index = sdls.data.index
@@ -63,65 +68,90 @@ def size_dist2optical_properties(op, sd, aod=False, noOfAngles=100):
         n_multi = True
     else:
         n_multi = False
+    diam = _np.array(sdls.bincenters / 1000.)
     if not n_multi:
-        mie, angular_scatt_func = _perform_Miecalculations(_np.array(sdls.bincenters / 1000.), wavelength / 1000., n,
-                                                           noOfAngles=noOfAngles)
+        mie, angular_scatt_func = _perform_Miecalculations(diam, wavelength / 1000., n, noOfAngles=noOfAngles,
+                                                           core=core)
+        n_interpolation = None
+    else:
+        tolerance = sd.parameters4reductions.refractive_index_interpolation.value
+        if tolerance and core:
+            _warnings.warn('Refractive index interpolation is not available for coated particles and is ignored.')
+        if tolerance and not core:
+            n_interpolation = _RefractiveIndexInterpolation(diam, wavelength / 1000., n.iloc[:, 0].values,
+                                                            dist=sdls.data.values, noOfAngles=noOfAngles,
+                                                            tolerance=tolerance)
+            out['refractive_index_interpolation_error'] = n_interpolation.max_interpolation_error
+        else:
+            n_interpolation = None
+
+    # Each contribution consists of the rows it applies to, their weights (None if all are 1) and the Mie results
+    # (crossections in um^2, angular scattering function bins x angles). The rows of a contribution are reduced with
+    # matrix products rather than one by one, so the cost scales with the number of rows, not with the number of
+    # contributions times the number of rows.
+    if not n_multi:
+        angles = angular_scatt_func.index.values
+        contributions = [(slice(None), None, mie.extinction_crossection.values,
+                          mie.scattering_crossection.values, angular_scatt_func.values.transpose())]
+        n_invalid = _np.zeros(index.shape[0], dtype=bool)
+    else:
+        n_values = n.iloc[:, 0].values.astype(_np.complex128)
+        n_invalid = _np.isnan(n_values)
+        if n_interpolation is not None:
+            angles = n_interpolation.angles
+            contributions = n_interpolation.contributions(n_values)
+        else:
+            contributions = []
+            for n_unique, rows in _group_rows(n_values):
+                mie, angular_scatt_func = _perform_Miecalculations(diam, wavelength / 1000., n_unique,
+                                                                   noOfAngles=noOfAngles, core=core)
+                contributions.append((rows, None, mie.extinction_crossection.values,
+                                      mie.scattering_crossection.values, angular_scatt_func.values.transpose()))
+            if len(contributions) == 0:
+                raise ValueError('All refractive indices are NaN.')
+            angles = angular_scatt_func.index.values
+
+    dist = sdls.data.values
+    dist_nonan = _np.nan_to_num(dist) # like pandas' sum, NaNs are skipped in the sums over the bins
+    extCoeffPerLayer = _np.zeros(dist.shape)
+    scattCoeffPerLayer = _np.zeros(dist.shape)
+    absCoeffPerLayer = _np.zeros(dist.shape)
+    scattering_cross_eff = _np.zeros(dist.shape[0])
+    pfe = _np.zeros((dist.shape[0], angles.shape[0]))  # sum of all angular_scattering_intensities
+    for rows, weights, ext_cross, sca_cross, asf in contributions:
+        dist_rows = dist[rows]
+        dist_weighted = dist_nonan[rows]
+        if weights is not None:
+            dist_rows = dist_rows * weights[:, _np.newaxis]
+            dist_weighted = dist_weighted * weights[:, _np.newaxis]
+        cn = dist_rows * 1e6  # conversion from cm^-3 to m^-3
+        extCoeffPerLayer[rows] += cn * (ext_cross * 1e-12)  # conversion from um^2 to m^2
+        scattCoeffPerLayer[rows] += cn * (sca_cross * 1e-12)
+        absCoeffPerLayer[rows] += cn * ((ext_cross - sca_cross) * 1e-12)
+        scattering_cross_eff[rows] += dist_weighted.dot(sca_cross)
+        pfe[rows] += dist_weighted.dot(asf)
+    extCoeffPerLayer[n_invalid] = _np.nan
+    scattCoeffPerLayer[n_invalid] = _np.nan
+    absCoeffPerLayer[n_invalid] = _np.nan
+
+    # limit to [0,pi]
+    x_1p = angles[angles < _np.pi]
+    y_1p = pfe[:, angles < _np.pi]
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        y_phase_func = y_1p * 4 * _np.pi / scattering_cross_eff[:, _np.newaxis]
+    asymmetry_parameter_LS = .5 * _integrate.simps(_np.cos(x_1p) * y_phase_func * _np.sin(x_1p), x_1p, axis=1)
 
     if aod:
         #todo: use function that does a the interpolation instead of the sum?!? I guess this can lead to errors when layers are very thick, since centers are used instea dof edges?
-        AOD_layer = _np.zeros((len(sdls.layercenters)))
-
-    extCoeffPerLayer = _np.zeros((len(sdls.data.index.values), len(sdls.bincenters)), dtype= _np.float32)
-    scattCoeffPerLayer = _np.zeros((len(sdls.data.index.values), len(sdls.bincenters)), dtype= _np.float32)
-    absCoeffPerLayer = _np.zeros((len(sdls.data.index.values), len(sdls.bincenters)), dtype= _np.float32)
-
-    angular_scatt_func_effective = _pd.DataFrame()
-    asymmetry_parameter_LS = _np.zeros((len(sdls.data.index.values)))
-
-    #calculate optical properties for each line in the dataFrame
-    for i, lc in enumerate(sdls.data.index.values):
-        laydata = sdls.data.iloc[i].values # picking a size distribution (either a layer or a point in time)
-
-        if n_multi:
-            mie, angular_scatt_func = _perform_Miecalculations(_np.array(sdls.bincenters / 1000.), wavelength / 1000., n.iloc[i].values[0],
-                                                               noOfAngles=noOfAngles)
-        extinction_coefficient = _get_coefficients(mie.extinction_crossection, laydata)
-        scattering_coefficient = _get_coefficients(mie.scattering_crossection, laydata)
-        absorption_coefficient = _get_coefficients(mie.absorption_crossection, laydata)
-
-        if aod:
-            layerThickness = sdls.layerbounderies[i][1] - sdls.layerbounderies[i][0]
-            AOD_perBin = extinction_coefficient * layerThickness
-            AOD_layer[i] = AOD_perBin.values.sum()
-
-        extCoeffPerLayer[i] = extinction_coefficient
-        scattCoeffPerLayer[i] = scattering_coefficient
-        absCoeffPerLayer[i] = absorption_coefficient
-
-        scattering_cross_eff = laydata * mie.scattering_crossection
-
-        pfe = (laydata * angular_scatt_func).sum(axis=1)  # sum of all angular_scattering_intensities
-
-        x_2p = pfe.index.values
-        y_2p = pfe.values
-
-        # limit to [0,pi]
-        y_1p = y_2p[x_2p < _np.pi]
-        x_1p = x_2p[x_2p < _np.pi]
-
-        y_phase_func = y_1p * 4 * _np.pi / scattering_cross_eff.sum()
-        asymmetry_parameter_LS[i] = .5 * _integrate.simps(_np.cos(x_1p) * y_phase_func * _np.sin(x_1p), x_1p)
-        angular_scatt_func_effective[
-            lc] = pfe * 1e-12 * 1e6  # equivalent to extCoeffPerLayer # similar to  _get_coefficients (converts everthing to meter)
-
-    if aod:
+        layerThickness = _np.array([lb[1] - lb[0] for lb in sdls.layerbounderies])
+        AOD_layer = (extCoeffPerLayer * layerThickness[:, _np.newaxis]).sum(axis=1)
         out['AOD'] = AOD_layer[~ _np.isnan(AOD_layer)].sum()
         out['AOD_layer'] = _pd.DataFrame(AOD_layer, index=sdls.layercenters, columns=['AOD per Layer'])
         out['AOD_cum'] = out['AOD_layer'].iloc[::-1].cumsum().iloc[::-1]
 
-    extCoeff_perrow_perbin = _pd.DataFrame(extCoeffPerLayer, index=index, columns=sdls.data.columns)
-    scattCoeff_perrow_perbin = _pd.DataFrame(scattCoeffPerLayer, index=index, columns=sdls.data.columns)
-    absCoeff_perrow_perbin = _pd.DataFrame(absCoeffPerLayer, index=index, columns=sdls.data.columns)
+    extCoeff_perrow_perbin = _pd.DataFrame(extCoeffPerLayer.astype(_np.float32), index=index, columns=sdls.data.columns)
+    scattCoeff_perrow_perbin = _pd.DataFrame(scattCoeffPerLayer.astype(_np.float32), index=index, columns=sdls.data.columns)
+    absCoeff_perrow_perbin = _pd.DataFrame(absCoeffPerLayer.astype(_np.float32), index=index, columns=sdls.data.columns)
 
     # if dist_class == 'SizeDist_TS':
     #     out['extCoeff_perrow_perbin'] = timeseries.TimeSeries_2D(extCoeff_perrow_perbin)
@@ -144,8 +174,250 @@ def size_dist2optical_properties(op, sd, aod=False, noOfAngles=100):
     out['bins'] = sdls.bins
     out['binwidth'] = sdls.binwidth
     out['distType'] = sdls.distributionType
-    out['angular_scatt_func'] = angular_scatt_func_effective.transpose()
+    angular_scatt_func_effective = _pd.DataFrame(pfe * 1e-12 * 1e6, index=index.values, columns=angles)  # similar to  _get_coefficients (converts everthing to meter)
+    angular_scatt_func_effective.columns.name = 'angle'
+    out['angular_scatt_func'] = angular_scatt_func_effective
+
+    return out
+
+def _group_rows(n_values):
+    """Yields each unique (not NaN) refractive index and the indices of the rows that have it. The rows are grouped
+    with a single sort, so this scales with the number of rows, not with the number of unique values times rows."""
+    valid_rows = _np.flatnonzero(~ _np.isnan(n_values))
+    n_uniques, inverse = _np.unique(n_values[valid_rows], return_inverse=True)
+    order = _np.argsort(inverse, kind='stable')
+    row_groups = _np.split(valid_rows[order], _np.flatnonzero(_np.diff(inverse[order])) + 1)
+    return zip(n_uniques, row_groups)
+
+
+def size_dist2optical_properties_streaming(sd, fname, chunksize=86400, noOfAngles=100):
+    """
+    Same as size_dist2optical_properties for a SizeDist_TS, but the distribution is processed in chunks of rows. Per
+    bin coefficients and the angular scattering function of each chunk are appended to a netCDF file, so they never
+    need to be in memory all at once. Only the integrated coefficients, the asymmetry parameter, and the hemispheric
+    back and forward scattering are returned.
+
+    Parameters
+    ----------
+    sd: SizeDist_TS
+    fname: str
+        netCDF file the per bin and angular results are written to. An existing file is overwritten.
+    chunksize: int
+        Number of rows processed at once.
+    noOfAngles: int, optional.
+        Number of scattering angles to be calculated.
+
+    Returns
+    -------
+    dict
+        In addition to the integrated values, the keys 'extCoeff_perrow_perbin', 'scattCoeff_perrow_perbin',
+        'absCoeff_perrow_perbin', and 'angular_scatt_func' hold OpticalPropertiesStoreVariable instances that read the
+        respective variable from fname on demand.
+    """
+    sd.parameters4reductions._check_opt_prop_param_exist()
+    wavelength = sd.parameters4reductions.wavelength.value
+    n = sd.parameters4reductions.refractive_index.value
+    interpolation = sd.parameters4reductions.refractive_index_interpolation.value
+    chunksize = int(chunksize)
+    no_rows = sd.data.shape[0]
+
+    results = {'ext_coeff_m^1': [], 'scatt_coeff_m^1': [], 'abs_coeff_m^1': [], 'asymmetry_param': [],
+               'hem_back_scatt': [], 'hem_forward_scatt': []}
+    interpolation_error = None
+    variables = (('extCoeff_perrow_perbin', 'bin_centers'),
+                 ('scattCoeff_perrow_perbin', 'bin_centers'),
+                 ('absCoeff_perrow_perbin', 'bin_centers'),
+                 ('angular_scatt_func', 'angle'))
+
+    ni = _Dataset(fname, 'w')
+    try:
+        for start in range(0, no_rows, chunksize):
+            end = min(start + chunksize, no_rows)
+            chunk = _sizedistribution.SizeDist_TS(sd.data.iloc[start:end], sd.bins, sd.distributionType)
+            chunk.parameters4reductions.wavelength = wavelength
+            if isinstance(n, _pd.DataFrame):
+                chunk.parameters4reductions.refractive_index = n.iloc[start:end]
+            else:
+                chunk.parameters4reductions.refractive_index = n
+            chunk.parameters4reductions.refractive_index_interpolation = interpolation
+            chunk.parameters4reductions.refractive_index_core = sd.parameters4reductions.refractive_index_core.value
+            chunk.parameters4reductions.core_diameter_fraction = sd.parameters4reductions.core_diameter_fraction.value
+            out = size_dist2optical_properties(None, chunk, noOfAngles=noOfAngles)
+
+            if start == 0:
+                ni.createDimension('time', None)
+                ni.createDimension('bin_centers', out['extCoeff_perrow_perbin'].shape[1])
+                ni.createDimension('angle', out['angular_scatt_func'].shape[1])
+                time_var = ni.createVariable('time', _np.int64, 'time')
+                time_var.units = 'nanoseconds since 1970-01-01 00:00:00'
+                if chunk.data.index.name:
+                    time_var.index_name = chunk.data.index.name
+                ni.createVariable('bin_centers', _np.float64, 'bin_centers')[:] = \
+                    out['extCoeff_perrow_perbin'].columns.values.astype(float)
+                ni.createVariable('angle', _np.float64, 'angle')[:] = out['angular_scatt_func'].columns.values
+                for var, dim in variables:
+                    ni.createVariable(var, out[var].values.dtype, ('time', dim), chunksizes=(
+                        min(chunksize, 4096), out[var].shape[1]))
+                ni.wavelength = wavelength
+                ni._type = 'OpticalProperties_TS'
+
+            ni.variables['time'][start:end] = chunk.data.index.values.astype('datetime64[ns]').astype(_np.int64)
+            for var, dim in variables:
+                ni.variables[var][start:end, :] = out[var].values
+
+            results['ext_coeff_m^1'].append(out['extCoeff_perrow_perbin'].sum(axis=1))
+            results['scatt_coeff_m^1'].append(out['scattCoeff_perrow_perbin'].sum(axis=1))
+            results['abs_coeff_m^1'].append(out['absCoeff_perrow_perbin'].sum(axis=1))
+            results['asymmetry_param'].append(out['asymmetry_param'].iloc[:, 0])
+            results['hem_back_scatt'].append(hemispheric_backscattering(out['angular_scatt_func']).iloc[:, 0])
+            results['hem_forward_scatt'].append(hemispheric_forwardscattering(out['angular_scatt_func']).iloc[:, 0])
+            if 'refractive_index_interpolation_error' in out:
+                interpolation_error = max(interpolation_error or 0, out['refractive_index_interpolation_error'])
+    finally:
+        ni.close()
+
+    out = {}
+    for key in results:
+        if key.startswith('hem_'):
+            # same column name as returned by hemispheric_backscattering
+            out[key] = _pd.concat(results[key]).to_frame()
+        else:
+            out[key] = _pd.concat(results[key]).to_frame(key)
+    for var, dim in variables:
+        out[var] = OpticalPropertiesStoreVariable(fname, var)
+    if interpolation_error is not None:
+        out['refractive_index_interpolation_error'] = interpolation_error
+    out['parent_type'] = 'SizeDist_TS'
+    out['wavelength'] = wavelength
+    out['index_of_refraction'] = n
+    out['bin_centers'] = sd.bincenters
+    out['bins'] = sd.bins
+    out['binwidth'] = sd.binwidth
+    out['distType'] = 'numberConcentration'
+    out['store'] = fname
+    return out
+
+def _spectral_kernels(diam, wavelengths, n, noOfAngles=100, core=None):
+    """Extinction and scattering crossections (wavelengths x bins, in um^2) for all wavelengths in a single batch."""
+    x = 2. * _np.pi * (diam / 2.)[_np.newaxis, :] / wavelengths[:, _np.newaxis]
+    if core:
+        values = _mie_cache.bhcoat_cached(x.ravel() * core[1], x.ravel(), core[0], n, noOfAngles,
+                                          diameter=_np.tile(diam, wavelengths.shape[0]))
+    else:
+        values = _mie_cache.bhmie_cached(x.ravel(), n, noOfAngles, diameter=_np.tile(diam, wavelengths.shape[0]))
+    ext = values['extinction_crosssection'].reshape(x.shape)
+    sca = values['scattering_crosssection'].reshape(x.shape)
+    return ext, sca
 
+
+def size_dist2spectral_optical_properties(sd, wavelengths, noOfAngles=100):
+    """Extinction, scattering, and absorption coefficients at several wavelengths.
+
+    The Mie calculations for all wavelengths are done in one batch (see mie_cache), the coefficients of all rows
+    follow from a (rows x bins) @ (bins x wavelengths) matrix product. The refractive index is taken from
+    sd.parameters4reductions.refractive_index; if it varies (DataFrame) rows are grouped by their refractive index,
+    or, if sd.parameters4reductions.refractive_index_interpolation is set, the Mie results are interpolated from a
+    grid of refractive indices for each wavelength (see _RefractiveIndexInterpolation).
+
+    Parameters
+    ----------
+    sd: SizeDist, SizeDist_TS, or SizeDist_LS
+    wavelengths: array-like
+        Wavelengths in nm.
+    noOfAngles: int, optional.
+
+    Returns
+    -------
+    dict with the keys 'extinction_coeff', 'scattering_coeff', and 'absorption_coeff', each a pandas DataFrame (rows x
+    wavelengths) in m^-1, and 'wavelengths'. With refractive index interpolation 'refractive_index_interpolation_error'
+    is the largest error estimate over all wavelengths.
+    """
+    sd.parameters4reductions._check_parameter_exists(parameters=['refractive_index'])
+    n = sd.parameters4reductions.refractive_index.value
+    core = _get_core(sd)
+    wavelengths = _np.atleast_1d(_np.asarray(wavelengths, dtype=float))
+    sdls = sd.convert2numberconcentration()
+    dist_class = type(sdls).__name__
+    if dist_class not in ['SizeDist','SizeDist_TS','SizeDist_LS']:
+        raise TypeError('this distribution class (%s) can not be converted into optical property yet!'%dist_class)
+
+    diam = _np.array(sdls.bincenters / 1000.)
+    # like the sum over the bins in OpticalProperties, NaNs are skipped
+    dist = _np.nan_to_num(sdls.data.values) * 1e6 * 1e-12  # conversion from cm^-3 to m^-3 and from um^2 to m^2
+    ext = _np.zeros((dist.shape[0], wavelengths.shape[0]))
+    sca = _np.zeros((dist.shape[0], wavelengths.shape[0]))
+    out = {}
+    if isinstance(n, _pd.DataFrame):
+        n_values = n.iloc[:, 0].values.astype(_np.complex128)
+        n_invalid = _np.isnan(n_values)
+        tolerance = sd.parameters4reductions.refractive_index_interpolation.value
+        if tolerance and core:
+            _warnings.warn('Refractive index interpolation is not available for coated particles and is ignored.')
+        if tolerance and not core:
+            errors = []
+            for e, wavelength in enumerate(wavelengths):
+                n_interpolation = _RefractiveIndexInterpolation(diam, wavelength / 1000., n_values, dist=dist,
+                                                                noOfAngles=noOfAngles, tolerance=tolerance)
+                errors.append(n_interpolation.max_interpolation_error)
+                for rows, weights, ext_cross, sca_cross, asf in n_interpolation.contributions(n_values):
+                    dist_weighted = dist[rows] * weights[:, _np.newaxis]
+                    ext[rows, e] += dist_weighted.dot(ext_cross)
+                    sca[rows, e] += dist_weighted.dot(sca_cross)
+            out['refractive_index_interpolation_error'] = max(errors)
+        else:
+            for n_unique, rows in _group_rows(n_values):
+                ext_cross, sca_cross = _spectral_kernels(diam, wavelengths / 1000., n_unique, noOfAngles=noOfAngles,
+                                                         core=core)
+                ext[rows] = dist[rows].dot(ext_cross.transpose())
+                sca[rows] = dist[rows].dot(sca_cross.transpose())
+        ext[n_invalid] = _np.nan
+        sca[n_invalid] = _np.nan
+    else:
+        ext_cross, sca_cross = _spectral_kernels(diam, wavelengths / 1000., n, noOfAngles=noOfAngles, core=core)
+        ext = dist.dot(ext_cross.transpose())
+        sca = dist.dot(sca_cross.transpose())
+
+    index = sdls.data.index
+    columns = _pd.Index(wavelengths, name='wavelength')
+    out['extinction_coeff'] = _pd.DataFrame(ext, index=index, columns=columns)
+    out['scattering_coeff'] = _pd.DataFrame(sca, index=index, columns=columns)
+    out['absorption_coeff'] = _pd.DataFrame(ext - sca, index=index, columns=columns)
+    out['wavelengths'] = wavelengths
+    return out
+
+
+def angstrom_exponent(coefficients):
+    """Angstrom exponent of each row, i.e. the negative slope of a linear least squares fit of log(coefficient) vs
+    log(wavelength). All rows are fitted at once.
+
+    Parameters
+    ----------
+    coefficients: pandas DataFrame
+        Rows x wavelengths, the column names giving the wavelengths (e.g. the extinction_coeff of
+        SpectralOpticalProperties).
+
+    Returns
+    -------
+    pandas DataFrame with the columns 'angstrom_exponent' and 'std_err' (standard error of the slope, NaN if there
+    are only two wavelengths). Rows with non-positive or NaN coefficients result in NaN.
+    """
+    wavelengths = coefficients.columns.values.astype(float)
+    if wavelengths.shape[0] < 2:
+        raise ValueError('At least two wavelengths are needed to calculate the Angstrom exponent.')
+    lx = _np.log(wavelengths)
+    lx = lx - lx.mean()
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        ly = _np.log(coefficients.values.astype(float))
+        ly = ly - ly.mean(axis=1)[:, _np.newaxis]
+        slope = ly.dot(lx) / (lx ** 2).sum()
+        if wavelengths.shape[0] > 2:
+            residuals = ly - slope[:, _np.newaxis] * lx
+            std_err = _np.sqrt((residuals ** 2).sum(axis=1) / (wavelengths.shape[0] - 2) / (lx ** 2).sum())
+        else:
+            std_err = _np.zeros(slope.shape) * _np.nan
+    slope[~ _np.isfinite(slope)] = _np.nan
+    out = _pd.DataFrame({'angstrom_exponent': -slope, 'std_err': std_err}, index=coefficients.index,
+                        columns=['angstrom_exponent', 'std_err'])
     return out
 
 def DEPRECATED_size_dist2optical_properties(sd, aod=False, noOfAngles=100):
@@ -308,26 +580,14 @@ def hemispheric_backscattering(osf_df):
     -------
     pandas data frame with the scattering intensities
     """
-    import pdb
-    # pdb.set_trace()
-    def ang_scat_funk2bs(index,ol):
-        x = index #_np.deg2rad(index)
-        f = ol
-        # pdb.set_trace()
-        # my phase function goes all the way to two py
-        f = f[x < _np.pi]
-        x = x[x < _np.pi]
-        f_b = f[x >= _np.pi / 2.]
-        x_b = x[x >= _np.pi / 2.]
-        # pdb.set_trace()
-        res_b = 2 * _np.pi * _integrate.simps(f_b * _np.sin(x_b), x_b)
-        return res_b
-
-    bs = _np.zeros(osf_df.shape[0])
-    index = osf_df.columns
-    for i in range(osf_df.shape[0]):
-        ol = osf_df.iloc[i,:].values
-        bs[i] = ang_scat_funk2bs(index,ol)
+    x = osf_df.columns.values.astype(float)
+    f = osf_df.values
+    # my phase function goes all the way to two py
+    f = f[:, x < _np.pi]
+    x = x[x < _np.pi]
+    f_b = f[:, x >= _np.pi / 2.]
+    x_b = x[x >= _np.pi / 2.]
+    bs = 2 * _np.pi * _integrate.simps(f_b * _np.sin(x_b), x_b, axis=1)
     bs = _pd.DataFrame(bs, index = osf_df.index)
     return bs
 
@@ -344,25 +604,14 @@ def hemispheric_forwardscattering(osf_df):
     -------
     pandas data frame with the scattering intensities
     """
-
-    def ang_scat_funk2fs(index,ol):
-        x = index #ol.index.values
-        f = ol
-
-        # my phase function goes all the way to two py
-        f = f[x < _np.pi]
-        x = x[x < _np.pi]
-        f_f = f[x < _np.pi / 2.]
-        x_f = x[x < _np.pi / 2.]
-
-        res_f = 2 * _np.pi * _integrate.simps(f_f * _np.sin(x_f), x_f)
-        return res_f
-
-    fs = _np.zeros(osf_df.shape[0])
-    index = osf_df.columns
-    for i in range(osf_df.shape[0]):
-        ol = osf_df.iloc[i,:].values
-        fs[i] = ang_scat_funk2fs(index,ol)
+    x = osf_df.columns.values.astype(float)
+    f = osf_df.values
+    # my phase function goes all the way to two py
+    f = f[:, x < _np.pi]
+    x = x[x < _np.pi]
+    f_f = f[:, x < _np.pi / 2.]
+    x_f = x[x < _np.pi / 2.]
+    fs = 2 * _np.pi * _integrate.simps(f_f * _np.sin(x_f), x_f, axis=1)
     fs = _pd.DataFrame(fs, index = osf_df.index)
     return fs
 
@@ -445,6 +694,16 @@ class OpticalProperties(object):
         self._optical_porperties
         return self._angular_scatt_func
 
+    @property
+    def asymmetry_param(self):
+        return self._optical_porperties['asymmetry_param']
+
+    @property
+    def refractive_index_interpolation_error(self):
+        """Max. relative error of the Mie results due to interpolating the refractive index (see
+        parameters.refractive_index_interpolation). None if no interpolation was performed."""
+        return self._optical_porperties.get('refractive_index_interpolation_error')
+
     @property
     def _optical_porperties(self):
         if not self._optical_porperties_pv:
@@ -530,6 +789,7 @@ class OpticalProperties(object):
 
     @property
     def hemispheric_backscattering(self):
+        self._optical_porperties
         if not _np.any(self._hemispheric_backscattering):
             self._hemispheric_backscattering = hemispheric_backscattering(self.angular_scatt_func)
             self._hemispheric_backscattering_ratio = _pd.DataFrame(
@@ -546,6 +806,7 @@ class OpticalProperties(object):
 
     @property
     def hemispheric_forwardscattering(self):
+        self._optical_porperties
         if not _np.any(self._hemispheric_forwardscattering):
             self._hemispheric_forwardscattering = hemispheric_forwardscattering(self.angular_scatt_func)
             self._hemispheric_forwardscattering_ratio = _pd.DataFrame(self._hemispheric_forwardscattering.iloc[:, 0] /  self._scattering_coeff.iloc[:, 0],
@@ -565,6 +826,37 @@ class OpticalProperties(object):
     def copy(self):
         return _deepcopy(self)
 
+    def mie_kernels(self, wavelengths, refractive_indices, workers=None, noOfAngles=100):
+        """Mie crossections and efficiencies of the size distribution's bins for all combinations of wavelengths and
+        refractive indices. The calculations are distributed over workers processes (see
+        atmPy.radiation.mie_scattering.mie_kernels.calculate_kernels).
+
+        Parameters
+        ----------
+        wavelengths: float or array-like
+            Wavelengths in nm.
+        refractive_indices: complex or array-like
+        workers: int, optional
+            Number of processes, defaults to the number of CPUs. Use 1 to calculate serially.
+
+        Returns
+        -------
+        dict of pandas DataFrames (wavelength x refractive_index x bin), one for each quantity. Crossections are in
+        um^2.
+        """
+        wavelengths = _np.atleast_1d(_np.asarray(wavelengths, dtype=float))
+        bincenters = _np.array(self._parent_sizedist.bincenters)
+        kernels = _mie_kernels.calculate_kernels(bincenters / 1000., wavelengths / 1000., refractive_indices,
+                                                 noOfAngles=noOfAngles, workers=workers)
+        # same order of the combinations as in calculate_kernels, but with the wavelengths in nm
+        index = _pd.MultiIndex.from_product([wavelengths,
+                                             _np.atleast_1d(_np.asarray(refractive_indices, dtype=_np.complex128))],
+                                            names=['wavelength', 'refractive_index'])
+        for kernel in kernels.values():
+            kernel.index = index
+            kernel.columns = bincenters
+        return kernels
+
 
 
 
@@ -719,7 +1011,121 @@ class DEPRECATEDOpticalProperties(object):
 
 
 
+class OpticalPropertiesStoreVariable(object):
+    """Lazy access to a variable (time x bins or time x angles) in a netCDF file written by
+    size_dist2optical_properties_streaming. Nothing is read until the variable is sliced along the time axis, either
+    by position or by time stamps (like DataFrame.loc, the end is included):
+
+    >>> opt.extinction_coeff_per_bin[:3600]
+    >>> opt.angular_scatt_func['2015-10-23 16:00:00':'2015-10-23 17:00:00']
+
+    Slicing returns a pandas DataFrame. Use load to get the entire variable.
+    """
+    def __init__(self, fname, variable):
+        self.fname = fname
+        self.variable = variable
+        self._index = None
+
+        ni = _Dataset(fname, 'r')
+        try:
+            var = ni.variables[variable]
+            self.shape = var.shape
+            self.dtype = var.dtype
+            self.columns = _pd.Index(ni.variables[var.dimensions[1]][:])
+            index_name = getattr(ni.variables['time'], 'index_name', None)
+        finally:
+            ni.close()
+        # same names as in the in-memory results
+        if variable == 'angular_scatt_func':
+            self.columns.name = 'angle'
+            self._index_name = None
+        else:
+            self._index_name = index_name
+
+    def __repr__(self):
+        return 'OpticalPropertiesStoreVariable: {} {} in {}'.format(self.variable, self.shape, self.fname)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def index(self):
+        """The time stamps (read from file on first access)"""
+        if isinstance(self._index, type(None)):
+            ni = _Dataset(self.fname, 'r')
+            try:
+                self._index = _pd.DatetimeIndex(_pd.to_datetime(ni.variables['time'][:].astype(_np.int64)),
+                                                name=self._index_name)
+            finally:
+                ni.close()
+        return self._index
+
+    def _time2position(self, key):
+        if not isinstance(key, slice):
+            raise IndexError('Only slices along the time axis are supported.')
+        start, stop = key.start, key.stop
+        if not isinstance(start, (type(None), int, _np.integer)):
+            start = self.index.searchsorted(_pd.Timestamp(start), side='left')
+        if not isinstance(stop, (type(None), int, _np.integer)):
+            stop = self.index.searchsorted(_pd.Timestamp(stop), side='right')
+        return slice(*slice(start, stop, key.step).indices(self.shape[0]))
+
+    def __getitem__(self, key):
+        key = self._time2position(key)
+        ni = _Dataset(self.fname, 'r')
+        try:
+            values = ni.variables[self.variable][key.start:key.stop:key.step]
+            time = ni.variables['time'][key.start:key.stop:key.step]
+        finally:
+            ni.close()
+        values = _np.ma.filled(values, _np.nan)
+        index = _pd.DatetimeIndex(_pd.to_datetime(_np.asarray(time).astype(_np.int64)), name=self._index_name)
+        return _pd.DataFrame(values, index=index, columns=self.columns)
+
+    def load(self):
+        """Reads the entire variable"""
+        return self[:]
+
+
 class OpticalProperties_TS(OpticalProperties):
+    """If parameters.streaming_store is set the optical properties are calculated chunk by chunk (see
+    size_dist2optical_properties_streaming). In that case the per bin coefficients and the angular scattering function
+    are OpticalPropertiesStoreVariable instances, which are loaded from the store when sliced."""
+
+    @property
+    def _optical_porperties(self):
+        store = self.parameters.streaming_store.value
+        if not store:
+            return super()._optical_porperties
+
+        if not self._optical_porperties_pv:
+            data = size_dist2optical_properties_streaming(self._parent_sizedist, store,
+                                                          chunksize=self.parameters.streaming_chunksize.value)
+            self._optical_porperties_pv = data
+
+            self._extinction_coeff_per_bin = data['extCoeff_perrow_perbin']
+            self._extinction_coeff = data['ext_coeff_m^1']
+            self._scattering_coeff_per_bin = data['scattCoeff_perrow_perbin']
+            self._scattering_coeff = data['scatt_coeff_m^1']
+            self._absorption_coeff_per_bin = data['absCoeff_perrow_perbin']
+            self._absorption_coeff = data['abs_coeff_m^1']
+            self._angular_scatt_func = data['angular_scatt_func']
+
+            # the hemispheric scattering has been integrated chunk by chunk since the angular scattering function is
+            # not in memory
+            self._hemispheric_backscattering = data['hem_back_scatt']
+            self._hemispheric_backscattering_ratio = _pd.DataFrame(
+                self._hemispheric_backscattering.iloc[:, 0] / self._scattering_coeff.iloc[:, 0],
+                columns=['hem_back_scatt_ratio'])
+            self._hemispheric_forwardscattering = data['hem_forward_scatt']
+            self._hemispheric_forwardscattering_ratio = _pd.DataFrame(
+                self._hemispheric_forwardscattering.iloc[:, 0] / self._scattering_coeff.iloc[:, 0],
+                columns=['hem_forward_scatt_ratio'])
+        return self._optical_porperties_pv
+
+    @property
+    def asymmetry_param(self):
+        return _timeseries.TimeSeries(super().asymmetry_param, sampling_period = self._parent_sizedist._data_period)
 
     @property
     def hemispheric_forwardscattering(self):
@@ -881,6 +1287,87 @@ class OpticalProperties_VP(OpticalProperties):
         self._optical_porperties
         return _vertical_profile.VerticalProfile(self._aod_cumulative)
 
+class SpectralOpticalProperties(object):
+    """Optical properties at several wavelengths (see size_dist2spectral_optical_properties). Calculations are done
+    on first access.
+
+    Parameters
+    ----------
+    parent: SizeDist instance
+    wavelengths: array-like
+        Wavelengths in nm.
+    """
+    def __init__(self, parent, wavelengths, noOfAngles=100):
+        self._parent_sizedist = parent
+        self.wavelengths = _np.atleast_1d(_np.asarray(wavelengths, dtype=float))
+        self.noOfAngles = noOfAngles
+        self._spectral_properties_pv = None
+        self._angstrom_exponents = {}
+
+    def _wrap(self, df):
+        return df
+
+    @property
+    def _spectral_properties(self):
+        if not self._spectral_properties_pv:
+            self._spectral_properties_pv = size_dist2spectral_optical_properties(self._parent_sizedist,
+                                                                                 self.wavelengths,
+                                                                                 noOfAngles=self.noOfAngles)
+        return self._spectral_properties_pv
+
+    def _angstrom_exponent(self, which):
+        if which not in self._angstrom_exponents:
+            self._angstrom_exponents[which] = angstrom_exponent(self._spectral_properties[which])
+        return self._wrap(self._angstrom_exponents[which])
+
+    @property
+    def extinction_coeff(self):
+        return self._wrap(self._spectral_properties['extinction_coeff'])
+
+    @property
+    def scattering_coeff(self):
+        return self._wrap(self._spectral_properties['scattering_coeff'])
+
+    @property
+    def absorption_coeff(self):
+        return self._wrap(self._spectral_properties['absorption_coeff'])
+
+    @property
+    def angstrom_exponent(self):
+        """Angstrom exponent of the extinction coefficient"""
+        return self._angstrom_exponent('extinction_coeff')
+
+    @property
+    def scattering_angstrom_exponent(self):
+        return self._angstrom_exponent('scattering_coeff')
+
+    @property
+    def absorption_angstrom_exponent(self):
+        return self._angstrom_exponent('absorption_coeff')
+
+
+class SpectralOpticalProperties_TS(SpectralOpticalProperties):
+    def _wrap(self, df):
+        return _timeseries.TimeSeries(df, sampling_period = self._parent_sizedist._data_period)
+
+
+class SpectralOpticalProperties_VP(SpectralOpticalProperties):
+    def _wrap(self, df):
+        return _vertical_profile.VerticalProfile(df)
+
+    @property
+    def aod(self):
+        """AOD (sum over all layers) as a function of wavelength"""
+        layerthickness = self._parent_sizedist.layerbounderies[:, 1] - self._parent_sizedist.layerbounderies[:, 0]
+        aod = self._spectral_properties['extinction_coeff'].multiply(layerthickness, axis=0).sum()
+        return _pd.DataFrame(aod, columns=['aod'])
+
+    @property
+    def aod_angstrom_exponent(self):
+        """Angstrom exponent of the AOD"""
+        return angstrom_exponent(self.aod.transpose()).iloc[0, 0]
+
+
 class DEPRECATED_OpticalProperties_VP(OpticalProperties):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -902,7 +1389,19 @@ class ExtinctionCoeffVerticlProfile(_vertical_profile.VerticalProfile):
         return a
 
 
-def _perform_Miecalculations(diam, wavelength, n, noOfAngles=100.):
+def _get_core(sd):
+    """Returns (refractive index of the core, core diameter fraction) if the parameters for coated particles are set,
+    else None."""
+    n_core = sd.parameters4reductions.refractive_index_core.value
+    core_fraction = sd.parameters4reductions.core_diameter_fraction.value
+    if isinstance(n_core, type(None)) and isinstance(core_fraction, type(None)):
+        return None
+    elif isinstance(n_core, type(None)) or isinstance(core_fraction, type(None)):
+        raise ValueError('For coated particles both, refractive_index_core and core_diameter_fraction, need to be set.')
+    return n_core, core_fraction
+
+
+def _perform_Miecalculations(diam, wavelength, n, noOfAngles=100., core=None):
     """
     Performs Mie calculations
 
@@ -913,7 +1412,13 @@ def _perform_Miecalculations(diam, wavelength, n, noOfAngles=100.):
     wavelength: float
                 Wavelength of light in um for which to perform calculations
     n:          complex
-                Ensemble complex index of refraction
+                Ensemble complex index of refraction (of the shell if core is given)
+    core:       tuple, optional
+                (refractive index of the core, core diameter / particle diameter) for coated particles
+
+    Note
+    ----
+    Results are taken from (and stored in) atmPy.radiation.mie_scattering.mie_cache.default_cache.
 
     Returns
         panda DataTable with the diameters as the index and the mie_scattering results in the different collumns
@@ -925,62 +1430,233 @@ def _perform_Miecalculations(diam, wavelength, n, noOfAngles=100.):
 
     diam = _np.asarray(diam)
 
-    extinction_efficiency = _np.zeros(diam.shape)
-    scattering_efficiency = _np.zeros(diam.shape)
-    absorption_efficiency = _np.zeros(diam.shape)
-
-    extinction_crossection = _np.zeros(diam.shape)
-    scattering_crossection = _np.zeros(diam.shape)
-    absorption_crossection = _np.zeros(diam.shape)
-
-    # phase_function_natural = pd.DataFrame()
-    angular_scattering_natural = _pd.DataFrame()
-    # extinction_coefficient = np.zeros(diam.shape)
-    # scattering_coefficient = np.zeros(diam.shape)
-    # absorption_coefficient = np.zeros(diam.shape)
-
-
-
     # Function for calculating the size parameter for wavelength l and radius r
     sp = lambda r, l: 2. * _np.pi * r / l
-    for e, d in enumerate(diam):
-        radius = d / 2.
-
-        # print('sp(radius, wavelength)', sp(radius, wavelength))
-        # print('n', n)
-        # print('d', d)
-
-        mie = _bhmie.bhmie_hagen(sp(radius, wavelength), n, noOfAngles, diameter=d)
-        values = mie.return_Values_as_dict()
-        extinction_efficiency[e] = values['extinction_efficiency']
-
-        # print("values['extinction_crosssection']",values['extinction_crosssection'])
+    x = sp(diam / 2., wavelength)
+    if core:
+        values = _mie_cache.bhcoat_cached(x * core[1], x, core[0], n, noOfAngles, diameter=diam)
+    else:
+        values = _mie_cache.bhmie_cached(x, n, noOfAngles, diameter=diam)
+    angles, natural = _bhmie.angular_scatt_func_vectorized(values, x)
 
+    angular_scattering_natural = _pd.DataFrame(natural.transpose(), index=angles, columns=diam)
+    angular_scattering_natural.index.name = 'angle'
 
-        scattering_efficiency[e] = values['scattering_efficiency']
-        absorption_efficiency[e] = values['extinction_efficiency'] - values['scattering_efficiency']
+    out = _pd.DataFrame(index=diam)
+    out['extinction_efficiency'] = _pd.Series(values['extinction_efficiency'], index=diam)
+    out['scattering_efficiency'] = _pd.Series(values['scattering_efficiency'], index=diam)
+    out['absorption_efficiency'] = _pd.Series(values['extinction_efficiency'] - values['scattering_efficiency'], index=diam)
 
-        extinction_crossection[e] = values['extinction_crosssection']
-        scattering_crossection[e] = values['scattering_crosssection']
-        absorption_crossection[e] = values['extinction_crosssection'] - values['scattering_crosssection']
+    out['extinction_crossection'] = _pd.Series(values['extinction_crosssection'], index=diam)
+    out['scattering_crossection'] = _pd.Series(values['scattering_crosssection'], index=diam)
+    out['absorption_crossection'] = _pd.Series(values['extinction_crosssection'] - values['scattering_crosssection'], index=diam)
+    return out, angular_scattering_natural
 
-        # phase_function_natural[d] = values['phaseFct_natural']['Phase_function_natural'].values
-        angular_scattering_natural[d] = mie.get_angular_scatt_func().natural.values
 
-        # print('\n')
+class _RefractiveIndexInterpolation(object):
+    """Mie results for a fixed set of diameters on a grid of refractive indices (real and imaginary part). Results
+    for arbitrary refractive indices within the grid are bilinearly interpolated.
 
-    # phase_function_natural.index = values['phaseFct_natural'].index
-    angular_scattering_natural.index = mie.get_angular_scatt_func().index
+    Mie results of individual particles show sharp resonances as a function of the refractive index, which no
+    reasonable grid resolves. Therefore, the interpolation error is assessed on what ends up in the results: the grid
+    is refined until the extinction and scattering coefficient and the angular scattering function of the test
+    distributions deviate less than tolerance from the exact Mie calculation. The test distributions are the rows of
+    dist whose refractive index is furthest away from the grid nodes.
 
-    out = _pd.DataFrame(index=diam)
-    out['extinction_efficiency'] = _pd.Series(extinction_efficiency, index=diam)
-    out['scattering_efficiency'] = _pd.Series(scattering_efficiency, index=diam)
-    out['absorption_efficiency'] = _pd.Series(absorption_efficiency, index=diam)
-
-    out['extinction_crossection'] = _pd.Series(extinction_crossection, index=diam)
-    out['scattering_crossection'] = _pd.Series(scattering_crossection, index=diam)
-    out['absorption_crossection'] = _pd.Series(absorption_crossection, index=diam)
-    return out, angular_scattering_natural
+    Parameters
+    ----------
+    diam: array-like
+        diameters in um
+    wavelength: float
+        wavelength in um
+    n_values: array-like
+        refractive indices that will be asked for later on, they define the extend of the grid
+    dist: 2D array, optional
+        number concentrations (rows x bins) that belong to n_values. If None the error is evaluated for a flat
+        distribution.
+    tolerance: float
+        relative tolerance
+    max_nodes: int
+        maximum number of nodes along each axis (real and imaginary part)
+    no_test: int
+        number of test distributions
+
+    Attributes
+    ----------
+    max_interpolation_error: float
+        The largest relative error found in the test distributions of the final grid.
+    """
+    def __init__(self, diam, wavelength, n_values, dist=None, noOfAngles=100, tolerance=1e-3, max_nodes=33,
+                 no_test=10):
+        self.diam = _np.asarray(diam, dtype=float)
+        self.wavelength = wavelength
+        self.noOfAngles = noOfAngles
+        self.tolerance = tolerance
+
+        n_values = _np.asarray(n_values, dtype=_np.complex128).ravel()
+        if isinstance(dist, type(None)):
+            dist = _np.ones((n_values.shape[0], self.diam.shape[0]))
+        dist = _np.nan_to_num(_np.asarray(dist, dtype=float))
+        valid = ~ _np.isnan(n_values) & (dist.sum(axis=1) > 0)
+        n_values = n_values[valid]
+        dist = dist[valid]
+        if n_values.shape[0] == 0:
+            raise ValueError('There are no rows with valid refractive indices and concentrations.')
+        limits_real = (n_values.real.min(), n_values.real.max())
+        limits_imag = (n_values.imag.min(), n_values.imag.max())
+
+        no_real = 1 if limits_real[0] == limits_real[1] else 3
+        no_imag = 1 if limits_imag[0] == limits_imag[1] else 3
+        self.n_real = _np.linspace(limits_real[0], limits_real[1], no_real)
+        self.n_imag = _np.linspace(limits_imag[0], limits_imag[1], no_imag)
+        self._ext, self._sca, self._asf = self._mie_on_grid(self.n_real[:, _np.newaxis] + 1j * self.n_imag)
+        while 1:
+            self.max_interpolation_error = self._estimate_error(n_values, dist, no_test)
+            if self.max_interpolation_error <= tolerance:
+                break
+            refine_real = 1 < no_real < max_nodes
+            refine_imag = 1 < no_imag < max_nodes
+            if not (refine_real or refine_imag):
+                txt = ('Interpolation of the refractive index did not reach the tolerance of {} (max. error: {}). '
+                       'Consider increasing max_nodes.').format(tolerance, self.max_interpolation_error)
+                _warnings.warn(txt)
+                break
+            self._refine(refine_real, refine_imag)
+            no_real, no_imag = self.n_real.shape[0], self.n_imag.shape[0]
+
+    def _refine(self, refine_real, refine_imag):
+        """Inserts a node in the middle of each interval of the refined axes. The old nodes become every other node of
+        the new grid, so Mie calculations are only done for the new nodes."""
+        def halve(nodes, refine):
+            if not refine:
+                return nodes, slice(None)
+            new = _np.empty(nodes.shape[0] * 2 - 1)
+            new[::2] = nodes
+            new[1::2] = (nodes[:-1] + nodes[1:]) / 2.
+            return new, slice(None, None, 2)
+
+        n_real, old_real = halve(self.n_real, refine_real)
+        n_imag, old_imag = halve(self.n_imag, refine_imag)
+        is_new = _np.ones((n_real.shape[0], n_imag.shape[0]), dtype=bool)
+        is_new[old_real, old_imag] = False
+        n_grid = n_real[:, _np.newaxis] + 1j * n_imag
+        new_results = self._mie_on_grid(n_grid[is_new])
+
+        tables = []
+        for old, new in zip((self._ext, self._sca, self._asf), new_results):
+            table = _np.empty(is_new.shape + old.shape[2:])
+            table[old_real, old_imag] = old
+            table[is_new] = new
+            tables.append(table)
+        self.n_real, self.n_imag = n_real, n_imag
+        self._ext, self._sca, self._asf = tables
+
+    def _mie_on_grid(self, n_grid):
+        n_grid = _np.asarray(n_grid)
+        x = 2. * _np.pi * (self.diam / 2.) / self.wavelength
+        x_all = _np.tile(x, n_grid.size)
+        values = _bhmie.bhmie_vectorized(x_all, _np.repeat(n_grid.ravel(), x.shape[0]), self.noOfAngles,
+                                         diameter=_np.tile(self.diam, n_grid.size))
+        self.angles, asf = _bhmie.angular_scatt_func_vectorized(values, x_all)
+        shape = n_grid.shape + x.shape
+        ext = values['extinction_crosssection'].reshape(shape)
+        sca = values['scattering_crosssection'].reshape(shape)
+        asf = asf.reshape(shape + (asf.shape[-1],))
+        return ext, sca, asf
+
+    def _estimate_error(self, n_values, dist, no_test):
+        """Compares the interpolated with the exact results for those distributions which refractive indices are
+        furthest away from the grid nodes."""
+        def distance2node(nodes, value):
+            if nodes.shape[0] == 1:
+                return _np.zeros(value.shape)
+            pos = (value - nodes[0]) / (nodes[1] - nodes[0])
+            return _np.abs(pos - _np.round(pos))
+
+        distance = distance2node(self.n_real, n_values.real) + distance2node(self.n_imag, n_values.imag)
+        if distance.max() == 0:
+            return 0.
+        test = _np.argsort(distance)[::-1][:no_test]
+        ext, sca, asf = self._mie_on_grid(n_values[test])
+
+        error = 0.
+        for e, t in enumerate(test):
+            ext_i, sca_i, asf_i = self._interpolate(n_values[t])
+            for interp, exact in ((ext_i, ext[e]), (sca_i, sca[e])):
+                exact = (dist[t] * exact).sum()
+                error = max(error, abs((dist[t] * interp).sum() - exact) / exact)
+            asf_exact = (dist[t][:, _np.newaxis] * asf[e]).sum(axis=0)
+            asf_interp = (dist[t][:, _np.newaxis] * asf_i).sum(axis=0)
+            error = max(error, _np.abs(asf_interp - asf_exact).max() / asf_exact.max())
+        return error
+
+    @staticmethod
+    def _bracket(nodes, value):
+        """Indices of the enclosing nodes and the weight of the lower one"""
+        if nodes.shape[0] == 1:
+            zeros = _np.zeros(_np.shape(value), dtype=int)
+            return zeros, zeros, _np.ones(_np.shape(value))
+        idx = _np.clip(_np.searchsorted(nodes, value) - 1, 0, nodes.shape[0] - 2)
+        w = (nodes[idx + 1] - value) / (nodes[idx + 1] - nodes[idx])
+        return idx, idx + 1, w
+
+    def _interpolate(self, n):
+        r0, r1, wr = self._bracket(self.n_real, n.real)
+        i0, i1, wi = self._bracket(self.n_imag, n.imag)
+        out = []
+        for table in (self._ext, self._sca, self._asf):
+            value = (wr * wi * table[r0, i0] + (1 - wr) * wi * table[r1, i0]
+                     + wr * (1 - wi) * table[r0, i1] + (1 - wr) * (1 - wi) * table[r1, i1])
+            out.append(value)
+        return out
+
+    def node_weights(self, n_values):
+        """Weights of the grid nodes in the bilinear interpolation of each refractive index in n_values.
+
+        Since the interpolation is linear in the Mie results, the interpolated result of a row equals the weighted
+        sum of the node results. Rows where n is NaN get zero weight.
+
+        Returns
+        -------
+        array of shape (len(n_values), len(n_real), len(n_imag))
+        """
+        n_values = _np.asarray(n_values, dtype=_np.complex128).ravel()
+        valid = ~ _np.isnan(n_values)
+        rows = _np.arange(n_values.shape[0])[valid]
+        r0, r1, wr = self._bracket(self.n_real, n_values.real[valid])
+        i0, i1, wi = self._bracket(self.n_imag, n_values.imag[valid])
+        weights = _np.zeros((n_values.shape[0], self.n_real.shape[0], self.n_imag.shape[0]))
+        _np.add.at(weights, (rows, r0, i0), wr * wi)
+        _np.add.at(weights, (rows, r1, i0), (1 - wr) * wi)
+        _np.add.at(weights, (rows, r0, i1), wr * (1 - wi))
+        _np.add.at(weights, (rows, r1, i1), (1 - wr) * (1 - wi))
+        return weights
+
+    def contributions(self, n_values):
+        """Yields (rows, row weights, extinction crossection, scattering crossection, angular scattering function) for
+        each grid node that contributes to any of the rows (see node_weights). rows are the indices of the rows with a
+        non-zero weight, so each row appears at most four times over all nodes."""
+        n_values = _np.asarray(n_values, dtype=_np.complex128).ravel()
+        no_rows = n_values.shape[0]
+        no_imag = self.n_imag.shape[0]
+        valid = ~ _np.isnan(n_values)
+        rows = _np.arange(no_rows)[valid]
+        r0, r1, wr = self._bracket(self.n_real, n_values.real[valid])
+        i0, i1, wi = self._bracket(self.n_imag, n_values.imag[valid])
+        nodes = _np.concatenate((r0 * no_imag + i0, r1 * no_imag + i0, r0 * no_imag + i1, r1 * no_imag + i1))
+        weights = _np.concatenate((wr * wi, (1 - wr) * wi, wr * (1 - wi), (1 - wr) * (1 - wi)))
+
+        # sum the weights of the same row and node (the brackets of a single node axis coincide), sorted by node
+        keys, inverse = _np.unique(nodes * no_rows + _np.tile(rows, 4), return_inverse=True)
+        weights = _np.bincount(inverse, weights=weights)
+        nonzero = weights != 0
+        keys, weights = keys[nonzero], weights[nonzero]
+        nodes, rows = keys // no_rows, keys % no_rows
+
+        bounds = _np.flatnonzero(_np.diff(nodes)) + 1
+        for start, end in zip(_np.concatenate(([0], bounds)), _np.concatenate((bounds, [nodes.shape[0]]))):
+            r, i = divmod(nodes[start], no_imag)
+            yield rows[start:end], weights[start:end], self._ext[r, i], self._sca[r, i], self._asf[r, i]
 
 
 def _get_coefficients(crossection, cn):
@@ -1035,4 +1711,45 @@ def vertical_profile2accumulative_AOD(timeseries):
     accu_aod = _vertical_profile.VerticalProfile(accu_aod)
 
     accu_aod._x_label = 'AOD$_{abs}$'
-    return accu_aod
\ No newline at end of file
+    return accu_aod
+
+def benchmark_reduction(no_of_rows=100000, no_of_rows_loop=1000, numberOfDiameters=60, noOfAngles=100):
+    """Times size_dist2optical_properties for a SizeDist_TS with no_of_rows rows and compares it to the row by row
+    reduction (as it was done before), which is timed for no_of_rows_loop rows and extrapolated."""
+    import time
+    sdtmp = _sizedistribution.simulate_sizedistribution(diameter=[15, 3000], numberOfDiameters=numberOfDiameters,
+                                                        centerOfAerosolMode=222, widthOfAerosolMode=0.18,
+                                                        numberOfParticsInMode=888)
+    scale = 1 + 0.5 * _np.sin(_np.linspace(0, 10 * _np.pi, no_of_rows))
+    data = _pd.DataFrame(sdtmp.data.values * scale[:, _np.newaxis],
+                         index=_pd.date_range('2015-10-23', periods=no_of_rows, freq='s'), columns=sdtmp.data.columns)
+    sd = _sizedistribution.SizeDist_TS(data, sdtmp.bins, sdtmp.distributionType)
+    sd.parameters4reductions.wavelength = 550
+    sd.parameters4reductions.refractive_index = 1.5 + 0.01j
+
+    # warm the Mie cache so only the reduction is timed
+    mie, angular_scatt_func = _perform_Miecalculations(_np.array(sd.bincenters / 1000.), 0.55, 1.5 + 0.01j,
+                                                       noOfAngles=noOfAngles)
+    start = time.time()
+    out = size_dist2optical_properties(None, sd, noOfAngles=noOfAngles)
+    time_matrix = time.time() - start
+
+    start = time.time()
+    sdls = sd.convert2numberconcentration()
+    angles = angular_scatt_func.index.values
+    for i in range(no_of_rows_loop):
+        laydata = sdls.data.iloc[i].values
+        extinction_coefficient = _get_coefficients(mie.extinction_crossection, laydata)
+        scattering_coefficient = _get_coefficients(mie.scattering_crossection, laydata)
+        absorption_coefficient = _get_coefficients(mie.absorption_crossection, laydata)
+        pfe = (laydata * angular_scatt_func).sum(axis=1)
+        y_phase_func = pfe.values[angles < _np.pi] * 4 * _np.pi / (laydata * mie.scattering_crossection).sum()
+        x_1p = angles[angles < _np.pi]
+        asym = .5 * _integrate.simps(_np.cos(x_1p) * y_phase_func * _np.sin(x_1p), x_1p)
+    time_loop = (time.time() - start) * no_of_rows / no_of_rows_loop
+
+    max_dev = abs(asym - out['asymmetry_param'].values[no_of_rows_loop - 1, 0]) / abs(asym)
+    print('row by row reduction (extrapolated): %.1f s' % time_loop)
+    print('matrix reduction: %.1f s (speedup: %.1f)' % (time_matrix, time_loop / time_matrix))
+    print('relative deviation of the asymmetry parameter: %s' % max_dev)
+    return time_loop, time_matrix
@@ -181,6 +181,38 @@ def get_settings():
                                      'unit': 'nm'},
                 'refractive_index': {'value': None,
                                      'default': None,},
+                'refractive_index_interpolation': {'value': None,
+                                                   'default': None,
+                                                   'unit': 'relative tolerance',
+                                                   'doc': ('Only relevant if the refractive index varies (e.g. a '
+                                                           'TimeSeries). If set to a tolerance (e.g. 1e-3) Mie '
+                                                           'results are calculated on a grid of refractive indices '
+                                                           'and interpolated for each row instead of doing the full '
+                                                           'Mie calculation for each row.')},
+                'refractive_index_core': {'value': None,
+                                          'default': None,
+                                          'unit': 'no unit',
+                                          'doc': ('Refractive index of the core of coated particles (e.g. black '
+                                                  'carbon, 1.95+0.79j). If this and core_diameter_fraction are set '
+                                                  'optical properties are calculated for coated spheres; '
+                                                  'refractive_index is then that of the shell.')},
+                'core_diameter_fraction': {'value': None,
+                                           'default': None,
+                                           'unit': 'no unit',
+                                           'doc': ('Ratio of the core diameter to the particle diameter (0-1) of '
+                                                   'coated particles, see refractive_index_core.')},
+                'streaming_store': {'value': None,
+                                    'default': None,
+                                    'unit': 'path',
+                                    'doc': ('Only relevant for SizeDist_TS. If set to a file name the optical '
+                                            'properties are calculated in chunks of streaming_chunksize rows. Per bin '
+                                            'coefficients and the angular scattering function are written to this '
+                                            'netCDF file and are loaded lazily; only integrated values are kept in '
+                                            'memory.')},
+                'streaming_chunksize': {'value': 86400,
+                                        'default': 86400,
+                                        'unit': 'rows',
+                                        'doc': 'Number of rows processed at once if streaming_store is set.'},
                 'particle_density': {'value': 1.8,
                                      'default': 1.8,
                                      'unit': 'g/cc',
@@ -466,6 +498,53 @@ class _Parameters4Reductions(object):
         self._reset_hygro()
         _Parameter(self, 'refractive_index')._set_value(n)
 
+    @property
+    def _prop_refractive_index_interpolation(self):
+        return _Parameter(self, 'refractive_index_interpolation')
+
+    @_prop_refractive_index_interpolation.setter
+    def _prop_refractive_index_interpolation(self, value):
+        self._reset_opt_prop()
+        _Parameter(self, 'refractive_index_interpolation')._set_value(value)
+
+    @property
+    def _prop_refractive_index_core(self):
+        return _Parameter(self, 'refractive_index_core')
+
+    @_prop_refractive_index_core.setter
+    def _prop_refractive_index_core(self, value):
+        self._reset_opt_prop()
+        _Parameter(self, 'refractive_index_core')._set_value(value)
+
+    @property
+    def _prop_core_diameter_fraction(self):
+        return _Parameter(self, 'core_diameter_fraction')
+
+    @_prop_core_diameter_fraction.setter
+    def _prop_core_diameter_fraction(self, value):
+        if value is not None and not 0 <= value <= 1:
+            raise ValueError('core_diameter_fraction has to be between 0 and 1.')
+        self._reset_opt_prop()
+        _Parameter(self, 'core_diameter_fraction')._set_value(value)
+
+    @property
+    def _prop_streaming_store(self):
+        return _Parameter(self, 'streaming_store')
+
+    @_prop_streaming_store.setter
+    def _prop_streaming_store(self, value):
+        self._reset_opt_prop()
+        _Parameter(self, 'streaming_store')._set_value(value)
+
+    @property
+    def _prop_streaming_chunksize(self):
+        return _Parameter(self, 'streaming_chunksize')
+
+    @_prop_streaming_chunksize.setter
+    def _prop_streaming_chunksize(self, value):
+        self._reset_opt_prop()
+        _Parameter(self, 'streaming_chunksize')._set_value(int(value))
+
     @property
     def _prop_wavelength(self):
         return _Parameter(self, 'wavelength')
@@ -529,6 +608,11 @@ class _Parameters4Reductions_all(_Parameters4Reductions):
         super().__init__(*args, **kwargs)
         setattr(_Parameters4Reductions_all, 'wavelength', _Parameters4Reductions_all._prop_wavelength)
         setattr(_Parameters4Reductions_all, 'refractive_index', _Parameters4Reductions_all._prop_refractive_index)
+        setattr(_Parameters4Reductions_all, 'refractive_index_interpolation', _Parameters4Reductions_all._prop_refractive_index_interpolation)
+        setattr(_Parameters4Reductions_all, 'refractive_index_core', _Parameters4Reductions_all._prop_refractive_index_core)
+        setattr(_Parameters4Reductions_all, 'core_diameter_fraction', _Parameters4Reductions_all._prop_core_diameter_fraction)
+        setattr(_Parameters4Reductions_all, 'streaming_store', _Parameters4Reductions_all._prop_streaming_store)
+        setattr(_Parameters4Reductions_all, 'streaming_chunksize', _Parameters4Reductions_all._prop_streaming_chunksize)
         setattr(_Parameters4Reductions_all, 'particle_density', _Parameters4Reductions_all._prop_particle_density)
         setattr(_Parameters4Reductions_all, 'kappa', _Parameters4Reductions_all._prop_kappa)
         setattr(_Parameters4Reductions_all, 'growth_distribution', _Parameters4Reductions_all._prop_growth_distribution)
@@ -539,6 +623,11 @@ class _Parameters4Reductions_opt_prop(_Parameters4Reductions):
         super().__init__(*args, **kwargs)
         setattr(_Parameters4Reductions_opt_prop, 'wavelength', _Parameters4Reductions_opt_prop._prop_wavelength)
         setattr(_Parameters4Reductions_opt_prop, 'refractive_index', _Parameters4Reductions_opt_prop._prop_refractive_index)
+        setattr(_Parameters4Reductions_opt_prop, 'refractive_index_interpolation', _Parameters4Reductions_opt_prop._prop_refractive_index_interpolation)
+        setattr(_Parameters4Reductions_opt_prop, 'refractive_index_core', _Parameters4Reductions_opt_prop._prop_refractive_index_core)
+        setattr(_Parameters4Reductions_opt_prop, 'core_diameter_fraction', _Parameters4Reductions_opt_prop._prop_core_diameter_fraction)
+        setattr(_Parameters4Reductions_opt_prop, 'streaming_store', _Parameters4Reductions_opt_prop._prop_streaming_store)
+        setattr(_Parameters4Reductions_opt_prop, 'streaming_chunksize', _Parameters4Reductions_opt_prop._prop_streaming_chunksize)
 
 class _Parameters4Reductions_hygro_growth(_Parameters4Reductions):
     def __init__(self, *args, **kwargs):
@@ -782,6 +871,11 @@ class SizeDist(object):
             self._optical_properties = optical_properties.OpticalProperties(self)
         return self._optical_properties
 
+    def calculate_spectral_optical_properties(self, wavelengths, noOfAngles=100):
+        """Extinction, scattering, and absorption coefficients and Angstrom exponents at several wavelengths (in
+        nm). The refractive index is taken from parameters4reductions."""
+        return optical_properties.SpectralOpticalProperties(self, wavelengths, noOfAngles=noOfAngles)
+
     @property
     def hygroscopicity(self):
         if not self._hygroscopicity:
@@ -2161,6 +2255,9 @@ class SizeDist_TS(SizeDist):
             self._optical_properties = optical_properties.OpticalProperties_TS(self)
         return self._optical_properties
 
+    def calculate_spectral_optical_properties(self, wavelengths, noOfAngles=100):
+        return optical_properties.SpectralOpticalProperties_TS(self, wavelengths, noOfAngles=noOfAngles)
+
     # @property
     # def optical_properties(self):
     #     self.__optical_properties = optical_properties.OpticalProperties_TS(self)
@@ -2227,6 +2324,9 @@ class SizeDist_LS(SizeDist):
             self._optical_properties = optical_properties.OpticalProperties_VP(self)
         return self._optical_properties
 
+    def calculate_spectral_optical_properties(self, wavelengths, noOfAngles=100):
+        return optical_properties.SpectralOpticalProperties_VP(self, wavelengths, noOfAngles=noOfAngles)
+
     # @property
     # def optical_properties(self):
     #     self.__optical_properties = optical_properties.OpticalProperties_VP(self)
@@ -2373,6 +2473,7 @@ class SizeDist_LS(SizeDist):
 
     def deprecated_calculate_angstromex(self, wavelengths=[460.3, 550.4, 671.2, 860.7], n=1.455):
         """Calculates the Anstrome coefficience (overall, layerdependent)
+        Deprecated, use calculate_spectral_optical_properties instead.
 
         Parameters
         ----------
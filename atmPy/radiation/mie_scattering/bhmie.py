@@ -345,6 +345,192 @@ class bhmie_hagen():
         return self.s1, self.s2, self.qext, self.qsca, self.qback, self.gsca
 
 
+def bhmie_vectorized(x, refrel, noOfAngles, diameter=None):
+    """Vectorized version of bhmie_hagen. Instead of looping over one particle at the time this calculates the Mie
+    results for a whole array of size parameters (and optionally refractive indices) at once. All particles are
+    padded to the largest number of terms; terms beyond a particle's own number of terms do not contribute.
+
+    Parameters
+    ----------
+    x: float or array-like
+        size parameter = k*radius = 2pi/lambda * radius
+    refrel: complex or array-like
+        refraction index, needs to broadcast against x
+    noOfAngles: int
+        number of angles for S1 and S2 function in range from 0 to pi/2
+    diameter: array-like, optional
+        to calculate the crosssections this value is needed (same units as the crosssection you are after)
+
+    Returns
+    -------
+    dict with the same keys as bhmie_hagen.return_Values_as_dict plus 'S1', 'S2', 'an', 'bn' and 'noOfTerms'.
+    S1 and S2 have the shape (len(x), 2 * noOfAngles - 1), an and bn (len(x), max(noOfTerms)).
+    """
+    x, refrel = np.broadcast_arrays(np.atleast_1d(np.asarray(x, dtype=float)),
+                                    np.atleast_1d(np.asarray(refrel, dtype=np.complex128)))
+    x = x.ravel()
+    refrel = refrel.ravel()
+    noOfAngles = int(noOfAngles)
+
+    if noOfAngles > 1000:
+        raise ValueError('noOfAngles > mxself.noOfAngles=1000 in bhmie')
+    # Require NANG>1 in order to calculate scattering intensities
+    if noOfAngles < 2:
+        noOfAngles = 2
+
+    # number of terms, see bhmie_hagen.calc_noOfTerms
+    y = x * refrel
+    ymod = np.abs(y)
+    xstop = x + 4. * x ** 0.3333 + 2.0
+    nmx = np.fix(np.maximum(xstop, ymod) + 15.0)
+    nstop = xstop.astype(int)
+    if np.any(nmx > 150000):
+        raise ValueError("error: nmx > nmxx=%f for |m|x=%f" % (150000, ymod.max()))
+    nstop_max = nstop.max()
+    nmx_max = int(nmx.max())
+
+    # Logarithmic derivative D(J) calculated by downward recurrence beginning with initial value (0.,0.) at J=NMX.
+    # Each particle starts at its own NMX.
+    logDeriv = np.zeros((x.shape[0], nmx_max), dtype=np.complex128)
+    for n in range(nmx_max - 2, -1, -1):
+        en = n + 2.
+        value = (en / y) - (1. / (logDeriv[:, n + 1] + en / y))
+        logDeriv[:, n] = np.where(n < nmx - 1, value, 0)
+    logDeriv = logDeriv[:, :nstop_max]
+
+    # Riccati-Bessel functions with real argument X calculated by upward recurrence
+    an = np.zeros((x.shape[0], nstop_max), dtype=np.complex128)
+    bn = np.zeros((x.shape[0], nstop_max), dtype=np.complex128)
+    psi0 = np.cos(x)
+    psi1 = np.sin(x)
+    chi0 = -np.sin(x)
+    chi1 = np.cos(x)
+    xi1 = psi1 - chi1 * 1j
+    for n in range(nstop_max):
+        en = n + 1.
+        active = n < nstop
+        psi = (2. * en - 1.) * psi1 / x - psi0
+        chi = (2. * en - 1.) * chi1 / x - chi0
+        xi = psi - chi * 1j
+        a = (logDeriv[:, n] / refrel + en / x)
+        b = (refrel * logDeriv[:, n] + en / x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            an[:, n] = np.where(active, (a * psi - psi1) / (a * xi - xi1), 0)
+            bn[:, n] = np.where(active, (b * psi - psi1) / (b * xi - xi1), 0)
+        # freeze the recurrence for particles that are done, otherwise chi overflows for small x
+        psi0 = np.where(active, psi1, psi0)
+        psi1 = np.where(active, psi, psi1)
+        chi0 = np.where(active, chi1, chi0)
+        chi1 = np.where(active, chi, chi1)
+        xi1 = psi1 - chi1 * 1j
+
+    out = scattering_from_coefficients(x, an, bn, noOfAngles, diameter=diameter)
+    out['an'] = an
+    out['bn'] = bn
+    out['noOfTerms'] = nstop
+    return out
+
+
+def scattering_from_coefficients(x, an, bn, noOfAngles, diameter=None):
+    """Efficiencies, asymmetry parameter, and amplitude scattering functions from the Mie coefficients of many
+    particles (this is the second half of bhmie_vectorized, which is shared with the coated sphere calculation in
+    mie_coated).
+
+    Parameters
+    ----------
+    x: array
+        size parameter (of the outer diameter)
+    an, bn: arrays of shape (len(x), number of terms)
+        Mie coefficients, padded with zeros
+    noOfAngles: int
+    diameter: array-like, optional
+
+    Returns
+    -------
+    dict with the keys of bhmie_vectorized except 'an', 'bn', and 'noOfTerms'
+    """
+    nstop_max = an.shape[1]
+    en = np.arange(1., nstop_max + 1)
+    fn = (2. * en + 1.) / (en * (en + 1.))
+
+    # Qsca and g=<cos(theta)>
+    qsca = ((2. * en + 1.) * (np.abs(an) ** 2 + np.abs(bn) ** 2)).sum(axis=1)
+    gsca = (fn * (np.real(an) * np.real(bn) + np.imag(an) * np.imag(bn))).sum(axis=1)
+    gsca += (((en[1:] - 1.) * (en[1:] + 1.) / en[1:]) * (np.real(an[:, :-1]) * np.real(an[:, 1:])
+                                                         + np.imag(an[:, :-1]) * np.imag(an[:, 1:])
+                                                         + np.real(bn[:, :-1]) * np.real(bn[:, 1:])
+                                                         + np.imag(bn[:, :-1]) * np.imag(bn[:, 1:]))).sum(axis=1)
+
+    # angular functions pi_n and tau_n do not depend on the particle, so they are calculated only once
+    dang = .5 * np.pi / (noOfAngles - 1)
+    amu = np.cos(np.arange(0.0, noOfAngles, 1) * dang)
+    pi_n = np.zeros((nstop_max, noOfAngles))
+    tau_n = np.zeros((nstop_max, noOfAngles))
+    pi0 = np.zeros(noOfAngles)
+    pi1 = np.ones(noOfAngles)
+    for n in range(nstop_max):
+        enn = n + 1.
+        pi_n[n] = pi1
+        tau_n[n] = enn * amu * pi1 - (enn + 1.) * pi0
+        pi0, pi1 = pi1, ((2. * enn + 1.) * amu * pi1 - (enn + 1.) * pi0) / enn
+
+    # scattering intensity pattern, first angles from 0 to 90 than angles greater than 90 using PI and TAU from
+    # angles less than 90. P=1 for N=1,3,...% P=-1 for N=2,4,...
+    p = np.where(np.arange(nstop_max) % 2 == 0, 1., -1.)
+    fan = fn * an
+    fbn = fn * bn
+    s1_1 = fan.dot(pi_n) + fbn.dot(tau_n)
+    s2_1 = fan.dot(tau_n) + fbn.dot(pi_n)
+    s1_2 = (p * fan).dot(pi_n) - (p * fbn).dot(tau_n)
+    s2_2 = (p * fbn).dot(pi_n) - (p * fan).dot(tau_n)
+
+    # we have to reverse the order of the elements of the second part of s1 and s2
+    s1 = np.concatenate((s1_1, s1_2[:, -2::-1]), axis=1)
+    s2 = np.concatenate((s2_1, s2_2[:, -2::-1]), axis=1)
+
+    gsca = 2. * gsca / qsca
+    qsca = (2. / (x ** 2)) * qsca
+    qext = (4. / (x ** 2)) * np.real(s1[:, 0])
+    qback = 4 * (np.abs(s1[:, -1]) / x) ** 2
+
+    if diameter is not None:
+        diameter = np.broadcast_to(np.asarray(diameter, dtype=float), x.shape)
+        csca = qsca * diameter ** 2 * np.pi * 0.5 ** 2
+        cext = qext * diameter ** 2 * np.pi * 0.5 ** 2
+    else:
+        csca = np.zeros(x.shape)
+        cext = np.zeros(x.shape)
+
+    return {'extinction_efficiency': qext,
+            'scattering_efficiency': qsca,
+            'backscatter_efficiency': qback,
+            'asymmetry_parameter': gsca,
+            'scattering_crosssection': csca,
+            'extinction_crosssection': cext,
+            'S1': s1,
+            'S2': s2}
+
+
+def angular_scatt_func_vectorized(mie_dict, x):
+    """Natural angular scattering function in the interval [0,2*pi) for all particles in the dict returned by
+    bhmie_vectorized. Equivalent to bhmie_hagen.get_angular_scatt_func().natural.
+
+    Returns
+    -------
+    angles, ndarray of shape (len(x), 4 * noOfAngles - 3)
+    """
+    s1 = mie_dict['S1']
+    s2 = mie_dict['S2']
+    s1s = np.abs(np.concatenate((s1, s1[:, -2::-1]), axis=1)) ** 2
+    s2s = np.abs(np.concatenate((s2, s2[:, -2::-1]), axis=1)) ** 2
+    natural = (s1s + s2s) / 2
+    x = np.broadcast_to(np.asarray(x, dtype=float), mie_dict['scattering_efficiency'].shape)
+    natural *= (4 * np.pi / (np.pi * x ** 2 * mie_dict['scattering_efficiency']))[:, np.newaxis]
+    natural *= (mie_dict['scattering_crosssection'] / (4 * np.pi))[:, np.newaxis]
+    angles = np.linspace(0, np.pi * 2, natural.shape[1])
+    return angles, natural
+
+
 def bhmie(x,refrel,nang):
     """ This file is converted from mie_scattering.m, see http://atol.ucsd.edu/scatlib/index.htm
          Bohren and Huffman originally published the code in their book on light scattering
@@ -558,3 +744,26 @@ def test_extinction_coeff():
     print('test value 1 is/should be: %s/%s'%(test_I_is, test_I_should))
     print('test value 2 is/should be: %s/%s'%(test_II_is, test_II_should))
 
+
+
+def benchmark_vectorized(noOfDiameters=200, wavelength=.55, refrel=1.5 + 0.01j, noOfAngles=100):
+    """Compares the speed of bhmie_vectorized to looping over bhmie_hagen (as it was done in
+    optical_properties._perform_Miecalculations) for diameters between 10 nm and 10 um."""
+    import time
+    d = np.logspace(-2, 1, noOfDiameters)
+    x = np.pi * d / wavelength
+
+    start = time.time()
+    loop = [bhmie_hagen(xi, refrel, noOfAngles, diameter=di).return_Values_as_dict() for xi, di in zip(x, d)]
+    time_loop = time.time() - start
+
+    start = time.time()
+    vect = bhmie_vectorized(x, refrel, noOfAngles, diameter=d)
+    time_vect = time.time() - start
+
+    ext_loop = np.array([i['extinction_crosssection'] for i in loop])
+    max_dev = np.abs((vect['extinction_crosssection'] - ext_loop) / ext_loop).max()
+    print('loop over bhmie_hagen: %.3f s' % time_loop)
+    print('bhmie_vectorized: %.3f s (speedup: %.1f)' % (time_vect, time_loop / time_vect))
+    print('max. relative deviation of the extinction crosssection: %s' % max_dev)
+    return time_loop, time_vect
@@ -20,14 +20,24 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 class Cache(dict):
+    """Dictionary which only keeps the last size items. Items that are read are considered recently used
+    (least recently used eviction)."""
     def __init__(self, size=10):
         super(Cache, self).__init__()
         self.size = size
         self.log = []
 
-    def __setitem___(self, key, value):
+    def __getitem__(self, key):
+        value = super(Cache, self).__getitem__(key)
+        self.log.remove(key)
+        self.log.append(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.log.remove(key)
         super(Cache, self).__setitem__(key, value)
         self.log.append(key)
         if len(self.log) > self.size:
-            del self[self.log[0]]
+            super(Cache, self).__delitem__(self.log[0])
             self.log.pop(0)
@@ -0,0 +1,217 @@
+"""Cache for Mie scattering results.
+
+Bins, wavelengths and refractive indices tend to be the same across many files, so Mie results are memoized per
+(size parameter, refractive index, number of angles), for coated spheres additionally per (size parameter of the
+shell, refractive index of the shell). The cache lives in memory and evicts the least recently used
+results when it is full. If a file is given, the cache can be saved to and warmed from a numpy .npz file so a new
+process does not have to recompute what an earlier one already calculated.
+
+Usage
+-----
+>>> from atmPy.radiation.mie_scattering import mie_cache
+>>> mie_cache.default_cache.path = '~/mie_cache.npz'
+>>> mie_cache.default_cache.load()    # warm from disk (does nothing if the file does not exist)
+>>> ... do your optical property calculations ...
+>>> mie_cache.default_cache.save()
+"""
+from collections import OrderedDict as _OrderedDict
+import os as _os
+
+import numpy as _np
+
+from atmPy.radiation.mie_scattering import bhmie as _bhmie
+from atmPy.radiation.mie_scattering import mie_coated as _mie_coated
+
+_scalar_keys = ('extinction_efficiency', 'scattering_efficiency', 'backscatter_efficiency', 'asymmetry_parameter',
+                'noOfTerms')
+_array_keys = ('S1', 'S2')
+
+
+class MieCache(object):
+    """Least recently used cache of Mie results with optional persistence to disk.
+
+    Parameters
+    ----------
+    size: int
+        Maximum number of particles (combinations of x, m, and noOfAngles) kept in memory. Each entry holds S1 and
+        S2, e.g. 100 angles result in about 6.5 kB per entry.
+    path: str, optional
+        .npz file to load from and save to.
+    autosave: bool
+        If True the cache is written to path whenever new results were calculated.
+    """
+    def __init__(self, size=20000, path=None, autosave=False):
+        self.size = size
+        self.path = path
+        self.autosave = autosave
+        self._data = _OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return 'MieCache: {} of {} entries, {} hits, {} misses, path: {}'.format(len(self), self.size, self.hits,
+                                                                                 self.misses, self.path)
+
+    @staticmethod
+    def _make_key(x, refrel, noOfAngles, y=None, m_shell=None):
+        if y is None:
+            return (float(x), complex(refrel), int(noOfAngles))
+        return (float(x), complex(refrel), int(noOfAngles), float(y), complex(m_shell))
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, x, refrel, noOfAngles, diameter=None):
+        """Same as bhmie.bhmie_vectorized, but results that have been calculated before are taken from the cache.
+        Note, the Mie coefficients (an, bn) are not cached and therefore not part of the returned dict.
+        """
+        noOfAngles = int(noOfAngles)
+        x, refrel = _np.broadcast_arrays(_np.atleast_1d(_np.asarray(x, dtype=float)),
+                                         _np.atleast_1d(_np.asarray(refrel, dtype=_np.complex128)))
+        x = x.ravel()
+        refrel = refrel.ravel()
+
+        keys = [self._make_key(xi, mi, noOfAngles) for xi, mi in zip(x, refrel)]
+        calculate = lambda missing: _bhmie.bhmie_vectorized(x[missing], refrel[missing], noOfAngles)
+        return self._get(keys, calculate, x, diameter)
+
+    def get_coated(self, x, y, m_core, m_shell, noOfAngles, diameter=None):
+        """Same as mie_coated.bhcoat_vectorized, but results that have been calculated before are taken from the
+        cache. Note, the Mie coefficients (an, bn) are not cached and therefore not part of the returned dict.
+        """
+        noOfAngles = int(noOfAngles)
+        x, y, m_core, m_shell = _np.broadcast_arrays(_np.atleast_1d(_np.asarray(x, dtype=float)),
+                                                     _np.atleast_1d(_np.asarray(y, dtype=float)),
+                                                     _np.atleast_1d(_np.asarray(m_core, dtype=_np.complex128)),
+                                                     _np.atleast_1d(_np.asarray(m_shell, dtype=_np.complex128)))
+        x, y, m_core, m_shell = [i.ravel() for i in (x, y, m_core, m_shell)]
+
+        keys = [self._make_key(xi, mi, noOfAngles, y=yi, m_shell=m2i)
+                for xi, mi, yi, m2i in zip(x, m_core, y, m_shell)]
+        calculate = lambda missing: _mie_coated.bhcoat_vectorized(x[missing], y[missing], m_core[missing],
+                                                                  m_shell[missing], noOfAngles)
+        return self._get(keys, calculate, y, diameter)
+
+    def _get(self, keys, calculate, x, diameter):
+        missing = [e for e, key in enumerate(keys) if key not in self._data]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        new = {}
+        if len(missing) > 0:
+            values = calculate(missing)
+            for i, e in enumerate(missing):
+                entry = {k: values[k][i] for k in _scalar_keys + _array_keys}
+                new[keys[e]] = entry
+                self._set(keys[e], entry)
+
+        # in case the cache is smaller than the number of requested particles, new results might have been evicted
+        # already, that's why they are also taken from new
+        entries = []
+        for key in keys:
+            if key in new:
+                entries.append(new[key])
+            else:
+                self._data.move_to_end(key)
+                entries.append(self._data[key])
+
+        out = {}
+        for k in _scalar_keys + _array_keys:
+            out[k] = _np.array([entry[k] for entry in entries])
+
+        if diameter is not None:
+            diameter = _np.broadcast_to(_np.asarray(diameter, dtype=float), x.shape)
+            out['scattering_crosssection'] = out['scattering_efficiency'] * diameter ** 2 * _np.pi * 0.5 ** 2
+            out['extinction_crosssection'] = out['extinction_efficiency'] * diameter ** 2 * _np.pi * 0.5 ** 2
+        else:
+            out['scattering_crosssection'] = _np.zeros(x.shape)
+            out['extinction_crosssection'] = _np.zeros(x.shape)
+
+        if len(missing) > 0 and self.autosave and self.path:
+            self.save()
+        return out
+
+    def save(self, path=None):
+        """Save the cache as .npz file. Results are grouped by the number of angles since S1 and S2 have a different
+        length for each."""
+        if not path:
+            path = self.path
+        if not path:
+            raise ValueError('No path given. Either set the path attribute or use the path argument.')
+        path = _os.path.expanduser(path)
+
+        out = {}
+        for noOfAngles, coated in set((key[2], len(key) == 5) for key in self._data.keys()):
+            keys = [key for key in self._data.keys() if key[2] == noOfAngles and (len(key) == 5) == coated]
+            grp = 'nang%i%s_' % (noOfAngles, 'coated' if coated else '')
+            out[grp + 'x'] = _np.array([key[0] for key in keys])
+            out[grp + 'm'] = _np.array([key[1] for key in keys], dtype=_np.complex128)
+            if coated:
+                out[grp + 'y'] = _np.array([key[3] for key in keys])
+                out[grp + 'm_shell'] = _np.array([key[4] for key in keys], dtype=_np.complex128)
+            for k in _scalar_keys + _array_keys:
+                out[grp + k] = _np.array([self._data[key][k] for key in keys])
+
+        # write to a temporary file first, so an interrupted save does not destroy an existing cache file
+        tmp = path + '.tmp.npz'
+        _np.savez(tmp, **out)
+        _os.replace(tmp, path)
+
+    def load(self, path=None):
+        """Warm the cache from a .npz file that was created with save. Does nothing if the file does not exist."""
+        if not path:
+            path = self.path
+        if not path:
+            raise ValueError('No path given. Either set the path attribute or use the path argument.')
+        path = _os.path.expanduser(path)
+        if not _os.path.isfile(path):
+            return
+
+        with _np.load(path) as data:
+            groups = set(k.split('_')[0] for k in data.files)
+            for grp in groups:
+                coated = grp.endswith('coated')
+                noOfAngles = int(grp.replace('nang', '').replace('coated', ''))
+                grp += '_'
+                columns = {k: data[grp + k] for k in _scalar_keys + _array_keys}
+                if coated:
+                    ys, m_shells = data[grp + 'y'], data[grp + 'm_shell']
+                for e, (xi, mi) in enumerate(zip(data[grp + 'x'], data[grp + 'm'])):
+                    if coated:
+                        key = self._make_key(xi, mi, noOfAngles, y=ys[e], m_shell=m_shells[e])
+                    else:
+                        key = self._make_key(xi, mi, noOfAngles)
+                    self._set(key, {k: columns[k][e] for k in columns})
+
+
+default_cache = MieCache()
+
+
+def bhmie_cached(x, refrel, noOfAngles, diameter=None, cache=None):
+    """Same as bhmie.bhmie_vectorized but using a MieCache (the module's default_cache if cache is None).
+    The returned dict has no Mie coefficients (an, bn)."""
+    if cache is None:
+        cache = default_cache
+    return cache.get(x, refrel, noOfAngles, diameter=diameter)
+
+
+def bhcoat_cached(x, y, m_core, m_shell, noOfAngles, diameter=None, cache=None):
+    """Same as mie_coated.bhcoat_vectorized but using a MieCache (the module's default_cache if cache is None).
+    The returned dict has no Mie coefficients (an, bn)."""
+    if cache is None:
+        cache = default_cache
+    return cache.get_coated(x, y, m_core, m_shell, noOfAngles, diameter=diameter)
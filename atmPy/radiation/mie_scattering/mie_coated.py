@@ -19,204 +19,182 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from atmPy.mie.mie_coeffs import MieCoeffs
-from atmPy.mie.mie_props import mie_props, mie_S12
-from numpy import sqrt
-
-from atmPy.radiation.mie_scattering import Cache
-
-
-class MieScatterProps(object):
-    """Stores the mie_scattering coefficients and the corresponding parameters.
+import numpy as _np
+from scipy.special import jv as _jv
+from scipy.special import yv as _yv
+
+from atmPy.radiation.mie_scattering import bhmie as _bhmie
+
+
+def _log_derivative(z, nmx, nmax):
+    """Logarithmic derivative D_n(z) by downward recurrence, each particle starting at its own nmx. Returns the
+    first nmax.max() terms."""
+    nmx_max = int(nmx.max())
+    dnx = _np.zeros((z.shape[0], nmx_max), dtype=_np.complex128)
+    for j in range(nmx_max - 1, 0, -1):
+        r = (j + 1.0) / z
+        value = r - 1.0 / (dnx[:, j] + r)
+        dnx[:, j - 1] = _np.where(j < nmx, value, 0)
+    return dnx[:, :int(nmax.max())]
+
+
+def coated_mie_coefficients(x, y, m_core, m_shell):
+    """Mie coefficients of coated spheres, vectorized version of mie_coeffs.coated_mie_coeff.
+
+    Parameters
+    ----------
+    x: array
+        size parameter of the core
+    y: array
+        size parameter of the shell (outer diameter), y > x
+    m_core, m_shell: arrays
+        refractive indices of core and shell
+
+    Returns
+    -------
+    an, bn: arrays of shape (len(x), max(nmax)), padded with zeros beyond each particle's nmax
+    nmax: array, number of terms of each particle
     """
-    def __init__(self, params):
-        par = dict(zip(("eps","mu","x","y","eps2"),params[:5]))
-        if par["x"]==0 and par["y"] is None:
-            #give valid output for x==0
-            self._coeffs = {"qext":0.0, "qsca":0.0, "qabs":0.0, "qb":0.0,
-                            "0.0":asy, "0.0":qratio}
-        else:
-            self._coeffs = MieCoeffs(par)
-        self._props = None
-        self._S12 = None
-        self.size = par["x"] if par["y"]==None else par["y"]
-
-    def prop(self, prop_name):
-        if self._props is None:
-            self._props = mie_props(self._coeffs, self.size)
-        return self._props[prop_name]
-
-    def S12(self, u):
-        if self._S12 is None:
-            self._S12 = mie_S12(self._coeffs, u)
-        return self._S12
-
-
-class Mie(object):
-    """Class for computing Mie scattering from homogeneous and coated spheres.
-
-    Create an instance of Mie, set the size and material parameters, then call
-    any of the methods to determine the scattering properties.
-
-    Attributes:
-    x: The size parameter, i.e. 2*pi/lambda*r where lambda is the
-        wavelength and r is the radius of the spheres.
-    eps: The complex relative permittivity (dielectric constant).
-    mu: The complex relative permeability.
-    eps2: The dielectric constant of the outer layer. If you specify this,
-        you must also specify y. If you specify eps2, eps is taken to be
-        the complex relative permittivity of the inner layer (core).
-    y: The size parameter of the outer layer. If you specify y, x is
-        taken to be the size paramater of the core (must be y>=x).
-    m: The complex refractive index. Setting this sets eps to m**2 and mu
-        to 1.0.
-    m2: The complex refractive index of the outer layer. See "m" above.
-
-    Setting mu together with eps2 and y raises an error.
-
-    Any of the above attributes can be given as keyword arguments when
-    creating a new Mie instance. For example:
-    mie_scattering = Mie(x=1.5,m=complex(1.2,0.1))
+    m = m_shell / m_core
+    u = m_core * x
+    v = m_shell * x
+    w = m_shell * y
+
+    nmax = _np.round(2 + y + 4 * y ** (1.0 / 3.0)).astype(int)
+    mx = _np.maximum(_np.abs(m_core * y), _np.abs(w))
+    nmx = _np.round(_np.maximum(nmax, mx) + 16).astype(int)
+    nmax_max = int(nmax.max())
+    n = _np.arange(nmax_max)
+    active = n[_np.newaxis, :] < nmax[:, _np.newaxis]
+
+    dnu = _log_derivative(u, nmx, nmax)
+    dnv = _log_derivative(v, nmx, nmax)
+    dnw = _log_derivative(w, nmx, nmax)
+
+    nu = n + 1.5
+    with _np.errstate(all='ignore'):
+        # terms beyond a particle's nmax can over or underflow, they are masked below
+        pv, pw, py = [_np.sqrt(0.5 * _np.pi * xx)[:, _np.newaxis] * _jv(nu, xx[:, _np.newaxis]) for xx in (v, w, y)]
+        chv, chw, chy = [-_np.sqrt(0.5 * _np.pi * xx)[:, _np.newaxis] * _yv(nu, xx[:, _np.newaxis])
+                         for xx in (v, w, y)]
+        p1y = _np.hstack((_np.sin(y)[:, _np.newaxis], py[:, :-1]))
+        ch1y = _np.hstack((_np.cos(y)[:, _np.newaxis], chy[:, :-1]))
+        gsy = py - 1j * chy
+        gs1y = p1y - 1j * ch1y
+
+        m = m[:, _np.newaxis]
+        uu = m * dnu - dnv
+        vv = dnu / m - dnv
+        fv = pv / chv
+        fw = pw / chw
+        ku1 = uu * fv / pw
+        kv1 = vv * fv / pw
+        pt = pw - chw * fv
+        prat = pw / pv / chv
+        ku2 = uu * pt + prat
+        kv2 = vv * pt + prat
+        dns1 = ku1 / ku2
+        gns1 = kv1 / kv2
+
+        dns = dns1 + dnw
+        gns = gns1 + dnw
+        nrat = (n + 1) / y[:, _np.newaxis]
+        a1 = dns / m_shell[:, _np.newaxis] + nrat
+        b1 = m_shell[:, _np.newaxis] * gns + nrat
+        an = (py * a1 - p1y) / (gsy * a1 - gs1y)
+        bn = (py * b1 - p1y) / (gsy * b1 - gs1y)
+
+    an = _np.where(active, an, 0)
+    bn = _np.where(active, bn, 0)
+    return an, bn, nmax
+
+
+def bhcoat_vectorized(x, y, m_core, m_shell, noOfAngles, diameter=None):
+    """Mie scattering of coated spheres (e.g. black carbon with a coating) for many particles at once. The returned
+    dict is the same as that of bhmie.bhmie_vectorized, so the results can be used in the same way (e.g. in
+    bhmie.angular_scatt_func_vectorized with the size parameter y).
+
+    Particles without a core (x == 0), without a shell (x == y), or with m_core == m_shell are calculated as
+    homogeneous spheres.
+
+    Parameters
+    ----------
+    x: float or array-like
+        size parameter of the core = 2pi/lambda * core radius
+    y: float or array-like
+        size parameter of the whole particle = 2pi/lambda * radius
+    m_core, m_shell: complex or array-like
+        refractive indices of core and shell
+    noOfAngles: int
+        number of angles for S1 and S2 function in range from 0 to pi/2
+    diameter: array-like, optional
+        outer diameter, needed to calculate the crosssections
+
+    Returns
+    -------
+    dict, see bhmie.bhmie_vectorized
     """
-    def __init__(self, **kwargs):
-        self._cache = Cache()
-        self.eps = None
-        self.mu = 1.0
-        self._x = None
-        self._y = None
-        self.eps2 = None
-        for k in ["eps","mu","eps2"]:
-            if k in kwargs:
-                self.__dict__[k] = kwargs[k]
-        if "m" in kwargs:
-            self.m = kwargs["m"]
-        if "m2" in kwargs:
-            self.m2 = kwargs["m2"]
-        if "x" in kwargs:
-            self.x = kwargs["x"]
-        if "y" in kwargs:
-            self.y = kwargs["y"]
-
-    def _params_signature(self):
-        return (self.eps, self.mu, self.x, self.y, self.eps2)
-
-    def qext(self):
-        """The extinction efficiency.
-
-        Returns:
-            The extinction efficiency. Multiply by the physical cross section
-            (pi*r**2) to get the cross section.
-        """
-        return self._get_scatt_prop("qext")
-
-    def qsca(self):
-        """The scattering efficiency.
-
-        Returns:
-            The scattering efficiency. Multiply by the physical cross section
-            (pi*r**2) to get the cross section.
-        """
-        return self._get_scatt_prop("qsca")
-
-    def qabs(self):
-        """The absorption efficiency.
-
-        Returns:
-            The absorption efficiency. Multiply by the physical cross section
-            (pi*r**2) to get the cross section.
-        """
-        return self._get_scatt_prop("qabs")
-
-    def qb(self):
-        """The backscattering efficiency.
-
-        Returns:
-            The backscattering efficiency. Multiply by the physical cross
-            section (pi*r**2) to get the cross section.
-        """
-        return self._get_scatt_prop("qb")
-
-    def asy(self):
-        """The asymmetry parameter.
-        Returns:
-            The asymmetry parameter, i.e. <cos(theta)>.
-        """
-        return self._get_scatt_prop("asy")
-
-    def qratio(self):
-        """The backscattering ratio.
-
-        Returns:
-              The backscattering ratio, i.e. qb()/qsca().
-        """
-        return self._get_scatt_prop("qratio")
-
-    def S12(self, u):
-        """The amplitude scattering matrix elements.
-
-        Arguments:
-            u: The cosine of the scattering angle, -1 <= u <= 1
-
-        Returns:
-            The amplitude scattering matrix elements S1 and S2.
-            Follows the conventions of Bohren and Huffman (1983).
-        """
-        return self._get_S12(u)
-
-
-    def _get_scatt_prop(self, prop):
-        sig = self._params_signature()
-        if sig not in self._cache:
-            self._cache[sig] = MieScatterProps(sig)
-        return self._cache[sig].prop(prop)
-
-    def _get_S12(self, u):
-        if abs(u) > 1:
-            raise ValueError("The cosine u must be between -1 and 1.")
-        sig = self._params_signature()
-        if sig not in self._cache:
-            self._cache[sig] = MieScatterProps(sig)
-        return self._cache[sig].S12(u)
-
-
-    def _get_m(self):
-        return sqrt(self.eps/self.mu)
-
-    def _set_m(self, m):
-        self.mu = 1.0
-        self.eps = m**2
-
-    m = property(_get_m, _set_m)
-
-
-    def _get_m2(self):
-        return sqrt(self.m2)
-
-    def _set_m2(self, m2):
-        self.eps2 = m2**2
-
-    m2 = property(_get_m2, _set_m2)
-
-
-    def _get_x(self):
-        return self._x
-
-    def _set_x(self, x):
-        if x >= 0.0:
-            self._x = x
+    x, y, m_core, m_shell = _np.broadcast_arrays(_np.atleast_1d(_np.asarray(x, dtype=float)),
+                                                 _np.atleast_1d(_np.asarray(y, dtype=float)),
+                                                 _np.atleast_1d(_np.asarray(m_core, dtype=_np.complex128)),
+                                                 _np.atleast_1d(_np.asarray(m_shell, dtype=_np.complex128)))
+    x, y, m_core, m_shell = [i.ravel() for i in (x, y, m_core, m_shell)]
+    if _np.any(x > y):
+        raise ValueError('The core can not be larger than the particle (x > y).')
+    noOfAngles = max(int(noOfAngles), 2)
+    if diameter is not None:
+        diameter = _np.broadcast_to(_np.asarray(diameter, dtype=float), y.shape)
+
+    no_core = (x == 0) | (m_core == m_shell)
+    no_shell = (x == y) & ~ no_core
+    coated = ~ (no_core | no_shell)
+
+    parts = []
+    if coated.any():
+        an, bn, nmax = coated_mie_coefficients(x[coated], y[coated], m_core[coated], m_shell[coated])
+        res = _bhmie.scattering_from_coefficients(y[coated], an, bn, noOfAngles,
+                                                  diameter=None if diameter is None else diameter[coated])
+        res.update({'an': an, 'bn': bn, 'noOfTerms': nmax})
+        parts.append((coated, res))
+    for which, m in ((no_core, m_shell), (no_shell, m_core)):
+        if which.any():
+            res = _bhmie.bhmie_vectorized(y[which], m[which], noOfAngles,
+                                          diameter=None if diameter is None else diameter[which])
+            parts.append((which, res))
+
+    out = {}
+    no_terms = max(res['an'].shape[1] for which, res in parts)
+    for key in parts[0][1]:
+        value = parts[0][1][key]
+        if key in ('an', 'bn'):
+            shape = (y.shape[0], no_terms)
         else:
-            raise ValueError("The size x cannot be smaller than 0.")
-
-    x = property(_get_x, _set_x)
-
-
-    def _get_y(self):
-        return self._y
-
-    def _set_y(self, y):
-        if y >= self.x:
-            self._y = y
-        else:
-            raise ValueError("The size y cannot be smaller than x.")
-
-    y = property(_get_y, _set_y)
+            shape = (y.shape[0],) + value.shape[1:]
+        out[key] = _np.zeros(shape, dtype=value.dtype)
+        for which, res in parts:
+            if key in ('an', 'bn'):
+                out[key][which, :res[key].shape[1]] = res[key]
+            else:
+                out[key][which] = res[key]
+    return out
+
+
+def benchmark(noOfDiameters=200, wavelength=.55, m_core=1.95 + 0.79j, m_shell=1.5 + 0j, core_fraction=0.5,
+              noOfAngles=100):
+    """Compares the speed of bhcoat_vectorized to bhmie.bhmie_vectorized (homogeneous spheres of the same size) for
+    diameters between 10 nm and 10 um."""
+    import time
+    d = _np.logspace(-2, 1, noOfDiameters)
+    y = _np.pi * d / wavelength
+
+    start = time.time()
+    _bhmie.bhmie_vectorized(y, m_shell, noOfAngles, diameter=d)
+    time_homogeneous = time.time() - start
+
+    start = time.time()
+    bhcoat_vectorized(y * core_fraction, y, m_core, m_shell, noOfAngles, diameter=d)
+    time_coated = time.time() - start
+
+    print('homogeneous: %.3f s' % time_homogeneous)
+    print('coated: %.3f s (ratio: %.1f)' % (time_coated, time_coated / time_homogeneous))
+    return time_homogeneous, time_coated
@@ -0,0 +1,116 @@
+"""Mie kernels (crossections and efficiencies as a function of diameter) for many wavelengths and refractive indices.
+
+Each combination of wavelength and refractive index is an independent calculation, which makes it easy to spread
+them over several processes. This is useful e.g. when optical properties are needed at all wavelengths of a
+nephelometer or sun photometer, or for sensitivity studies on the refractive index.
+
+Usage
+-----
+>>> from atmPy.radiation.mie_scattering import mie_kernels
+>>> kernels = mie_kernels.calculate_kernels(diameters, [0.45, 0.55, 0.7], [1.5, 1.5 + 0.01j], workers=4)
+>>> kernels['extinction_crossection'].loc[(0.55, 1.5 + 0.01j)]
+"""
+from concurrent import futures as _futures
+import os as _os
+
+import numpy as _np
+import pandas as _pd
+
+from atmPy.radiation.mie_scattering import mie_cache as _mie_cache
+
+quantities = ('extinction_efficiency', 'scattering_efficiency', 'absorption_efficiency',
+              'extinction_crossection', 'scattering_crossection', 'absorption_crossection')
+
+
+def _kernel(diam, wavelength, n, noOfAngles):
+    """Mie results for all diameters at one wavelength and refractive index. Module level so it can be pickled to
+    the worker processes."""
+    x = 2. * _np.pi * (diam / 2.) / wavelength
+    values = _mie_cache.bhmie_cached(x, n, noOfAngles, diameter=diam)
+    ext_eff = values['extinction_efficiency']
+    sca_eff = values['scattering_efficiency']
+    ext = values['extinction_crosssection']
+    sca = values['scattering_crosssection']
+    return _np.array([ext_eff, sca_eff, ext_eff - sca_eff, ext, sca, ext - sca])
+
+
+def calculate_kernels(diam, wavelengths, refractive_indices, noOfAngles=100, workers=None):
+    """Calculates Mie crossections and efficiencies for each combination of wavelength and refractive index.
+
+    Parameters
+    ----------
+    diam: array-like
+        Diameters in um.
+    wavelengths: float or array-like
+        Wavelengths in um.
+    refractive_indices: complex or array-like
+        Refractive indices.
+    noOfAngles: int
+        Number of angles used in the Mie calculation. Only matters for results shared with the Mie cache.
+    workers: int, optional
+        Number of processes. If None, the number of CPUs is used. With workers=1 (or if there is only one
+        calculation) everything is done in the current process, which also uses and fills
+        mie_cache.default_cache.
+
+    Returns
+    -------
+    dict of pandas DataFrames, one for each quantity (see mie_kernels.quantities). The index is a MultiIndex
+    (wavelength, refractive_index), the columns are the diameters, i.e. a wavelength x n x bin array for each quantity.
+    Crossections are in um^2.
+    """
+    diam = _np.asarray(diam, dtype=float)
+    wavelengths = _np.atleast_1d(_np.asarray(wavelengths, dtype=float))
+    refractive_indices = _np.atleast_1d(_np.asarray(refractive_indices, dtype=_np.complex128))
+    index = _pd.MultiIndex.from_product([wavelengths, refractive_indices], names=['wavelength', 'refractive_index'])
+
+    if workers is None:
+        workers = _os.cpu_count() or 1
+    workers = min(int(workers), len(index))
+    if workers < 1:
+        raise ValueError('workers has to be at least 1.')
+
+    combinations = list(index)
+    if workers == 1:
+        results = [_kernel(diam, wl, n, noOfAngles) for wl, n in combinations]
+    else:
+        with _futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_kernel,
+                                        [diam] * len(combinations),
+                                        [wl for wl, n in combinations],
+                                        [n for wl, n in combinations],
+                                        [noOfAngles] * len(combinations)))
+
+    results = _np.array(results)
+    out = {}
+    for e, quantity in enumerate(quantities):
+        out[quantity] = _pd.DataFrame(results[:, e, :], index=index, columns=diam)
+    return out
+
+
+def benchmark(workers=None, noOfDiameters=200, noOfWavelengths=7, noOfRefractiveIndices=8):
+    """Compares calculate_kernels with one worker to calculate_kernels with workers processes."""
+    import time
+    diam = _np.logspace(-2, 1, noOfDiameters)
+    wavelengths = _np.linspace(0.4, 1., noOfWavelengths)
+    refractive_indices = _np.linspace(1.4, 1.6, noOfRefractiveIndices) + 0.01j
+    if workers is None:
+        workers = _os.cpu_count() or 1
+
+    cache = _mie_cache.default_cache
+    _mie_cache.default_cache = _mie_cache.MieCache(size=0)
+    try:
+        start = time.time()
+        serial = calculate_kernels(diam, wavelengths, refractive_indices, workers=1)
+        time_serial = time.time() - start
+
+        start = time.time()
+        parallel = calculate_kernels(diam, wavelengths, refractive_indices, workers=workers)
+        time_parallel = time.time() - start
+    finally:
+        _mie_cache.default_cache = cache
+
+    max_dev = _np.abs(serial['extinction_crossection'].values - parallel['extinction_crossection'].values).max()
+    print('serial: %.2f s' % time_serial)
+    print('%i workers: %.2f s (speedup: %.1f)' % (workers, time_parallel, time_serial / time_parallel))
+    print('max. deviation of the extinction crossection: %s' % max_dev)
+    return time_serial, time_parallel
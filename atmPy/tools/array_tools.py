@@ -88,6 +88,119 @@ def reverse_binary(variable, no_bits):
     return variable
 
 
+
+class LookupTable(object):
+    def __init__(self, function, x_min, x_max, no_pts = 2**14, log = True, outside = 'extrapolate'):
+        """Dense lookup table of a monotonically increasing function, e.g. a calibration spline. The table is
+        calculated once on a grid that is equally spaced in x (or log10(x)), so looking up a value is a simple index
+        calculation followed by a linear interpolation, which is much faster than evaluating a spline or a binary
+        search (np.searchsorted/np.interp) on large arrays.
+
+        If the function is not monotonic within the range the table is made monotonic (np.maximum.accumulate) and a
+        warning is issued.
+
+        Parameters
+        ----------
+        function: callable
+        x_min, x_max: float
+            Range of the table.
+        no_pts: int
+            Number of points in the table.
+        log: bool
+            If the grid is equally spaced in log10(x) or x.
+        outside: str
+            What is returned for values outside [x_min, x_max]:
+            'extrapolate': the table is continued with the mean slope of its outermost percent, as a power law if log
+                is True (and the table is positive), as a straight line otherwise. This keeps the result monotonic
+                everywhere.
+            'clip': the values at x_min and x_max.
+            'nan': NaN.
+            'function': function is evaluated, which is not necessarily monotonic.
+
+        Attributes
+        ----------
+        x, y: ndarrays
+            The table.
+        max_error: float
+            Maximum relative deviation from function (tested half way between the grid points).
+        """
+        if outside not in ('extrapolate', 'clip', 'nan', 'function'):
+            raise ValueError('outside has to be one of extrapolate, clip, nan, or function, not %s' % outside)
+        self.function = function
+        self.log = log
+        self.outside = outside
+        self.x_min = float(x_min)
+        self.x_max = float(x_max)
+        if log:
+            self._grid = _np.linspace(_np.log10(self.x_min), _np.log10(self.x_max), no_pts)
+            self.x = 10**self._grid
+        else:
+            self._grid = _np.linspace(self.x_min, self.x_max, no_pts)
+            self.x = self._grid
+        self._inv_step = (no_pts - 1) / (self._grid[-1] - self._grid[0])
+
+        y = _np.asarray(function(self.x), dtype=float)
+        self.monotonic = bool(_np.all(y[1:] >= y[:-1]))
+        if not self.monotonic:
+            y = _np.maximum.accumulate(y)
+            _warnings.warn('The function is not monotonic between %s and %s; the lookup table was made monotonic.' % (
+                self.x_min, self.x_max))
+        self.y = y
+
+        # slopes (per grid step) of the table at both ends, used for the extrapolation
+        self._log_y = log and bool(_np.all(y > 0))
+        y_ext = _np.log10(y) if self._log_y else y
+        k = max(no_pts // 100, 1)
+        self._slope_low = (y_ext[k] - y_ext[0]) / k
+        self._slope_high = (y_ext[-1] - y_ext[-1 - k]) / k
+
+        grid_mid = (self._grid[1:] + self._grid[:-1]) / 2.
+        x_mid = 10**grid_mid if log else grid_mid
+        y_soll = _np.asarray(function(x_mid), dtype=float)
+        self.max_error = _np.nanmax(_np.abs(((self.y[1:] + self.y[:-1]) / 2.) / y_soll - 1))
+
+    def __call__(self, x, chunksize = 1000000):
+        x = _np.asarray(x, dtype=float)
+        out = _np.empty(x.shape)
+        x_flat = x.ravel()
+        out_flat = out.reshape(-1)
+        last = self.y.shape[0] - 1
+        for start in range(0, x_flat.shape[0], chunksize):
+            xc = x_flat[start:start + chunksize]
+            with _np.errstate(divide='ignore', invalid='ignore'):
+                pos = ((_np.log10(xc) if self.log else xc) - self._grid[0]) * self._inv_step
+            inside = (pos >= 0) & (pos <= last)
+            idx = _np.clip(_np.where(inside, pos, 0).astype(_np.intp), 0, last - 1)
+            frac = pos - idx
+            yc = self.y[idx]
+            yc += frac * (self.y[idx + 1] - yc)
+            if not _np.all(inside):
+                yc[~inside] = self._outside(xc[~inside], pos[~inside])
+            out_flat[start:start + chunksize] = yc
+        if out.ndim == 0:
+            return float(out)
+        return out
+
+    def _outside(self, x, pos):
+        """Values for x outside the table, pos is the position of x in units of the grid steps."""
+        if self.outside == 'function':
+            return self.function(x)
+        out = _np.full(x.shape, _np.nan)
+        low = pos < 0
+        high = pos > self.y.shape[0] - 1
+        if self.outside == 'clip':
+            out[low] = self.y[0]
+            out[high] = self.y[-1]
+        elif self.outside == 'extrapolate':
+            last = self.y.shape[0] - 1
+            if self._log_y:
+                out[low] = self.y[0] * 10**(self._slope_low * pos[low])
+                out[high] = self.y[-1] * 10**(self._slope_high * (pos[high] - last))
+            else:
+                out[low] = self.y[0] + self._slope_low * pos[low]
+                out[high] = self.y[-1] + self._slope_high * (pos[high] - last)
+        return out
+
 class Correlation(object):
     def __init__(self, data, correlant, remove_zeros = True, index = False, odr_function = 'linear', sx = 1, sy = 1):
         """This object is for testing correlation in two two data sets.
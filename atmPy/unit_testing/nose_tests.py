@@ -149,6 +149,165 @@ class SizeDistTest(TestCase):
         # self.assertTrue(np.all(sd.optical_properties.aerosol_optical_depth_cumulative_VP.data.values == sdl.data.values))
         self.assertLess(abs((sd.optical_properties.aod_cumulative.data.values - sdl.data.values).sum()), 1e-10)
 
+    def test_opt_prop_TS_streaming(self):
+        import tempfile
+        bins = np.logspace(np.log10(15), np.log10(3000), 30)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        index = pd.date_range('2015-10-23 16:00:00', periods=60, freq='10s')
+        center = 200 + 100 * np.sin(np.linspace(0, 10 * np.pi, 60))
+        data = np.exp(-np.log(bincenters / center[:, np.newaxis]) ** 2 / 0.4) * 100
+        sd = size_distribution.sizedistribution.SizeDist_TS(pd.DataFrame(data, index=index, columns=bincenters), bins,
+                                                            'dNdlogDp')
+        sd.parameters4reductions.refractive_index = 1.5
+        sd.parameters4reductions.wavelength = 550
+        ext = sd.optical_properties.extinction_coeff.data.values
+        sca = sd.optical_properties.scattering_coeff.data.values
+        ext_per_bin = sd.optical_properties.extinction_coeff_per_bin.values
+        asf = sd.optical_properties.angular_scatt_func.values
+        hbs = sd.optical_properties.hemispheric_backscattering.data.values
+
+        with tempfile.TemporaryDirectory() as folder:
+            sd.parameters4reductions.streaming_store = os.path.join(folder, 'opt_prop.nc')
+            sd.parameters4reductions.streaming_chunksize = 25
+            self.assertLess(abs(sd.optical_properties.extinction_coeff.data.values - ext).max(), ext.max() * 1e-6)
+            self.assertLess(abs(sd.optical_properties.scattering_coeff.data.values - sca).max(), sca.max() * 1e-6)
+            self.assertLess(abs(sd.optical_properties.hemispheric_backscattering.data.values - hbs).max(),
+                            hbs.max() * 1e-10)
+            stored = sd.optical_properties.extinction_coeff_per_bin
+            self.assertEqual(stored.shape, ext_per_bin.shape)
+            self.assertTrue(np.all(stored[30:40].values == ext_per_bin[30:40]))
+            self.assertTrue(np.all(stored[:].values == ext_per_bin))
+            self.assertTrue(np.allclose(sd.optical_properties.angular_scatt_func[:].values, asf, rtol=1e-6))
+
+    def test_opt_prop_matrix_reduction(self):
+        """The matrix reduction has to give the same results as calculating the optical properties row by row, for
+        SizeDist, SizeDist_TS (with a varying, partly missing refractive index) and SizeDist_LS."""
+        from scipy import integrate
+        from atmPy.aerosols.physics import optical_properties
+        bins = np.logspace(1, np.log10(2500), 31)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        data = np.exp(-np.log(bincenters / 200) ** 2 / 0.4) * np.linspace(50, 150, 12)[:, np.newaxis]
+        index = pd.date_range('2015-10-23 16:00', periods=12, freq='min')
+        n_ts = np.array([1.5, 1.45 + 0.01j, 1.5, np.nan, 1.6, 1.45 + 0.01j] * 2)
+        layerbounderies = np.array([np.arange(12) * 100., np.arange(1, 13) * 100.]).transpose()
+
+        sd = size_distribution.sizedistribution.SizeDist(pd.DataFrame(data[:1], columns=bincenters), bins,
+                                                         'numberConcentration')
+        sd_ts = size_distribution.sizedistribution.SizeDist_TS(pd.DataFrame(data, index=index, columns=bincenters),
+                                                               bins, 'numberConcentration')
+        sd_ls = size_distribution.sizedistribution.SizeDist_LS(pd.DataFrame(data, index=layerbounderies.mean(axis=1),
+                                                                            columns=bincenters),
+                                                               bins, 'numberConcentration', layerbounderies)
+        for dist, n in ((sd, 1.5), (sd_ts, pd.DataFrame(n_ts, index=index, columns=['n'])), (sd_ls, 1.5 + 0.001j)):
+            dist.parameters4reductions.refractive_index = n
+            dist.parameters4reductions.wavelength = 550
+            out = optical_properties.size_dist2optical_properties(None, dist, aod=dist is sd_ls)
+            n_rows = n.iloc[:, 0].values if isinstance(n, pd.DataFrame) else [n] * dist.data.shape[0]
+            ext = np.asarray(out['extCoeff_perrow_perbin'].data if dist is sd else out['extCoeff_perrow_perbin'])
+            aod = 0
+            for i, n_row in enumerate(n_rows):
+                if np.isnan(n_row):
+                    self.assertTrue(np.all(np.isnan(ext[i])))
+                    continue
+                mie, asf = optical_properties._perform_Miecalculations(bincenters / 1000., 0.55, n_row)
+                ext_row = data[i] * mie.extinction_crossection.values * 1e-6
+                self.assertTrue(np.allclose(ext[i], ext_row, rtol=1e-6))
+                aod += ext_row.sum() * 100
+                pfe = (data[i] * asf).sum(axis=1)
+                self.assertTrue(np.allclose(out['angular_scatt_func'].values[i], pfe.values * 1e-6))
+                x = pfe.index.values[pfe.index.values < np.pi]
+                y = pfe.values[pfe.index.values < np.pi] * 4 * np.pi / (data[i] * mie.scattering_crossection).sum()
+                asym = .5 * integrate.simps(np.cos(x) * y * np.sin(x), x)
+                self.assertAlmostEqual(out['asymmetry_param'].values[i, 0], asym, places=10)
+            if dist is sd_ls:
+                self.assertLess(abs(out['AOD'] - aod), aod * 1e-10)
+
+    def test_opt_prop_refractive_index_interpolation(self):
+        """With refractive_index_interpolation the coefficients of each row have to agree with the exact Mie
+        calculation within the tolerance. If max_nodes does not suffice a warning is issued."""
+        import warnings
+        from atmPy.aerosols.physics import optical_properties
+        bins = np.logspace(1, np.log10(2500), 31)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        index = pd.date_range('2015-10-23 16:00', periods=30, freq='min')
+        data = np.exp(-np.log(bincenters / np.linspace(100, 500, 30)[:, np.newaxis]) ** 2 / 0.4) * 100
+        n = pd.DataFrame(np.linspace(1.45, 1.6, 30)[::-1] + np.linspace(0, 0.02, 30) * 1j, index=index,
+                         columns=['n'])
+        n.iloc[4] = np.nan
+        sd = size_distribution.sizedistribution.SizeDist_TS(pd.DataFrame(data, index=index, columns=bincenters),
+                                                            bins, 'numberConcentration')
+        sd.parameters4reductions.refractive_index = n
+        sd.parameters4reductions.wavelength = 550
+        soll = optical_properties.size_dist2optical_properties(None, sd)
+
+        tolerance = 1e-3
+        sd.parameters4reductions.refractive_index_interpolation = tolerance
+        out = optical_properties.size_dist2optical_properties(None, sd)
+        self.assertLessEqual(out['refractive_index_interpolation_error'], tolerance)
+        for key in ('extCoeff_perrow_perbin', 'scattCoeff_perrow_perbin'):
+            ist = out[key].sum(axis=1, min_count=1).values
+            exact = soll[key].sum(axis=1, min_count=1).values
+            self.assertTrue(np.all(np.isnan(ist) == n.n.isnull().values))
+            self.assertTrue(np.allclose(ist, exact, rtol=tolerance, atol=0, equal_nan=True))
+        asf = out['angular_scatt_func'].values
+        asf_exact = soll['angular_scatt_func'].values
+        valid = n.n.notnull().values
+        asf, asf_exact = asf[valid], asf_exact[valid]
+        self.assertTrue(np.all(np.abs(asf - asf_exact) <= tolerance * asf_exact.max(axis=1)[:, np.newaxis]))
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            n_interpolation = optical_properties._RefractiveIndexInterpolation(bincenters / 1000., 0.55,
+                                                                              n.n.dropna().values,
+                                                                              tolerance=1e-8, max_nodes=5)
+        self.assertEqual(n_interpolation.n_real.shape[0], 5)
+        self.assertEqual(n_interpolation.n_imag.shape[0], 5)
+        self.assertGreater(n_interpolation.max_interpolation_error, 1e-8)
+        self.assertTrue(any('did not reach the tolerance' in str(i.message) for i in w))
+
+    def test_spectral_optical_properties(self):
+        """Angstrom exponents of exact power laws, and the spectral properties of a SizeDist_TS agree with the single
+        wavelength calculation at each wavelength."""
+        from atmPy.aerosols.physics import optical_properties
+        wavelengths = np.array([450., 550., 700., 860.])
+        alpha = np.array([0., 1.3, -0.4, 2.])
+        coeff = pd.DataFrame(1e-5 * (wavelengths / 550.) ** -alpha[:, np.newaxis], columns=wavelengths)
+        out = optical_properties.angstrom_exponent(coeff)
+        self.assertTrue(np.allclose(out.angstrom_exponent.values, alpha, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(out.std_err.values, 0, rtol=0, atol=1e-12))
+        self.assertTrue(np.all(np.isnan(optical_properties.angstrom_exponent(coeff.iloc[:, :2]).std_err.values)))
+        coeff.iloc[2, 1] = 0
+        self.assertTrue(np.isnan(optical_properties.angstrom_exponent(coeff).angstrom_exponent.values[2]))
+
+        bins = np.logspace(1, np.log10(2500), 31)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        index = pd.date_range('2015-10-23 16:00', periods=8, freq='min')
+        data = np.exp(-np.log(bincenters / np.linspace(100, 400, 8)[:, np.newaxis]) ** 2 / 0.4) * 100
+        n = pd.DataFrame(np.array([1.5, 1.45 + 0.01j, np.nan, 1.5] * 2), index=index, columns=['n'])
+        sd = size_distribution.sizedistribution.SizeDist_TS(pd.DataFrame(data, index=index, columns=bincenters),
+                                                            bins, 'numberConcentration')
+        sd.parameters4reductions.refractive_index = n
+        spectral = sd.calculate_spectral_optical_properties(wavelengths)
+        ext = spectral.extinction_coeff.data
+        self.assertEqual(ext.shape, (8, 4))
+        for wl in wavelengths:
+            sd.parameters4reductions.wavelength = wl
+            soll = optical_properties.size_dist2optical_properties(None, sd)['extCoeff_perrow_perbin'].values
+            self.assertTrue(np.allclose(ext[wl].values, soll.sum(axis=1), rtol=1e-6, equal_nan=True))
+        self.assertTrue(np.all(np.isnan(ext.values[n.n.isnull().values])))
+        soll = optical_properties.angstrom_exponent(ext)
+        self.assertTrue(np.allclose(spectral.angstrom_exponent.data.values, soll.values, equal_nan=True))
+        self.assertTrue(np.all(spectral.angstrom_exponent.data.angstrom_exponent.dropna() > 0))
+
+        n = pd.DataFrame(np.linspace(1.45, 1.6, 8) + np.linspace(0, 0.02, 8) * 1j, index=index, columns=['n'])
+        n.iloc[2] = np.nan
+        sd.parameters4reductions.refractive_index = n
+        soll = sd.calculate_spectral_optical_properties(wavelengths).extinction_coeff.data.values
+        sd.parameters4reductions.refractive_index_interpolation = 1e-4
+        out = optical_properties.size_dist2spectral_optical_properties(sd, wavelengths)
+        self.assertLessEqual(out['refractive_index_interpolation_error'], 1e-4)
+        self.assertTrue(np.allclose(out['extinction_coeff'].values, soll, rtol=1e-3, equal_nan=True))
+
     def test_growth_opt_propLS(self):
 
         # use the same dist_LS as in test_opt_prop_LS
@@ -249,3 +408,577 @@ class PhysicsHygroscopicityTest(TestCase):
         threshold = sd.hygroscopicity.f_RH_85_40.data.sum().values[0] * 1e-5
         # np.abs(sd.hygroscopicity.f_RH_85_40.data - fRH_gd_soll.data).sum().values[0] < threshold
         self.assertLess(np.abs(sd.hygroscopicity.f_RH_85_40.data - fRH_gd_soll.data).sum().values[0], threshold)
+
+    def test_growth_shift(self):
+        """Growing all rows at once with a growth factor per row has to give the same result as growing each row
+        with its growth factor alone."""
+        bins = np.logspace(np.log10(0.14), np.log10(2.5), 31)
+        data = np.random.rand(6, 30)
+        gf = np.array([1.3, 1., np.nan, 2.2, 1.05, 1.7])
+        data_new, bins_new = hyg._growth_shift(data, bins, gf)
+
+        for e, gfi in enumerate(gf):
+            row_new, row_bins = hyg._growth_shift(data[e:e + 1], bins, gf[e:e + 1])
+            self.assertTrue(np.allclose(row_bins, bins_new[:row_bins.shape[0]]))
+            self.assertTrue(np.allclose(row_new[0], data_new[e, :row_new.shape[1]], equal_nan=True))
+            self.assertTrue(np.all(np.isnan(data_new[e, row_new.shape[1]:])))
+        self.assertTrue(np.all(np.isnan(data_new[2])))
+        self.assertTrue(np.allclose(data_new[1, :30], data[1]))
+
+    def test_kappa_from_fofrh_grid(self):
+        """Growth factors are retrieved from the f of RH of size distributions that were grown with known growth
+        factors."""
+        from atmPy.general import timeseries
+        bins = np.logspace(2, 3, 31)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        index = pd.date_range('2012-06-01', periods=20, freq='min')
+        data = np.exp(-np.log(bincenters / 250) ** 2 / 0.3) * np.linspace(50, 150, 20)[:, np.newaxis]
+        sd = size_distribution.sizedistribution.SizeDist_TS(pd.DataFrame(data, index=index, columns=bincenters), bins,
+                                                            'numberConcentration')
+        n = pd.DataFrame(np.linspace(1.45, 1.6, 20) + 0.01j, index=index, columns=['n'])
+        sd.parameters4reductions.refractive_index = n
+        sd.parameters4reductions.wavelength = 550
+
+        gf_soll = np.linspace(1.05, 1.9, 20)
+        sd_grown = hyg.apply_growth2sizedist(sd.copy(), gf_soll.copy())
+        sd_grown.parameters4reductions.refractive_index = n
+        sd_grown.parameters4reductions.wavelength = 550
+        f_rh = sd_grown.optical_properties.scattering_coeff.data.values / sd.optical_properties.scattering_coeff.data.values
+        f_rh = timeseries.TimeSeries(pd.DataFrame(f_rh, index=index, columns=['f_RH']))
+
+        kappa, gf = hyg.kappa_from_fofrh_and_sizedist(f_rh, sd, 550, 85)
+        self.assertLess(np.abs(gf.data.values[:, 0] - gf_soll).max(), 1e-3)
+        self.assertTrue(np.allclose(kappa.data.values[:, 0], hyg.kappa_simple(gf.data.values[:, 0], 85, inverse=True)))
+
+        f_rh = sd_grown.optical_properties.extinction_coeff.data.values / sd.optical_properties.extinction_coeff.data.values
+        f_rh = timeseries.TimeSeries(pd.DataFrame(f_rh, index=index, columns=['f_RH']))
+        kappa, gf = hyg.kappa_from_fofrh_and_sizedist(f_rh, sd, 550, 85, quantity='extinction')
+        self.assertLess(np.abs(gf.data.values[:, 0] - gf_soll).max(), 1e-3)
+
+
+class MieScatteringTest(TestCase):
+    def test_bhmie_vectorized(self):
+        """The vectorized Mie calculation has to give the same results as bhmie_hagen for each individual particle."""
+        from atmPy.radiation.mie_scattering import bhmie
+        d = np.logspace(-2, 1, 50)
+        x = np.pi * d / 0.55
+        n = 1.5 + 0.01j
+        vect = bhmie.bhmie_vectorized(x, n, 100, diameter=d)
+        for e, xi in enumerate(x):
+            mie = bhmie.bhmie_hagen(xi, n, 100, diameter=d[e])
+            soll = mie.return_Values_as_dict()
+            for key in ['extinction_crosssection', 'scattering_crosssection', 'asymmetry_parameter']:
+                self.assertLess(abs(vect[key][e] - soll[key]), abs(soll[key]) * 1e-10)
+            self.assertLess(np.abs(vect['S1'][e] - mie.s1).max(), np.abs(mie.s1).max() * 1e-10)
+
+    def test_mie_cache(self):
+        """Results from the cache (in memory or warmed from disk) have to be the same as freshly calculated ones."""
+        import tempfile
+        from atmPy.radiation.mie_scattering import bhmie, mie_cache
+        d = np.logspace(-2, 1, 20)
+        x = np.pi * d / 0.55
+        soll = bhmie.bhmie_vectorized(x, 1.5, 50, diameter=d)
+
+        cache = mie_cache.MieCache(size=15)
+        cache.get(x, 1.5, 50, diameter=d)
+        self.assertEqual(len(cache), 15)
+        with tempfile.TemporaryDirectory() as folder:
+            cache.save(os.path.join(folder, 'mie_cache.npz'))
+            cache_disk = mie_cache.MieCache()
+            cache_disk.load(os.path.join(folder, 'mie_cache.npz'))
+        out = cache_disk.get(x, 1.5, 50, diameter=d)
+        self.assertEqual(cache_disk.hits, 15)
+        for key in ['extinction_crosssection', 'scattering_crosssection', 'S1', 'S2']:
+            self.assertLess(np.abs(out[key] - soll[key]).max(), np.abs(soll[key]).max() * 1e-10)
+
+    def test_mie_kernels(self):
+        """Each (wavelength, refractive index) label carries the Mie results of exactly that combination, also for
+        unsorted input and in parallel."""
+        from atmPy.radiation.mie_scattering import bhmie, mie_kernels
+        bins = np.logspace(1, 3, 11)
+        bincenters = (bins[1:] + bins[:-1]) / 2
+        sd = size_distribution.sizedistribution.SizeDist(pd.DataFrame(np.ones((1, 10)), columns=bincenters), bins,
+                                                         'numberConcentration')
+        wavelengths = [700., 450.]
+        refractive_indices = [1.6, 1.45 + 0.01j]
+        for workers in (1, 2):
+            kernels = mie_kernels.calculate_kernels(bincenters / 1000., np.array(wavelengths) / 1000.,
+                                                    refractive_indices, workers=workers)
+            kernels_nm = sd.optical_properties.mie_kernels(wavelengths, refractive_indices, workers=workers)
+            for wl in wavelengths:
+                for n in refractive_indices:
+                    soll = bhmie.bhmie_vectorized(np.pi * bincenters / wl, n, 100, diameter=bincenters / 1000.)
+                    for out in (kernels['extinction_crossection'].loc[(wl / 1000., n)].values,
+                                kernels_nm['extinction_crossection'].loc[(wl, n)].values):
+                        self.assertTrue(np.allclose(out, soll['extinction_crosssection'], rtol=1e-10))
+            self.assertTrue(np.all(kernels_nm['extinction_crossection'].columns == bincenters))
+
+    def test_bhcoat_vectorized(self):
+        """The vectorized coated sphere calculation has to agree with the scalar Mie coefficients of each particle
+        and fall back to homogeneous spheres if there is no core."""
+        from atmPy.radiation.mie_scattering import bhmie, mie_coated, mie_coeffs
+        d = np.logspace(-2, 1, 20)
+        y = np.pi * d / 0.55
+        m_core = 1.95 + 0.79j
+        m_shell = 1.5 + 0j
+        vect = mie_coated.bhcoat_vectorized(y * 0.5, y, m_core, m_shell, 50, diameter=d)
+        for e, yi in enumerate(y):
+            an, bn, nmax = mie_coeffs.coated_mie_coeff(m_core ** 2, m_shell ** 2, yi * 0.5, yi)
+            n = np.arange(1, nmax + 1)
+            qext = 2 / yi ** 2 * ((2 * n + 1) * (an + bn).real).sum()
+            self.assertLess(abs(vect['extinction_efficiency'][e] - qext), qext * 1e-10)
+
+        no_core = mie_coated.bhcoat_vectorized(0, y, m_core, m_shell, 50, diameter=d)
+        soll = bhmie.bhmie_vectorized(y, m_shell, 50, diameter=d)
+        self.assertLess(np.abs(no_core['S1'] - soll['S1']).max(), np.abs(soll['S1']).max() * 1e-10)
+
+
+class POPSTest(TestCase):
+    def test_read_peaks_binary(self):
+        """Peak files with and without header as well as a truncated last cluster."""
+        import struct
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import peaks
+        clusters = b''
+        soll = []
+        for c, length in enumerate([3, 0, 2]):
+            clusters += struct.pack('>QQi', 3500000000 + c, 2**63, length)
+            for i in range(length):
+                clusters += struct.pack('>LHBBB', 1000 * c + i, 200 + i, 10, 0, i % 2)
+                soll.append([3500000000.5 + c, 1000 * c + i, 200 + i, 10, 0, i % 2])
+        soll = np.array(soll)
+        truncated = struct.pack('>QQi', 3500000003, 0, 5) + struct.pack('>LHBBB', 1, 1, 1, 1, 1)
+
+        with tempfile.TemporaryDirectory() as folder:
+            fname = os.path.join(folder, '20160101_Peak.bin')
+            for content in (b'\x00' * 20 + clusters, clusters, b'\x00' * 20 + clusters + truncated):
+                with open(fname, 'wb') as out:
+                    out.write(content)
+                data = peaks._binary2array_labview_clusters(fname)
+                self.assertTrue(np.array_equal(data, soll))
+
+    def test_read_peaks_binary_multiple_files(self):
+        """Reading several files in parallel has to give the same (ordered) result as reading them one by one."""
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import peaks
+        with tempfile.TemporaryDirectory() as folder:
+            files = []
+            for e in range(3):
+                fname = os.path.join(folder, '20160101_%02i0000_Peak.bin' % e)
+                peaks._write_synthetic_peak_file(fname, 0.05, peaks_per_cluster=10, start=3.5e9 + e * 3600)
+                files.append(fname)
+            soll = pd.concat([peaks.read_binary(fname).data for fname in files])
+            for workers in (1, 2):
+                out = peaks.read_binary(files, workers=workers)
+                self.assertTrue(soll.equals(out.data))
+                self.assertTrue(out.data.index.is_monotonic_increasing)
+
+    def test_peak2sizedistribution(self):
+        """All peaks within the bins have to end up in the size distribution, at any time resolution."""
+        from atmPy.aerosols.instruments.POPS import peaks
+        times = np.datetime64('2016-01-01') + np.sort(np.random.randint(0, 600, 5000)) * np.timedelta64(100, 'ms')
+        data = pd.DataFrame({'Amplitude': np.random.uniform(35, 65000, 5000),
+                             'Masked': np.random.choice([0, 0, 0, 1, 2], 5000).astype(np.int8)},
+                            index=pd.Index(times, name='Time_UTC'))
+        peak_data = peaks.peaks(data)
+        bins = np.logspace(np.log10(35), np.log10(65000), 50)
+        soll = np.histogram(data.Amplitude[data.Masked == 0], bins=bins)[0]
+        for resolution in (None, '1S', '7S'):
+            dist = peak_data.peak2peakHeightDistribution(bins=bins, resolution=resolution)
+            count_rate = peak_data.get_countRate(resolution=resolution)
+            counts = dist.data.values * (bins[1:] - bins[:-1]) * count_rate.DeltaT_s.values[:, np.newaxis]
+            self.assertTrue(np.allclose(counts.sum(axis=0), soll))
+            self.assertEqual(count_rate.No_of_particles.sum(), (data.Masked == 0).sum())
+
+    def test_read_cal_process_peakFile_streaming(self):
+        """Processing the peaks block by block has to give the same size distribution as processing all at once."""
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import peaks, calibration
+        d = np.logspace(np.log10(120), np.log10(3500), 30)
+        cal = calibration.Calibration(pd.DataFrame({'amp': 30 * (d / 120) ** 2.5, 'd': d}))
+        with tempfile.TemporaryDirectory() as folder:
+            for e in range(2):
+                fname = os.path.join(folder, '20160101_%02i0000_Peak.bin' % e)
+                peaks._write_synthetic_peak_file(fname, 0.2, peaks_per_cluster=37, start=3.5e9 + e * 600)
+            all_peaks = peaks.read_binary(folder)
+            all_peaks.apply_calibration(cal)
+            for resolution in (None, '7S'):
+                soll = all_peaks.peak2sizedistribution(resolution=resolution)
+                out = peaks.read_cal_process_peakFile_streaming(folder, cal, resolution=resolution, block_size=1000)
+                self.assertTrue(np.all(out.data.index == soll.data.index))
+                self.assertTrue(np.allclose(out.data.values, soll.data.values))
+
+    def test_read_cal_process_peakFile_streaming_clean(self):
+        """Cleaning uses the thresholds of the file version, so no valid peak of a current version file is removed."""
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import peaks, calibration
+        d = np.logspace(np.log10(120), np.log10(3500), 30)
+        cal = calibration.Calibration(pd.DataFrame({'amp': 30 * (d / 120) ** 2.5, 'd': d}))
+        with tempfile.TemporaryDirectory() as folder:
+            fname = os.path.join(folder, '20160101_000000_Peak.bin')
+            no_of_clusters = peaks._write_synthetic_peak_file(fname, 0.2, peaks_per_cluster=37)
+            no_of_peaks = sum(block.data.shape[0] for block in peaks.iter_binary(fname, block_size=1000, clean=True))
+            self.assertEqual(no_of_peaks, no_of_clusters * 37)
+
+            soll = peaks.read_cal_process_peakFile_streaming(fname, cal, resolution='7S', block_size=1000)
+            out = peaks.read_cal_process_peakFile_streaming(fname, cal, resolution='7S', block_size=1000, clean=True)
+            self.assertTrue(np.allclose(out.data.values, soll.data.values))
+
+            out = peaks.read_cal_process_peakFile_streaming(fname, cal, resolution='7S', block_size=1000,
+                                                            clean=dict(amplitude_range=(0, 1000)))
+            self.assertTrue(out.data.values.sum() < soll.data.values.sum())
+
+    def test_cleanPeaksArray(self):
+        """Each criterion removes and counts the right peaks, a bad time stamp does not affect the following peaks."""
+        from atmPy.aerosols.instruments.POPS import peaks
+        no_peaks = 3000
+        data = np.zeros((no_peaks, 6))
+        data[:, 0] = np.repeat(np.arange(no_peaks // 3) * 0.1, 3)
+        data[:, 2] = 10.
+        data[:, 3] = 50
+        data[:, 5] = 1
+        data[10, 0] = 2e6
+        data[20, 2] = 7e4
+        data[30, 5] = 3
+        data[40, 3] = 1
+        data[50, 4] = 1
+        data[100, 0] -= 5
+        data[200, 0] += 5
+        clean, report, statistics = peaks._cleanPeaksArray(data, remove_saturated=True, return_statistics=True)
+        soll = dict(time=1, amplitude=1, use=1, width=1, saturated=1, time_continuity=2)
+        for criterion in soll:
+            self.assertEqual(statistics[criterion], soll[criterion])
+        self.assertEqual(clean.shape[0], no_peaks - 7)
+
+        clean, report = peaks._cleanPeaksArray(data, amplitude_range=(0, 1e5), time_tolerance=None)
+        self.assertEqual(clean.shape[0], no_peaks - 3)
+
+    def test_read_raw(self):
+        """Raw files are big endian int16, windowed, decimated and lazy reading has to give the same numbers."""
+        import struct
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import raw
+        soll = np.arange(-5000, 5000, 7)
+        with tempfile.TemporaryDirectory() as folder:
+            fname = os.path.join(folder, 'raw.bin')
+            with open(fname, 'wb') as out:
+                out.write(struct.pack('>%ih' % soll.shape[0], *soll))
+            self.assertTrue(np.array_equal(raw.read(fname), soll))
+            self.assertTrue(np.array_equal(raw.read(fname, start=10, stop=500, step=3), soll[10:500:3]))
+            lazy = raw.read(fname, lazy=True)
+            self.assertEqual(len(lazy), soll.shape[0])
+            mins, maxs = lazy.envelope(100, chunksize=250)
+            self.assertTrue(np.array_equal(mins, soll[::100]))
+            self.assertTrue(np.array_equal(maxs[:-1], soll[99::100]))
+            self.assertEqual(maxs[-1], soll[-1])
+            del lazy
+
+    def test_mirror_weights(self):
+        """The cached mirror weights have to give the same intensity as the sum over the mirror grid."""
+        from atmPy.aerosols.instruments.POPS import mie
+        event = mie.Mie(silent=True, indexOfRef=1.59, diameter='dynamic', wavelength=.405, nang=100)
+        event.set_r(0.3)
+        for polarization in ('perpendicular', 'parallel', 'natural'):
+            intensity = event.get_detectableIntensity(polarization)
+            event.get_mirror_grid()
+            s1 = np.abs(event.s1[event.angleIndexArray]) ** 2
+            s2 = np.abs(event.s2[event.angleIndexArray]) ** 2
+            off = event.offAngleMatrix
+            if polarization == 'perpendicular':
+                grid = np.sin(off) ** 2 * s2 + np.cos(off) ** 2 * s1
+            elif polarization == 'parallel':
+                grid = np.cos(off) ** 2 * s2 + np.sin(off) ** 2 * s1
+            else:
+                grid = np.where(np.isnan(off), 0, .5 * (s1 + s2))
+            self.assertAlmostEqual(intensity / np.nansum(grid), 1, places=10)
+
+    def test_makeMie_diameter_batch(self):
+        """The batched simulation has to agree with the Mie instance for each combination."""
+        from atmPy.aerosols.instruments.POPS import mie
+        diameters = np.array([0.15, 0.5, 1.2])
+        wavelengths = [.405, .45]
+        iors = [1.45, 1.59 + 0.01j]
+        out = mie.makeMie_diameter_batch(diameters, wavelengths, iors, mirrorJetDist=7.68)
+        self.assertEqual(out.shape, (4, 3))
+        event = mie.Mie(silent=True, indexOfRef=1.45, diameter='dynamic', wavelength=.405)
+        for wl in wavelengths:
+            for ior in iors:
+                event.set_wavelength(wl)
+                event.set_n(ior)
+                for d in diameters:
+                    event.set_d(d)
+                    soll = event.get_detectableIntensity('perpendicular')
+                    self.assertAlmostEqual(out.loc[(wl, ior), d] / soll, 1, places=10)
+
+    def test_generate_calibration_cache(self):
+        """Simulated responds curves are reused from memory and disk and give the same calibration."""
+        import tempfile
+        from atmPy.aerosols.instruments.POPS import calibration
+        kwargs = dict(ior=1.52, no_pts=150, no_cal_pts=10)
+        soll = calibration.generate_calibration(**kwargs)
+        with tempfile.TemporaryDirectory() as folder:
+            calibration.generate_calibration(cache=folder, **kwargs)
+            self.assertEqual(len(os.listdir(folder)), 2)
+            calibration._response_cache.clear()
+            out = calibration.generate_calibration(cache=folder, **kwargs)
+            self.assertEqual(len(calibration._response_cache), 2)
+        self.assertTrue(np.allclose(out.data.values, soll.data.values))
+
+    def test_calibration_lookup_table(self):
+        """The lookup table agrees with the spline inside the calibration range and is continued as a power law
+        outside."""
+        from atmPy.aerosols.instruments.POPS import calibration
+        data = pd.DataFrame({'d': np.logspace(np.log10(140), np.log10(3000), 22)})
+        data['amp'] = 0.01 * data.d ** 2
+        cal = calibration.Calibration(data)
+        self.assertTrue(cal.lookup_table.monotonic)
+        self.assertLess(cal.lookup_table.max_error, 1e-6)
+        amp = np.logspace(1, 5, 1000)
+        out = cal.calibrationFunction(amp)
+        soll = cal.calibrationFunctionSpline(amp)
+        self.assertTrue(np.allclose(out, soll, rtol=1e-6))
+        self.assertTrue(np.allclose(out, 10 * amp ** 0.5, rtol=1e-6))
+
+    def test_calibration_interface_bins_monotonic(self):
+        """Bin edges beyond the calibrated amplitude range have to keep increasing."""
+        from atmPy.aerosols.instruments.POPS import calibration
+        cal = calibration.generate_calibration(ior=1.52, no_pts=600, no_cal_pts=20)
+        self.assertLess(cal.data.amp.max(), 10 ** 4.8)
+        edges = cal.get_interface_bins(20)['binedges_v_int'].Bin_edges.values
+        self.assertTrue(np.all(np.diff(edges) > 0))
+        amp = np.logspace(0, 5, 20000)
+        self.assertTrue(np.all(np.diff(cal.calibrationFunction(amp)) > 0))
+
+
+class _Gas(object):
+    """Air at about 20 C and 1 atm, only what the mobility functions need"""
+    t = 20.
+
+    def mu(self):
+        return 1.81e-5
+
+    def l(self):
+        return 0.0665
+
+
+class PhysicsAerosolTest(TestCase):
+    def test_z2d_vectorized(self):
+        from atmPy.aerosols.physics import aerosol
+        from atmPy.aerosols.instruments.DMA import dma
+        gas = _Gas()
+        mobilities = np.logspace(-9, -4, 50)
+        for n in (1, 2):
+            soll = np.array([aerosol.z2d(z, gas, n) for z in mobilities])
+            self.assertTrue(np.allclose(aerosol.z2d_vectorized(mobilities, gas, n), soll, rtol=1e-8))
+
+        voltages = np.array([20., 500., 5000.])
+        noaa = dma.NoaaWide()
+        soll = np.array([noaa.v2d(v, gas, 5., 5.) for v in voltages])
+        self.assertTrue(np.allclose(noaa.v2d_vectorized(voltages, gas, 5., 5.), soll, rtol=1e-8))
+
+    def test_vectorized_mobility_physics(self):
+        """z, cc and ndistr (scalar and array calls) reproduce the values of the former scalar implementation, for
+        the Wiedensohler (dp <= 1000 nm and |n| <= 2) and the temperature dependent Gunn branch."""
+        from atmPy.aerosols.physics import aerosol
+        gas = _Gas()
+        diam = np.array([5., 50., 300., 1500.])
+        z_soll = [8.581247989049194e-06, 9.680933401221364e-08, 4.880021117097904e-09, 6.910984132332544e-10]
+        cc_soll = [45.68344568986887, 5.153777117574435, 1.5587675355811972, 1.1037470377590413]
+        self.assertIsInstance(aerosol.z(50., gas, 1), float)
+        self.assertIsInstance(aerosol.ndistr(50., -1), float)
+        self.assertTrue(np.allclose(aerosol.z(diam, gas, 1), z_soll, rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(aerosol.z(diam, gas, 2), 2 * np.array(z_soll), rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(aerosol.cc(diam, gas), cc_soll, rtol=1e-12, atol=0))
+        for d, z, c in zip(diam, z_soll, cc_soll):
+            self.assertAlmostEqual(aerosol.z(d, gas, 1) / z, 1, places=12)
+            self.assertAlmostEqual(aerosol.cc(d, gas) / c, 1, places=12)
+
+        # (dp, n, t, charged fraction)
+        ndistr_soll = [(50.0, -1, 20.0, 0.22286241046455535), (300.0, 2, 20.0, 0.08780998195150135),
+                       (1000.0, -2, 20.0, 0.12606658835244963), (15.0, -2, 20.0, 0), (50.0, 3, 20.0, 0),
+                       (100.0, 0, 0.0, 0.42589250766720704), (50.0, -1, 35.0, 0.22286241046455535),
+                       (100.0, -3, 0.0, 0.0026574302861938487), (100.0, -3, 35.0, 0.004671480248943465),
+                       (100.0, 3, 35.0, 0.002096538466674615), (1500.0, -1, 0.0, 0.11206533115013756),
+                       (1500.0, -1, 35.0, 0.10452494082220327), (1500.0, 1, 20.0, 0.08239021753675786),
+                       (1500.0, 2, 35.0, 0.06282675031023525), (3000.0, 0, 35.0, 0.0592734539330048),
+                       (3000.0, -3, 20.0, 0.07737872869947952)]
+        for dp, n, t, soll in ndistr_soll:
+            self.assertAlmostEqual(aerosol.ndistr(dp, n, t), soll, places=12)
+        for t in (0., 20., 35.):
+            cases = [case for case in ndistr_soll if case[2] == t]
+            for n in set(case[1] for case in cases):
+                dp = np.array([case[0] for case in cases if case[1] == n])
+                soll = [case[3] for case in cases if case[1] == n]
+                self.assertTrue(np.allclose(aerosol.ndistr(dp, n, t), soll, rtol=1e-12, atol=1e-15))
+                dist = aerosol.charge_distribution(dp, [n], t=t)
+                self.assertTrue(np.allclose(dist[n].values, soll, rtol=1e-12, atol=1e-15))
+
+
+def _smps_proc_file_stub(fname, *settings):
+    """Stands in for SMPS.__proc_file__ (and smps._proc_file, which also gets the settings): canned up and down scans,
+    dated by the number in the file name.  Scan 2 was taken at a higher temperature."""
+    if 'bad' in fname:
+        raise IOError('corrupt file %s' % fname)
+    hour = int(fname.split('_')[-1].split('.')[0])
+    date = np.datetime64('2016-01-01T00:00') + np.timedelta64(hour, 'h')
+    diam = np.logspace(np.log10(20), np.log10(500), 10)
+    return {'date': (date, date + np.timedelta64(2, 'm')),
+            'diam': (diam, diam[::-1]),
+            'cn_raw': (np.ones(10) * hour, np.ones(10) * hour),
+            'cn_smoothed': (np.ones(10) * hour, np.ones(10) * hour + 0.5),
+            'conditions': ((25. if hour == 2 else 22., 12.5, 0.5, 5.),) * 2}
+
+
+class DMATest(TestCase):
+    def test_smps_proc_files(self):
+        """Scans are assembled in chronological order and inverted in groups of the same diameters and conditions with
+        any number of workers, failed files are collected."""
+        from unittest import mock
+        try:
+            from atmPy.aerosols.instruments.DMA import smps
+        except ImportError as err:
+            self.skipTest('smps can not be imported: %s' % err)
+        from atmPy.aerosols.instruments.DMA import dma
+        for workers in (1, 2):
+            with mock.patch.object(smps.SMPS, '__proc_file__', lambda self, fname: _smps_proc_file_stub(fname)), \
+                    mock.patch.object(smps, '_proc_file', _smps_proc_file_stub):
+                instrument = smps.SMPS(dma.NoaaWide())
+                instrument.files = ['scan_3.txt', 'scan_bad.txt', 'scan_1.txt', 'scan_2.txt']
+                out = instrument.proc_files(workers=workers)
+            self.assertEqual(list(instrument.failed.keys()), ['scan_bad.txt'])
+            self.assertIsInstance(instrument.failed['scan_bad.txt'], IOError)
+            self.assertIs(out, instrument.size_distribution)
+            self.assertEqual(out.data.shape, (6, 300))
+            self.assertTrue(out.data.index.is_monotonic_increasing)
+            self.assertTrue(np.all(instrument.cn_raw[:, 0] == [1, 1, 2, 2, 3, 3]))
+            self.assertTrue(np.all(instrument.cn_smoothed[:, 0] == [1, 1.5, 2, 2.5, 3, 3.5]))
+            for row in range(6):
+                scan = _smps_proc_file_stub('scan_%i.txt' % (row // 2 + 1))
+                soll = instrument.__fwhm__(scan['diam'][row % 2], scan['cn_smoothed'][row % 2],
+                                           scan['conditions'][row % 2])
+                self.assertTrue(np.allclose(out.data.values[row], soll, rtol=1e-12, atol=0, equal_nan=True))
+            self.assertGreater(np.isfinite(out.data.values).sum(), 6 * 100)
+
+            instrument.files = ['scan_bad.txt']
+            with mock.patch.object(smps.SMPS, '__proc_file__', lambda self, fname: _smps_proc_file_stub(fname)):
+                self.assertRaises(ValueError, instrument.proc_files)
+            self.assertIsNone(instrument.size_distribution)
+            self.assertEqual(list(instrument.failed.keys()), ['scan_bad.txt'])
+
+    def test_smps_proc_files_worker(self):
+        """Worker processes set up their SMPS from the settings sent with the files and give the same result as
+        processing the files in the current process. Only the LOWESS smoothing is stubbed, the worker processes
+        inherit the stub by forking."""
+        import multiprocessing
+        import tempfile
+        from unittest import mock
+        try:
+            from atmPy.aerosols.instruments.DMA import smps
+        except ImportError as err:
+            self.skipTest('smps can not be imported: %s' % err)
+        if multiprocessing.get_start_method() != 'fork':
+            self.skipTest('the LOWESS stub is only inherited by forked worker processes')
+        from atmPy.aerosols.instruments.DMA import dma
+
+        tscan, tdwell = 60, 10
+        volts = np.concatenate((np.logspace(1, np.log10(5000), tscan), np.ones(tdwell) * 5000))
+        diam = np.logspace(np.log10(10), np.log10(300), tscan + tdwell)
+        with tempfile.TemporaryDirectory() as folder:
+            fnames = []
+            for minute in (5, 0):
+                counts = 1000 * np.exp(-np.log(diam / (80 + minute)) ** 2) + minute
+                times = pd.date_range('2016-01-01 00:%02i:00' % minute, periods=tscan + tdwell, freq='s')
+                data = pd.DataFrame({'CPC_1_Cnt': counts, 'CPC_Flw': 1., 'DMA_Diam': diam, 'DMA_Set_Volts': volts,
+                                     'Aer_Temp_C': 22., 'Aer_Pres_PSI': 12.5, 'Sh_Q_VLPM': 5., 'Aer_Q_VLPM': 0.5},
+                                    index=pd.Index(times, name='Date_Time'))
+                fname = os.path.join(folder, 'scan_%i.csv' % minute)
+                with open(fname, 'w') as scan_file:
+                    scan_file.write('Date,Time,Scan_Time,Dwell_Time\n')
+                    scan_file.write('01/01/16,00:%02i:00,%i,%i\n' % (minute, tscan, tdwell))
+                    data.to_csv(scan_file)
+                fnames.append(fname)
+
+            out = {}
+            with mock.patch.object(smps.sm.nonparametric, 'lowess', lambda endog, exog, **kwargs: endog.copy()):
+                for workers in (1, 2):
+                    smps.transfer_function._fwhm_cache.clear()
+                    smps.charge_correction._kernels.clear()
+                    instrument = smps.SMPS(dma.NoaaWide())
+                    instrument.lag = 3
+                    instrument.files = fnames
+                    out[workers] = instrument.proc_files(workers=workers).data
+                    self.assertEqual(instrument.failed, {})
+                    # both files were taken under the same conditions: one calculation for the up and one for the
+                    # down scans
+                    self.assertEqual(len(smps.transfer_function._fwhm_cache), 2)
+                    self.assertEqual(len(smps.charge_correction._kernels), 2)
+
+        self.assertEqual(out[2].shape, (4, 300))
+        self.assertTrue(out[2].index.is_monotonic_increasing)
+        # diameters outside of the scanned range are NaN
+        self.assertGreater(np.isfinite(out[2].values).sum(axis=1).min(), 100)
+        self.assertGreater(np.nanmax(out[2].values), 0)
+        self.assertTrue(np.allclose(out[2].values, out[1].values, rtol=1e-12, atol=0, equal_nan=True))
+
+    def test_charge_correction_kernel(self):
+        """The kernel inverts what it forward calculates, with and without clipping."""
+        from atmPy.aerosols.instruments.DMA import charge_correction
+        diam = np.logspace(1, 3, 60)
+        kernel = charge_correction.get_kernel(diam, _Gas(), n=3)
+        self.assertIs(kernel, charge_correction.get_kernel(diam.copy(), _Gas(), n=3))
+        self.assertTrue(np.all(kernel.matrix[np.tril_indices(diam.shape[0], -1)] == 0))
+        true = np.random.RandomState(0).uniform(0, 100, (4, diam.shape[0]))
+        measured = true.dot(kernel.matrix.T)
+        self.assertTrue(np.allclose(kernel.apply(measured, clip=False), true))
+        self.assertTrue(np.allclose(kernel.apply(measured), true))
+        self.assertTrue(np.allclose(kernel.apply(measured[1]), true[1]))
+
+    def test_charge_correction_regression(self):
+        """SMPS.__chargecorr__ (all scans at once) gives the results of the former loop over the diameters, including
+        the clipping where a channel would loose more particles than it contains."""
+        from atmPy.aerosols.instruments.DMA import charge_correction
+        diam = np.logspace(1, 3, 12)
+        dn = 100 * np.exp(-np.log(diam / 150) ** 2)
+        dn_clipped = dn.copy()
+        dn_clipped[2:5] = 0.5
+        soll = {(3, -1): [[1.270532648306, 6.291331944273, 22.461778617297, 59.449720102442, 111.635896205769,
+                           170.768846045216, 211.851232279172, 218.1385878552, 182.936395510967, 115.96789447373,
+                           54.68743545987, 19.753600297711],
+                          [1.270532648306, 6.394402276426, 3.901983806032, 2.806101591193, 0.,
+                           170.768846045216, 211.851232279172, 218.1385878552, 182.936395510967, 115.96789447373,
+                           54.68743545987, 19.753600297711]],
+                (2, 1): [[1.588860723316, 8.09781800759, 29.654661929686, 79.819561357071, 163.591083805128,
+                          262.639661235227, 335.481797773149, 343.217395023588, 277.444453559929, 173.971838805517,
+                          75.443155007926, 26.323659337823]]}
+        for (n, pos_neg), values in soll.items():
+            measured = np.array([dn, dn_clipped][:len(values)])
+            out = charge_correction.get_kernel(diam, _Gas(), n=n, pos_neg=pos_neg).apply(measured)
+            self.assertTrue(np.allclose(out, values, rtol=1e-11, atol=1e-11))
+
+        try:
+            from atmPy.aerosols.instruments.DMA import smps
+        except ImportError as err:
+            self.skipTest('smps can not be imported: %s' % err)
+        measured = np.array([dn, dn_clipped])
+        smps.SMPS.__chargecorr__(diam, measured, _Gas())
+        self.assertTrue(np.allclose(measured, soll[(3, -1)], rtol=1e-11, atol=1e-11))
+
+    def test_transfer_function_fwhm(self):
+        """The triangular FWHM is the one of SMPS.__fwhm__, diffusion only broadens it."""
+        from atmPy.aerosols.physics import aerosol
+        from atmPy.aerosols.instruments.DMA import dma, transfer_function
+        gas = _Gas()
+        diam = np.array([5., 50., 500.])
+        soll = []
+        for d in diam:
+            zc = aerosol.z(d, gas, 1)
+            soll.append(aerosol.z2d(0.95 * zc, gas, 1) - aerosol.z2d(1.05 * zc, gas, 1))
+        self.assertTrue(np.allclose(transfer_function.get_fwhm(diam, gas, 0.3, 3.), soll, rtol=1e-8))
+        self.assertIs(transfer_function.get_fwhm(diam.copy(), _Gas(), 0.3, 3.),
+                      transfer_function.get_fwhm(diam, gas, 0.3, 3.))
+
+        z_tilde = np.linspace(0, 2, 20001)
+        area = np.trapz(transfer_function.omega_diffusing(z_tilde, 0.1, 0.02), z_tilde)
+        self.assertAlmostEqual(area, 0.1, places=6)
+        broadened = transfer_function.get_fwhm(diam, gas, 0.3, 3., dma=dma.NoaaWide(), diffusion=True)
+        self.assertTrue(np.all(broadened > soll))